@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+# Test that ultratils modules import quickly and do not pull in heavy
+# libraries at import time. Each module is imported cold in a fresh
+# interpreter. Exits with status 1 if any module goes over its budget.
+#
+# Usage: python scripts/test_import_time.py [budget_seconds]
+
+import sys
+import subprocess
+
+# Default cold import budget in seconds, on top of the cost of numpy, which
+# every module needs.
+BUDGET = 0.25
+
+# Libraries that no module below may import at import time.
+HEAVY = ['pandas', 'matplotlib', 'scipy', 'audiolabel', 'pkg_resources']
+
+MODULES = [
+    'ultratils.acq',
+    'ultratils.exp',
+    'ultratils.utils',
+    'ultratils.psync',
+    'ultratils.taptest',
+    'ultratils.wavreader',
+    'ultratils.rawreader',
+    'ultratils.archive',
+    'ultratils.pysonix.bprreader',
+    'ultratils.pysonix.probe',
+]
+
+# Run in the child interpreter. Prints the import time and any heavy modules.
+child = '''
+import sys, time
+import numpy
+t = time.time()
+import {mod}
+dur = time.time() - t
+heavy = [m for m in {heavy!r} if m in sys.modules]
+print('{{:0.4f}} {{}}'.format(dur, ','.join(heavy)))
+'''
+
+if __name__ == '__main__':
+    budget = BUDGET
+    if len(sys.argv) > 1:
+        budget = float(sys.argv[1])
+    failed = []
+    for mod in MODULES:
+        out = subprocess.check_output(
+            [sys.executable, '-c', child.format(mod=mod, heavy=HEAVY)]
+        ).decode('utf-8').split()
+        dur = float(out[0])
+        heavy = out[1] if len(out) > 1 else ''
+        status = 'ok'
+        if dur > budget or heavy != '':
+            status = 'FAIL'
+            failed.append(mod)
+        print("{:<30s} {:0.4f} s {:s} {:s}".format(mod, dur, status, heavy))
+    if len(failed) > 0:
+        print("{:d} modules over import budget of {:0.2f} s.".format(len(failed), budget))
+        sys.exit(1)
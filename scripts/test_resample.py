@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+
+# Test resampling across dropped frames. Exits with status 1 on failure.
+
+import sys
+import numpy as np
+from ultratils.syncindex import SyncIndex
+from ultratils.resample import ResamplePlan
+
+def sync_index(npulses, period, dropped):
+    '''Return a SyncIndex of npulses pulses period apart, without frames
+for the pulses in dropped.'''
+    t1 = np.arange(npulses) * period
+    raw = np.cumsum([p not in dropped for p in range(npulses)]) - 1
+    raw[list(dropped)] = -1
+    return SyncIndex(t1, t1 + period / 2, np.arange(npulses), raw)
+
+def check(name, got, expected):
+    ok = np.array_equal(got, expected)
+    print("{:<40s} {:s}".format(name, 'ok' if ok else 'FAIL'))
+    if not ok:
+        print("    got {}, expected {}".format(got, expected))
+    return ok
+
+if __name__ == '__main__':
+    # Frames at 0.00 ... 0.09 s; the frame of pulse 4 was dropped.
+    sidx = sync_index(10, 0.01, [4])
+    frames = np.arange(9, dtype=np.float32).reshape(9, 1, 1)
+    times = [0.02, 0.03, 0.0325, 0.04, 0.0475, 0.05]
+    results = []
+    linear = ResamplePlan.from_sync_index(sidx, times, 'linear')
+    results.append(check(
+        'linear valid next to a dropped frame', linear.valid,
+        [True, True, False, False, False, True]
+    ))
+    out = linear.apply(lambda idx: frames[idx]).ravel()
+    results.append(check('linear on received frames', out[[0, 1, 5]], [2, 3, 4]))
+    nearest = ResamplePlan.from_sync_index(sidx, times, 'nearest')
+    results.append(check(
+        'nearest valid next to a dropped frame', nearest.valid,
+        [True, True, True, False, True, True]
+    ))
+    out = nearest.apply(lambda idx: frames[idx]).ravel()
+    results.append(check('nearest frames', out[nearest.valid], [2, 3, 3, 4, 4]))
+    fill = ResamplePlan.from_sync_index(sidx, times, 'fill')
+    results.append(check('fill valid across a dropped frame', fill.valid, [True] * 6))
+    if not all(results):
+        sys.exit(1)
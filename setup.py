@@ -23,11 +23,15 @@ setup(
   packages = ['ultratils', 'ultratils.pysonix'],
   package_data = {'ultratils.pysonix': ['data/probes.xml']},
   scripts = [
+    'scripts/bprarchive',
     'scripts/bpr2bmp',
+    'scripts/bprmonitor',
     'scripts/psync',
     'scripts/sepchan',
     'scripts/taptest',
+    'scripts/ultrabench',
     'scripts/ultraproc',
+    'scripts/ultraserve',
     'scripts/ultrasession.py',
     'scripts/wait_for_input'
   ],
@@ -9,19 +9,17 @@ from dateutil.tz import tzlocal
 from collections import OrderedDict
 from collections import namedtuple
 import numpy as np
-import pandas as pd
-import audiolabel
 from ultratils.pysonix.bprreader import BprReader
 import ultratils.pysonix.probe
-import ultratils.pysonix.scanconvert
+import ultratils.pysonix.converters
+import ultratils.framecache
+import ultratils.syncindex
+from ultratils.syncindex import SyncIndex, SYNC_INDEX_EXT
+from ultratils.wavreader import WavReader
 
-# These are needed for make_mp4()
-import matplotlib
-matplotlib.use("Agg")
-import matplotlib.pyplot as plt
-import matplotlib.animation as manimation
-import scipy.io.wavfile
-import subprocess
+# pandas, audiolabel, matplotlib, scipy and the compiled scanconvert module
+# are slow to import and are imported by the methods that use them, so that
+# command line tools that only need part of this module start quickly.
 
 # Regex that matches a timezone offset at the end of an acquisition directory
 # name.
@@ -112,6 +110,7 @@ class Acq():
     @property
     def runtime_vars(self):
         if self._runtime_vars is None:
+            import pandas as pd
             try:
                 df = pd.read_csv(self.abs_runtime_vars, sep='\s+', header=None)
                 (mypath, ts) = os.path.split(self.relpath)
@@ -143,6 +142,10 @@ class Acq():
     def abs_sync_tg(self):
         return os.path.join(self.abspath, "{:}.{:}.sync.TextGrid".format(self.timestamp, self.dtype))
 
+    @property
+    def abs_sync_index(self):
+        return os.path.join(self.abspath, "{:}.{:}{:}".format(self.timestamp, self.dtype, SYNC_INDEX_EXT))
+
     @property
     def abs_image_file(self):
         return os.path.join(self.abspath, "{:}.{:}".format(self.timestamp, self.dtype))
@@ -176,18 +179,30 @@ class Acq():
         """Return the frames/second."""
         rate = self._framerate
         if rate is None:
-            frames = self.sync_lm.tier('pulse_idx').search(r'\w')
-            t1 = frames[0].t1
-            t2 = frames[-1].t2
-            rate = len(frames) / (t2 - t1)
+            rate = self.sync_index.framerate
             self._framerate = rate
         return rate
 
+    @property
+    def sync_index(self):
+        """The SyncIndex of the synchronization pulses, loaded from the .sync.npz sidecar if it is not older than the .sync.TextGrid, or else built from the TextGrid."""
+        idx = self._sync_index
+        if idx is None:
+            if self._sync_lm is not None and \
+               not ultratils.syncindex.is_fresh(self.abs_sync_index, self.abs_sync_tg):
+                # The TextGrid has already been parsed.
+                idx = SyncIndex.from_textgrid(self._sync_lm)
+            else:
+                idx = SyncIndex.for_textgrid(self.abs_sync_tg, self.abs_sync_index)
+            self._sync_index = idx
+        return idx
+
     @property
     def sync_lm(self):
         """The LabelManager for .sync.textgrid."""
         lm = self._sync_lm
         if lm is None:
+            import audiolabel
             lm = audiolabel.LabelManager(
                 from_file=self.abs_sync_tg,
                 from_type='praat'
@@ -233,20 +248,24 @@ class Acq():
         c = self._image_converter
         if c is None:
             if self.dtype == 'bpr':
-                c = ultratils.pysonix.scanconvert.Converter(
+                c = ultratils.pysonix.converters.get_converter(
                     self.image_reader.header,
                     self.probe
                 )
                 self._image_converter = c
         return c
 
-    def __init__(self, timestamp=None, expdir=None, dtype='bpr', abspath=abspath, image_converter=None):
+    def __init__(self, timestamp=None, expdir=None, dtype='bpr', abspath=None, image_converter=None, prefetch=0):
         self.utcoffset = is_timestamp(timestamp)
         self.timestamp = timestamp
         self.expdir = os.path.normpath(expdir)
         self.dtype = dtype
         self._abspath = abspath
         self._runtime_vars = None
+        if self.abspath is None:
+            raise AcqError(
+                "No directory for acquisition '{:}' in {:}.".format(timestamp, expdir)
+            )
         self.relpath = self.abspath.replace(self.expdir, '')
         self.runvars = RuntimeVars()
         if self.runtime_vars is not None:
@@ -255,11 +274,16 @@ class Acq():
         self._image_reader = None
         self._framerate = None
         self._sync_lm = None
+        self._sync_index = None
+        # Number of frames on each side of a requested frame to read into
+        # the frame cache along with it.
+        self.prefetch = prefetch
         if image_converter is None:
             self._image_converter = None
         else:
-            if image_converter.input_h == self.image_reader.h and \
-               image_converter.input_w == self.image_reader.w:
+            if ultratils.pysonix.converters.matches(
+                image_converter, self.image_reader.header
+            ):
                 self._image_converter = image_converter
             else:
                 sys.stderr.write('INFO: ignoring non-matching image_converter for acquisition {:}.'.format(timestamp))
@@ -298,11 +322,10 @@ class Acq():
         except IOError:
             self.stimulus = None
         try:
-            tg = self.abs_sync_tg
-            lm = audiolabel.LabelManager(from_file=tg, from_type='praat')
-            durs = [l.duration for l in lm.tier('pulse_idx').search(r'^\d+$')]
+            sidx = self.sync_index
+            durs = sidx.durations
             self.n_pulse_idx = len(durs)
-            self.n_raw_data_idx = len([l for l in lm.tier('raw_data_idx').search(r'^\d+$')])
+            self.n_raw_data_idx = sidx.n_raw_data_idx
             self.pulse_max = np.max(durs)
             self.pulse_min = np.min(durs)
         except IOError as e:
@@ -312,17 +335,67 @@ class Acq():
             self.pulse_min = None
 
     def as_dict(self, fields):
-        """Return an ordered dict with the Acq attributes as key/value pairs."""
+        """Return an ordered dict with the Acq attributes as key/value pairs.
+Fields that are not Acq attributes are looked up in the runtime vars."""
         d = OrderedDict()
         for fld in fields:
-            d[fld] = getattr(self, fld)
+            try:
+                d[fld] = getattr(self, fld)
+            except AttributeError:
+                if not hasattr(self.runvars, fld):
+                    raise
+                d[fld] = getattr(self.runvars, fld)
         return d
 
-    def frame_at(self, t, convert=False, missing_val=None):
+    def _frame_key(self, fidx, convert):
+        """Return the frame cache key for frame fidx."""
+        geometry = None
+        if convert is True:
+            c = self.image_converter
+            geometry = ultratils.pysonix.converters.geometry_key(
+                c.header, c.probe, c.ppmm
+            )
+        return (self.abs_image_file, fidx, convert is True, geometry)
+
+    def _load_frame(self, fidx, convert):
+        """Read frame fidx from the image file as uint8 and optionally convert it."""
+        frame = self.image_reader.get_frame(fidx).astype(np.uint8)
+        if convert is True:
+            frame = self.image_converter.convert(frame)
+        return frame
+
+    def get_frame(self, fidx, convert=False, copy=True):
+        """Return image frame fidx. If convert is True, return the frame scan-converted by the acquisition's image_converter.
+
+Frames are kept as uint8 in the process-wide ultratils.framecache cache, and repeated requests for a frame do not read or convert it again. By default the frame is returned as a new, writable int array, like the frames of BprReader.get_frame(). If copy is False, the cached uint8 frame itself is returned; it is shared and read-only. If the prefetch attribute is greater than zero, that many frames on each side of fidx are read into the cache along with it."""
+        cache = ultratils.framecache.default_cache()
+        key = self._frame_key(fidx, convert)
+        frame = cache.get(key)
+        if frame is None:
+            frame = cache.put(key, self._load_frame(fidx, convert))
+            if self.prefetch > 0:
+                self.prefetch_frames(fidx - self.prefetch, fidx + self.prefetch + 1, convert)
+        if copy:
+            frame = frame.astype(int)
+        return frame
+
+    def prefetch_frames(self, start, stop, convert=False):
+        """Read frames start to stop - 1 into the frame cache, skipping frames that are already cached."""
+        cache = ultratils.framecache.default_cache()
+        start = max(start, 0)
+        stop = min(stop, self.image_reader.header.nframes)
+        for fidx in range(start, stop):
+            key = self._frame_key(fidx, convert)
+            if key not in cache:
+                cache.put(key, self._load_frame(fidx, convert))
+
+    def frame_at(self, t, convert=False, missing_val=None, copy=True):
         """Return image frame data at time t. If convert is True, use the acquisition's image_converter to do a scanconvert. If missing_val is True, return a replacement frame if the frame at time t is missing.
 
 By default frame_at() returns a 2D numpy array of image data or None if no image data is available at time t.
-If missing_val is not None, frame_at() returns a tuple """
+If missing_val is not None, frame_at() returns a tuple 
+
+Frames are read through get_frame(), and copy is passed to it."""
         frame = None
         repfr = None
         l = self.raw_data_idx.label_at(t)
@@ -344,8 +417,8 @@ If missing_val is not None, frame_at() returns a tuple """
                     else:
                         l = self.raw_data_idx.next(l)
                 elif missing_val is not None:
-                    repfr = self.image_reader.get_frame(0)
-                    repfr = (repfr * 0) + missing_val
+                    repfr = self.get_frame(0, copy=False)
+                    repfr = np.zeros(repfr.shape, dtype=int) + missing_val
                     l = None
                     break
                 else:
@@ -353,26 +426,57 @@ If missing_val is not None, frame_at() returns a tuple """
                     break
         if l is not None:
             if l == self.raw_data_idx.label_at(t):
-                frame = self.image_reader.get_frame(fidx)
+                frame = self.get_frame(fidx, convert=convert, copy=copy)
             else:
-                repfr = self.image_reader.get_frame(fidx)
-        if frame is not None and convert is True:
-            frame = self.image_converter.as_bmp(frame)
-        if repfr is not None and convert is True:
-            repfr = self.image_converter.as_bmp(repfr)
+                repfr = self.get_frame(fidx, convert=convert, copy=copy)
+        elif repfr is not None and convert is True:
+            repfr = self.image_converter.convert(repfr)
         if missing_val is None:
             return (frame, l)
         else:
             return (frame, l, repfr)
 
-    def make_mp4(self, t1=None, t2=None, outfile=None, metadata={}, fill=True, audio=True, corrected=True):
-        """Make an .mp4, starting at t1 and ending at t2. The metadata parameter is a dict suitable for use with the Matplotlib animation ffmpeg writer. If fille is True, insert blank for missing frames. If corrected is False use raw scanline data in rectangular format. If corrected is True interpolate the scanline data to correct for transducer geometry."""
+    def frames_at(self, times, convert=False, fill=0):
+        """Return (frames, raw_data_idx) for the frames at times, read in one batch. frames is a uint8 array of shape (len(times), h, w), scan-converted if convert is True, with frames of the fill value where no frame was received; raw_data_idx is -1 there. Unlike frame_at(), the frames are not cached."""
+        import ultratils.dataset
+        raw = np.asarray(self.sync_index.raw_data_idx_at(np.atleast_1d(times)), dtype=np.int64)
+        conv = self.image_converter if convert is True else None
+        with ultratils.dataset.ConcatFrameDataset([self.abs_image_file]) as ds:
+            frames = ultratils.dataset.read_frames(ds, raw, fill=fill, converter=conv)
+        return (frames, raw)
+
+    def motion_energy(self, regions=None, **kwargs):
+        """Return the ultratils.motion.MotionEnergy of the acquisition frames for regions, a dict of name: (top, bottom, left, right). Results are cached next to the image file. See ultratils.motion.motion_energy for the keyword arguments; use MotionEnergy.at_pulses(self.sync_index, ...) to align a series to the pulse times."""
+        import ultratils.motion
+        return ultratils.motion.motion_energy(self.abs_image_file, regions, **kwargs)
+
+    def mmode(self, scanlines, t1=None, t2=None, aligned=True, **kwargs):
+        """Return (times, image) of an M-mode display of scanlines between t1 and t2. If aligned is True, the image columns are the pulses of the sync index; otherwise they are the frames and t1 and t2 are ignored. See ultratils.mmode.mmode for the keyword arguments."""
+        import ultratils.mmode
+        sidx = self.sync_index if aligned else None
+        return ultratils.mmode.mmode(self.image_reader, scanlines, sidx, t1, t2, **kwargs)
+
+    def resample_frames(self, rate=100.0, **kwargs):
+        """Return (times, frames, valid) of the acquisition frames resampled onto a uniform grid of rate Hz. See ultratils.resample.resample_acq for the keyword arguments."""
+        import ultratils.resample
+        return ultratils.resample.resample_acq(self, rate=rate, **kwargs)
+
+    def make_mp4(self, t1=None, t2=None, outfile=None, metadata={}, fill=True, audio=True, corrected=True, enhance=None):
+        """Make an .mp4, starting at t1 and ending at t2. The metadata parameter is a dict suitable for use with the Matplotlib animation ffmpeg writer. If fille is True, insert blank for missing frames. If corrected is False use raw scanline data in rectangular format. If corrected is True interpolate the scanline data to correct for transducer geometry. If enhance is an ultratils.enhance.Chain or spec string, the frames are enhanced in batches before conversion."""
+        import subprocess
+        import tempfile
+        import shutil
+        import scipy.io.wavfile
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+        import matplotlib.animation as manimation
         labels = self.sync_lm.tier('raw_data_idx').tslice(t1=t1, t2=t2)
         blank_intensity = 0
         if self.dtype == 'bpr':
             if corrected is True:
                 blankbpr = self.image_converter.default_bpr_frame(blank_intensity)
-                blank = self.image_converter.as_bmp(blankbpr).astype(np.uint8)
+                blank = self.image_converter.convert(blankbpr).astype(np.uint8)
             else:
                 blank = self.image_reader.get_frame(0).astype(np.uint8) * 0
         else:
@@ -399,37 +503,55 @@ If missing_val is not None, frame_at() returns a tuple """
             fps=self.framerate,
             metadata=metadata
         )
-        with writer.saving(fig, 'tmp_vid.mp4', 100):
-            for l in labels:
-                try:
-                    rdidx = int(l.text)
-                    d = self.image_reader.get_frame(rdidx)
-                    if corrected is True:
-                        frame = np.flipud(self.image_converter.as_bmp(d).astype(np.uint8))
-                    else:
-                        frame = np.flipud(d)
-                except ValueError:   # l.text is 'NA'
+        # Private temporary files, so that clips can be rendered concurrently.
+        tmpdir = tempfile.mkdtemp(prefix='make_mp4')
+        tmp_vid = os.path.join(tmpdir, 'tmp_vid.mp4')
+        tmp_aud = os.path.join(tmpdir, 'tmp_aud.wav')
+        rdidxs = []
+        for l in labels:
+            try:
+                rdidxs.append(int(l.text))
+            except ValueError:   # l.text is 'NA'
+                rdidxs.append(None)
+        if enhance is not None:
+            import ultratils.enhance
+            chain = ultratils.enhance.as_chain(enhance).for_reader(self.image_reader)
+            frames = chain.frames_at(
+                self.image_reader, rdidxs,
+                converter=self.image_converter if corrected is True else None
+            )
+        else:
+            frames = (
+                self.get_frame(rdidx, convert=corrected, copy=False) if rdidx is not None else None
+                for rdidx in rdidxs
+            )
+        with writer.saving(fig, tmp_vid, 100):
+            for d in frames:
+                if d is None:
                     frame = blank
+                elif corrected is True:
+                    frame = np.flipud(d.astype(np.uint8))
+                else:
+                    frame = np.flipud(d)
                 p.set_data(frame)
                 plt.show()
                 writer.grab_frame()
 
         if audio is True:
-            arate, d = scipy.io.wavfile.read(self.abs_audio_file)
-            aidx0 = int(np.round(t1 * arate))
-            aidx1 = int(np.round(t2 * arate))
-            snip = d[aidx0:aidx1,0]
-            scipy.io.wavfile.write('tmp_aud.wav', arate, snip)
+            # Only the samples between t1 and t2 are read from the mapped file.
+            with WavReader(self.abs_audio_file) as w:
+                arate = w.rate
+                snip = np.ascontiguousarray(w.tslice(t1, t2, chan=0))
+            scipy.io.wavfile.write(tmp_aud, arate, snip)
             subprocess.check_call([
                 'ffmpeg', '-y',
-                '-i', 'tmp_vid.mp4',
-                '-i', 'tmp_aud.wav',
+                '-i', tmp_vid,
+                '-i', tmp_aud,
                 '-vcodec', 'copy', '-shortest', '-strict', '-2',
 # TODO: remove hardcoded scale values
                 '-vf', 'scale=692x350', '-c:v', 'libx264', '-pix_fmt', 'yuv420p',
                 outfile
             ])
-            os.remove('tmp_aud.wav')
-            os.remove('tmp_vid.mp4')
         else:
-            os.rename('tmp_vid.wav', outfile)
+            shutil.move(tmp_vid, outfile)
+        shutil.rmtree(tmpdir, ignore_errors=True)
@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+
+# Compressed, random-access archive format for ultrasound frame data.
+#
+# File layout:
+#
+#   magic (8 bytes)
+#   chunk 0 .. chunk N-1 (compressed)
+#   index (JSON, utf-8)
+#   index offset (8 bytes, little-endian uint64)
+#   magic (8 bytes)
+#
+# Each chunk holds up to chunk_frames consecutive frames. The first frame
+# of a chunk is stored as is and each following frame is stored as the
+# wrapping difference from the frame before it, so that duplicate and
+# near-identical frames compress to almost nothing. The delta-encoded chunk
+# is then compressed with a fast lossless codec.
+#
+# The index records the original file's header bytes, any trailing bytes
+# that do not form a complete frame, the frame geometry and dtype, the
+# offset, length and SHA1 of every chunk, the SHA1 of the original file and
+# the contents of its .idx.txt file, if there is one. The original file can
+# be restored byte for byte from the archive.
+
+import os, sys
+import io
+import json
+import zlib
+import base64
+import hashlib
+import struct
+import numpy as np
+from ultratils import profiling
+from ultratils.posio import PositionalFile
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MAGIC = b'UTARC001'
+FORMAT_VERSION = 1
+ARCHIVE_EXT = '.uarc'
+
+class ArchiveError(Exception):
+    """Base class for errors in this module."""
+    def __init__(self, msg):
+        self.msg = msg
+    def __str__(self):
+        return repr(self.msg)
+
+def is_archive(filename):
+    '''Return True if filename is a frame archive.'''
+    try:
+        with open(filename, 'rb') as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except IOError:
+        return False
+
+def _compress(data, codec, level):
+    if codec == 'zlib':
+        return zlib.compress(data, level)
+    elif codec == 'zstd':
+        if zstandard is None:
+            raise ArchiveError('The zstandard package is required for zstd.')
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    raise ArchiveError("Unknown codec '{:}'.".format(codec))
+
+def _decompress(data, codec):
+    if codec == 'zlib':
+        return zlib.decompress(data)
+    elif codec == 'zstd':
+        if zstandard is None:
+            raise ArchiveError('The zstandard package is required for zstd.')
+        return zstandard.ZstdDecompressor().decompress(data)
+    raise ArchiveError("Unknown codec '{:}'.".format(codec))
+
+def delta_encode(frames):
+    '''Delta-encode a (n, npoints) array of frames along the first axis,
+with wraparound, on an unsigned integer view of the data.'''
+    u = frames.view('u{:d}'.format(frames.dtype.itemsize))
+    d = np.empty_like(u)
+    d[0] = u[0]
+    np.subtract(u[1:], u[:-1], out=d[1:])
+    return d
+
+def delta_decode(deltas, dtype):
+    '''Invert delta_encode().'''
+    u = np.cumsum(deltas, axis=0, dtype=deltas.dtype)
+    return u.view(dtype)
+
+def write_archive(filename, outname, framesize, header_size=0, dtype=np.uint8, kind='raw', idxfile=None, chunk_frames=64, codec='zlib', level=1, meta=None):
+    '''Write the frames of an uncompressed ultrasound data file to an archive.
+
+filename = the input file
+outname = the output archive
+framesize = number of data values per frame
+header_size = number of header bytes before the first frame
+dtype = data type of the data values
+kind = 'bpr' or 'raw'
+idxfile = name of the .idx.txt file to store; if None, look for
+    filename + '.idx.txt'
+chunk_frames = number of frames per compressed chunk
+codec = 'zlib' or 'zstd'
+level = compression level
+meta = dict of additional values to store in the index
+
+Returns the index dict.
+'''
+    dtype = np.dtype(dtype)
+    framebytes = framesize * dtype.itemsize
+    if idxfile is None and os.path.isfile(filename + '.idx.txt'):
+        idxfile = filename + '.idx.txt'
+    idxtxt = None
+    if idxfile is not None:
+        with open(idxfile, 'rb') as f:
+            idxtxt = base64.b64encode(f.read()).decode('ascii')
+    fsha1 = hashlib.sha1()
+    chunks = []
+    nframes = 0
+    with open(filename, 'rb') as fin, open(outname, 'wb') as fout:
+        fout.write(MAGIC)
+        header = fin.read(header_size)
+        fsha1.update(header)
+        while True:
+            data = fin.read(framebytes * chunk_frames)
+            fsha1.update(data)
+            n = len(data) // framebytes
+            tail = data[n * framebytes:]
+            if n > 0:
+                frames = np.frombuffer(data[:n * framebytes], dtype=dtype)
+                frames = frames.reshape(n, framesize)
+                payload = _compress(delta_encode(frames).tobytes(), codec, level)
+                chunks.append({
+                    'offset': fout.tell(),
+                    'length': len(payload),
+                    'first': nframes,
+                    'nframes': n,
+                    'sha1': hashlib.sha1(data[:n * framebytes]).hexdigest()
+                })
+                fout.write(payload)
+                nframes += n
+            if n < chunk_frames:
+                break
+        index = {
+            'version': FORMAT_VERSION,
+            'kind': kind,
+            'source': os.path.basename(filename),
+            'header': base64.b64encode(header).decode('ascii'),
+            'tail': base64.b64encode(tail).decode('ascii'),
+            'dtype': dtype.str,
+            'framesize': framesize,
+            'nframes': nframes,
+            'chunk_frames': chunk_frames,
+            'codec': codec,
+            'chunks': chunks,
+            'sha1': fsha1.hexdigest(),
+            'idx_txt': idxtxt,
+            'meta': meta if meta is not None else {}
+        }
+        idxpos = fout.tell()
+        fout.write(json.dumps(index).encode('utf-8'))
+        fout.write(struct.pack('<Q', idxpos))
+        fout.write(MAGIC)
+    return index
+
+def archive_bpr(bpr, outname=None, **kwargs):
+    '''Write a .bpr file to an archive. Default outname is bpr + '.uarc'.'''
+    from ultratils.pysonix.bprreader import Header
+    if outname is None:
+        outname = bpr + ARCHIVE_EXT
+    with open(bpr, 'rb') as f:
+        hdr = Header(f)
+    return write_archive(
+        bpr, outname, framesize=hdr.h * hdr.w, header_size=hdr.packed_size,
+        dtype=np.uint8, kind='bpr', **kwargs
+    )
+
+def archive_raw(filename, nscanlines, npoints, dtype=np.uint8, data_offset=0, outname=None, **kwargs):
+    '''Write a uniform binary data file (see RawReader) to an archive.
+Default outname is filename + '.uarc'.'''
+    if outname is None:
+        outname = filename + ARCHIVE_EXT
+    meta = {'nscanlines': nscanlines, 'npoints': npoints}
+    return write_archive(
+        filename, outname, framesize=nscanlines * npoints,
+        header_size=data_offset, dtype=dtype, kind='raw', meta=meta, **kwargs
+    )
+
+class ArchiveReader(object):
+    '''Random-access reader for frame archives.
+
+    Frames are returned as 1D arrays of framesize values in the order they
+    were stored in the original file; reshaping is left to BprReader and
+    RawReader. The most recently decoded chunk is cached, so sequential
+    reads decompress each chunk once.
+    '''
+    def __init__(self, filename, verify=False):
+        self.filename = os.path.abspath(filename)
+        self.verify = verify
+        self._file = PositionalFile(self.filename)
+        f = self._file
+        if f.pread(len(MAGIC), 0) != MAGIC:
+            raise ArchiveError('{:} is not a frame archive.'.format(filename))
+        idxend = f.size() - (8 + len(MAGIC))
+        trailer = f.pread(8 + len(MAGIC), idxend)
+        if idxend < 0 or trailer[8:] != MAGIC:
+            raise ArchiveError('Truncated frame archive {:}.'.format(filename))
+        (idxpos,) = struct.unpack('<Q', trailer[:8])
+        self.index = json.loads(f.pread(idxend - idxpos, idxpos).decode('utf-8'))
+        if self.index['version'] > FORMAT_VERSION:
+            raise ArchiveError('Unsupported archive version {:}.'.format(self.index['version']))
+        self.kind = self.index['kind']
+        self.dtype = np.dtype(str(self.index['dtype']))
+        self.framesize = self.index['framesize']
+        self.nframes = self.index['nframes']
+        self.chunk_frames = self.index['chunk_frames']
+        self.codec = self.index['codec']
+        self.chunks = self.index['chunks']
+        self.header_bytes = base64.b64decode(self.index['header'])
+        self.meta = self.index['meta']
+        # (chunk index, decoded frames) of the most recently decoded chunk,
+        # replaced as a unit so that threads see a consistent pair.
+        self._cache = (None, None)
+
+    @property
+    def idx_txt(self):
+        '''The contents of the original .idx.txt file, or None.'''
+        if self.index['idx_txt'] is None:
+            return None
+        return base64.b64decode(self.index['idx_txt'])
+
+    def _chunk(self, cidx):
+        '''Return the decoded frames of chunk cidx as a read-only (n, framesize)
+array. The array is cached and shared by later reads of the chunk.'''
+        (key, frames) = self._cache
+        if key != cidx:
+            c = self.chunks[cidx]
+            with profiling.stage('archive_decode', frames=c['nframes'], nbytes=c['length']):
+                raw = _decompress(self._file.pread(c['length'], c['offset']), self.codec)
+                deltas = np.frombuffer(raw, dtype='u{:d}'.format(self.dtype.itemsize))
+                frames = delta_decode(deltas.reshape(c['nframes'], self.framesize), self.dtype)
+            if self.verify and hashlib.sha1(frames.tobytes()).hexdigest() != c['sha1']:
+                raise ArchiveError('Checksum mismatch in chunk {:d}.'.format(cidx))
+            frames.setflags(write=False)
+            self._cache = (cidx, frames)
+        return frames
+
+    def get_frame(self, idx):
+        '''Return frame idx as a read-only 1D view of the cached chunk.'''
+        if idx < 0:
+            idx += self.nframes
+        if idx < 0 or idx >= self.nframes:
+            raise IndexError('{:}'.format(idx))
+        (cidx, fidx) = divmod(idx, self.chunk_frames)
+        return self._chunk(cidx)[fidx]
+
+    def get_frames(self, start=0, stop=None):
+        '''Return frames start to stop (exclusive) as a (n, framesize) array.'''
+        if stop is None or stop > self.nframes:
+            stop = self.nframes
+        if start >= stop:
+            return np.zeros([0, self.framesize], dtype=self.dtype)
+        parts = []
+        for cidx in range(start // self.chunk_frames, (stop - 1) // self.chunk_frames + 1):
+            first = cidx * self.chunk_frames
+            frames = self._chunk(cidx)
+            parts.append(frames[max(start - first, 0):stop - first])
+        return np.concatenate(parts)
+
+    def restore(self, outname, idxfile=True):
+        '''Write the original file to outname, byte for byte, and verify its
+checksum. If idxfile is True also restore outname + '.idx.txt'.'''
+        fsha1 = hashlib.sha1()
+        with open(outname, 'wb') as fout:
+            fout.write(self.header_bytes)
+            fsha1.update(self.header_bytes)
+            for cidx in range(len(self.chunks)):
+                data = self._chunk(cidx).tobytes()
+                fout.write(data)
+                fsha1.update(data)
+            tail = base64.b64decode(self.index['tail'])
+            fout.write(tail)
+            fsha1.update(tail)
+        if fsha1.hexdigest() != self.index['sha1']:
+            raise ArchiveError('Checksum mismatch restoring {:}.'.format(outname))
+        if idxfile and self.idx_txt is not None:
+            with open(outname + '.idx.txt', 'wb') as f:
+                f.write(self.idx_txt)
+
+    # Define __enter__ and __exit__ to create context manager.
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def closed(self):
+        return self._file.closed
+
+    def close(self):
+        self._file.close()
+        self._cache = (None, None)
@@ -0,0 +1,297 @@
+# Reproducible benchmarks of ultratils processing on synthetic data.
+#
+# Benchmarks are registered with the @benchmark decorator. Each benchmark
+# is a function that takes a Fixture, which holds the synthetic experiment,
+# and returns the number of items (usually frames) it processed. The
+# runner times each benchmark repeat times and reports the best time.
+# Results are saved as JSON so that runs can be compared between commits.
+
+import os, sys
+import json
+import shutil
+import tempfile
+import platform
+import subprocess
+import timeit
+from collections import OrderedDict
+from datetime import datetime
+import numpy as np
+
+import ultratils.synth
+
+# Synthetic experiment sizes.
+SIZES = {
+    'small': {'nacq': 4, 'npulses': 200, 'h': 256, 'w': 128},
+    'medium': {'nacq': 16, 'npulses': 600, 'h': 512, 'w': 128},
+    'large': {'nacq': 64, 'npulses': 2000, 'h': 512, 'w': 128},
+}
+
+# Registered benchmarks, in the order they are run.
+BENCHMARKS = OrderedDict()
+
+def benchmark(func):
+    '''Register a benchmark function.'''
+    BENCHMARKS[func.__name__] = func
+    return func
+
+class Fixture(object):
+    '''A synthetic experiment that the benchmarks run against.'''
+    def __init__(self, workdir, size='small', drop_rate=0.02):
+        self.workdir = workdir
+        self.size = size
+        self.params = dict(SIZES[size])
+        self.expdir = os.path.join(workdir, 'exp')
+        nacq = self.params.pop('nacq')
+        self.bprs = ultratils.synth.make_experiment(
+            self.expdir, nacq=nacq, drop_rate=drop_rate, **self.params
+        )
+        self.bpr = self.bprs[0]
+        self.wav = self.bpr + '.wav'
+        # A .raw file with the same frames as the first .bpr.
+        self.raw = os.path.join(workdir, 'frames.raw')
+        self.h = self.params['h']
+        self.w = self.params['w']
+        with open(self.bpr, 'rb') as f:
+            f.seek(19 * 4)
+            frames = np.frombuffer(f.read(), dtype=np.uint8)
+        frames = frames.reshape(-1, self.w, self.h).transpose(0, 2, 1)
+        ultratils.synth.write_raw(self.raw, frames)
+        self.nframes = frames.shape[0]
+        self.outdir = os.path.join(workdir, 'out')
+        os.makedirs(self.outdir)
+
+    def header(self):
+        from ultratils.pysonix.bprreader import BprReader
+        return BprReader(self.bpr).header
+
+    def probe(self):
+        import ultratils.pysonix.probe
+        return ultratils.pysonix.probe.Probe(ultratils.synth.DEFAULT_PROBE)
+
+@benchmark
+def bprreader_get_frame(fx):
+    from ultratils.pysonix.bprreader import BprReader
+    rdr = BprReader(fx.bpr)
+    for idx in range(rdr.nframes):
+        rdr.get_frame(idx)
+    return rdr.nframes
+
+@benchmark
+def bprreader_get_roi(fx):
+    from ultratils.pysonix.bprreader import BprReader
+    rdr = BprReader(fx.bpr)
+    # A tongue-root sized region: a quarter of the samples of a third of
+    # the scanlines.
+    roi = (fx.h // 2, fx.h // 2 + fx.h // 4, fx.w // 3, 2 * fx.w // 3)
+    rdr.get_roi(roi)
+    return rdr.nframes
+
+@benchmark
+def rawreader_get_frame(fx):
+    from ultratils.rawreader import RawReader
+    rdr = RawReader(fx.raw, fx.w, fx.h)
+    for idx in range(rdr.nframes):
+        rdr.get_frame(idx)
+    rdr.close()
+    return rdr.nframes
+
+@benchmark
+def rawreader_data(fx):
+    from ultratils.rawreader import RawReader
+    rdr = RawReader(fx.raw, fx.w, fx.h)
+    rdr.data
+    rdr.close()
+    return rdr.nframes
+
+@benchmark
+def converter_build(fx):
+    import ultratils.pysonix.scanconvert
+    ultratils.pysonix.scanconvert.Converter(fx.header(), fx.probe())
+    return 1
+
+@benchmark
+def converter_convert(fx):
+    import ultratils.pysonix.scanconvert
+    from ultratils.pysonix.bprreader import BprReader
+    rdr = BprReader(fx.bpr)
+    frames = [rdr.get_frame(idx) for idx in range(rdr.nframes)]
+    conv = ultratils.pysonix.scanconvert.Converter(rdr.header, fx.probe())
+    start = timeit.default_timer()
+    for frame in frames:
+        conv.convert(frame)
+    # Report only the conversion time, not the reads and the build.
+    return (len(frames), timeit.default_timer() - start)
+
+@benchmark
+def converter_convert_stack(fx):
+    import ultratils.pysonix.scanconvert
+    from ultratils.pysonix.bprreader import BprReader
+    rdr = BprReader(fx.bpr)
+    frames = np.stack([rdr.get_frame(idx) for idx in range(rdr.nframes)])
+    conv = ultratils.pysonix.scanconvert.Converter(rdr.header, fx.probe())
+    start = timeit.default_timer()
+    conv.convert_stack(frames)
+    return (len(frames), timeit.default_timer() - start)
+
+@benchmark
+def psync_detect(fx):
+    import ultratils.psync
+    (sig, rate) = ultratils.psync.loadsync(fx.wav, 1)
+    return len(ultratils.psync.sync_impulse(sig))
+
+@benchmark
+def psync_sync2text(fx):
+    import ultratils.psync
+    outbase = os.path.join(fx.outdir, 'psync')
+    ultratils.psync.sync2text(
+        fx.wav, 1, 'impulse', outbase, received_indexes=fx.bpr + '.idx.txt'
+    )
+    return 1
+
+@benchmark
+def bpr2bmp(fx):
+    from ultratils.pysonix.bmpwriter import convert_to_bmp
+    bmpdir = os.path.join(fx.outdir, 'bmp')
+    if os.path.isdir(bmpdir):
+        shutil.rmtree(bmpdir)
+    os.makedirs(bmpdir)
+    bpr = os.path.join(bmpdir, os.path.basename(fx.bpr))
+    shutil.copy(fx.bpr, bpr)
+    shutil.copy(fx.bpr + '.idx.txt', bpr + '.idx.txt')
+    return convert_to_bmp(bpr, fx.probe())
+
+@benchmark
+def exp_gather(fx):
+    from ultratils.exp import Exp
+    e = Exp(fx.expdir)
+    e.gather()
+    return len(e.acquisitions)
+
+@benchmark
+def extract_frames(fx):
+    import ultratils.utils
+    frames = []
+    for bpr in fx.bprs:
+        ts = os.path.basename(bpr).replace('.bpr', '')
+        frames.extend([(ts, idx) for idx in range(0, 50, 5)])
+    ultratils.utils.extract_frames(fx.expdir, frames=frames)
+    return len(frames)
+
+@benchmark
+def dataset_epoch(fx):
+    from ultratils.dataset import ConcatFrameDataset
+    with ConcatFrameDataset(fx.bprs) as ds:
+        for (indices, frames) in ds.iter_batches(batch_size=256, seed=0):
+            pass
+        return len(ds)
+
+@benchmark
+def enhance_chain(fx):
+    import ultratils.enhance
+    from ultratils.pysonix.bprreader import BprReader
+    rdr = BprReader(fx.bpr)
+    chain = ultratils.enhance.parse('median:3,log:20,normalize').for_reader(rdr)
+    n = 0
+    for (idx, frame) in chain.iter_frames(rdr):
+        n += 1
+    return n
+
+def git_commit(path):
+    '''Return the git commit of the repository containing path, or None.'''
+    try:
+        out = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=path, stderr=subprocess.STDOUT
+        )
+        return out.decode('ascii').strip()
+    except Exception:
+        return None
+
+def run(names=None, size='small', repeat=3, workdir=None, verbose=False):
+    '''Run the named benchmarks (default all) on a synthetic experiment of
+the given size and return a results dict.
+
+Each benchmark is run repeat times and the best wall time is reported,
+with the throughput in items per second. A benchmark that raises an
+exception, e.g. because an optional dependency is missing, is reported
+with its error message instead.'''
+    if names is None:
+        names = list(BENCHMARKS.keys())
+    cleanup = workdir is None
+    if workdir is None:
+        workdir = tempfile.mkdtemp(prefix='ultrabench')
+    results = OrderedDict([
+        ('date', datetime.now().replace(microsecond=0).isoformat()),
+        ('commit', git_commit(os.path.dirname(os.path.abspath(__file__)))),
+        ('python', platform.python_version()),
+        ('numpy', np.__version__),
+        ('platform', platform.platform()),
+        ('size', size),
+        ('params', SIZES[size]),
+        ('repeat', repeat),
+        ('benchmarks', OrderedDict()),
+    ])
+    try:
+        fx = Fixture(workdir, size)
+        for name in names:
+            func = BENCHMARKS[name]
+            times = []
+            rec = OrderedDict()
+            try:
+                for r in range(repeat):
+                    start = timeit.default_timer()
+                    n = func(fx)
+                    elapsed = timeit.default_timer() - start
+                    if isinstance(n, tuple):
+                        (n, elapsed) = n
+                    times.append(elapsed)
+                best = min(times)
+                rec['items'] = n
+                rec['best'] = best
+                rec['mean'] = sum(times) / len(times)
+                rec['rate'] = n / best if best > 0 else None
+            except Exception as e:
+                msg = str(e).strip().split('\n')[0]
+                rec['error'] = '{:}: {:}'.format(type(e).__name__, msg)
+            results['benchmarks'][name] = rec
+            if verbose:
+                sys.stderr.write(format_result(name, rec) + '\n')
+    finally:
+        if cleanup:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+def format_result(name, rec):
+    '''Format one benchmark result as a line of text.'''
+    if 'error' in rec:
+        return '{:<22s} error: {:s}'.format(name, rec['error'])
+    return '{:<22s} {:10.4f} s {:12.1f} items/s'.format(
+        name, rec['best'], rec['rate'] or 0
+    )
+
+def save(results, filename):
+    '''Save a results dict as JSON.'''
+    with open(filename, 'w') as f:
+        json.dump(results, f, indent=2)
+
+def load(filename):
+    '''Load a results dict saved by save().'''
+    with open(filename, 'r') as f:
+        return json.load(f, object_pairs_hook=OrderedDict)
+
+def compare(old, new, threshold=0.1):
+    '''Compare two results dicts. Return a list of (name, old best, new best,
+ratio, flag) tuples, where ratio is new/old and flag is 'slower' or
+'faster' when the ratio differs from 1 by more than threshold.'''
+    rows = []
+    for name, rec in new['benchmarks'].items():
+        orec = old['benchmarks'].get(name)
+        if orec is None or 'best' not in orec or 'best' not in rec:
+            continue
+        ratio = rec['best'] / orec['best'] if orec['best'] > 0 else float('inf')
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = 'slower'
+        elif ratio < 1 - threshold:
+            flag = 'faster'
+        rows.append((name, orec['best'], rec['best'], ratio, flag))
+    return rows
@@ -0,0 +1,317 @@
+# Frames of many acquisitions as one indexable dataset.
+#
+# A ConcatFrameDataset numbers the frames of a list of .bpr files, usually
+# every acquisition of an experiment, from 0 to len(dataset) - 1. A global
+# frame index is mapped to a file and a local frame index by binary search
+# in the cumulative frame offsets of the files. Plain .bpr files are read
+# through memory maps, of which at most maxopen are kept open, least
+# recently used first out. Batched reads are grouped by file and sorted by
+# local index, so that each file is read in a single fancy-indexing pass.
+# Frame archives are read frame by frame through BprReader.
+#
+# Frames are returned as uint8 arrays of shape (h, w), in the orientation of
+# BprReader.get_frame(), and batches as arrays of shape (n, h, w). A .bpr
+# file stores each frame scanline by scanline, as (w, h), and reorienting
+# the frames costs more than reading them from the page cache; pass
+# transpose=False to get frames of shape (w, h) as stored.
+
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+
+from ultratils import profiling
+
+# Default number of memory maps kept open.
+MAXOPEN = 32
+
+class DatasetError(Exception):
+    """Base class for errors in this module."""
+    def __init__(self, msg):
+        self.msg = msg
+    def __str__(self):
+        return repr(self.msg)
+
+def _bpr_files(sources):
+    '''Return a list of image filenames for sources, which may be an Exp, a
+sequence of Acq objects or a sequence of filenames.'''
+    if hasattr(sources, 'acquisitions'):
+        if len(sources.acquisitions) == 0:
+            sources.gather()
+        sources = sources.acquisitions
+    files = []
+    for src in sources:
+        if hasattr(src, 'abs_image_file'):
+            src = src.abs_image_file
+        files.append(os.path.abspath(src))
+    return files
+
+class _Source(object):
+    '''One .bpr file of a dataset.'''
+    def __init__(self, filename):
+        from ultratils.pysonix.bprreader import BprReader
+        self.filename = filename
+        self.reader = BprReader(filename)
+        hdr = self.reader.header
+        (self.h, self.w) = (hdr.h, hdr.w)
+        self.framesize = hdr.h * hdr.w
+        self.offset = hdr.packed_size
+        self.is_archive = self.reader._archive is not None
+        if self.is_archive:
+            self.nframes = self.reader.nframes
+        else:
+            # A file cut short by an interrupted acquisition has fewer frames
+            # than its header says.
+            nbytes = os.path.getsize(filename) - self.offset
+            self.nframes = min(hdr.nframes, max(0, nbytes // self.framesize))
+
+    def memmap(self):
+        '''Return a memory map of the frames, of shape (nframes, w, h).'''
+        return np.memmap(
+            self.filename, dtype=np.uint8, mode='r', offset=self.offset,
+            shape=(self.nframes, self.w, self.h)
+        )
+
+class ConcatFrameDataset(object):
+    '''The frames of a list of .bpr files as one dataset.
+
+sources = an Exp, a sequence of Acq objects or a sequence of .bpr filenames
+maxopen = maximum number of memory maps kept open
+transpose = if True, frames have shape (h, w) as in BprReader.get_frame();
+    if False, they have shape (w, h) as stored in the file
+
+All files must have the same frame dimensions.
+'''
+    def __init__(self, sources, maxopen=MAXOPEN, transpose=True):
+        self.filenames = _bpr_files(sources)
+        self._sources = [_Source(f) for f in self.filenames]
+        shapes = set((s.h, s.w) for s in self._sources)
+        if len(shapes) > 1:
+            raise DatasetError(
+                'Frame dimensions differ between files: {:}'.format(sorted(shapes))
+            )
+        (h, w) = shapes.pop() if len(shapes) == 1 else (0, 0)
+        self.transpose = transpose
+        self.frame_shape = (h, w) if transpose else (w, h)
+        counts = np.array([s.nframes for s in self._sources], dtype=np.int64)
+        # offsets[i] is the global index of the first frame of file i, and
+        # offsets[-1] is the number of frames.
+        self.offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        self.maxopen = max(1, int(maxopen))
+        self._maps = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    @property
+    def nfiles(self):
+        return len(self._sources)
+
+    def locate(self, idx):
+        '''Return (file index, local frame index) for the global frame index
+idx. idx may be a scalar or an array, and negative indexes count from the
+end.'''
+        idx = np.asarray(idx, dtype=np.int64)
+        n = len(self)
+        idx = np.where(idx < 0, idx + n, idx)
+        if np.any((idx < 0) | (idx >= n)):
+            raise IndexError('frame index out of range for {:d} frames'.format(n))
+        fidx = np.searchsorted(self.offsets, idx, side='right') - 1
+        return (fidx, idx - self.offsets[fidx])
+
+    def _memmap(self, fidx):
+        with self._lock:
+            try:
+                mm = self._maps.pop(fidx)
+            except KeyError:
+                mm = self._sources[fidx].memmap()
+            self._maps[fidx] = mm
+            # A map dropped here stays valid for readers still holding it,
+            # and is closed when the last reference goes.
+            while len(self._maps) > self.maxopen:
+                self._maps.popitem(last=False)
+        return mm
+
+    def _read(self, fidx, local, cols, rows):
+        '''Return the frames local of file fidx, in order, with shape
+(n, w, h), cropped to the slices cols (scanlines) and rows (samples).
+local must be sorted.'''
+        src = self._sources[fidx]
+        if src.is_archive:
+            return np.stack([
+                src.reader.get_frame(int(lidx)).T.astype(np.uint8)[cols, rows]
+                for lidx in local
+            ])
+        # Only the selected part of each scanline is copied.
+        return self._memmap(fidx)[local, cols, rows]
+
+    def roi_shape(self, roi=None):
+        '''Return the frame shape of get_batch() results for roi.'''
+        (h, w) = self.frame_shape if self.transpose else self.frame_shape[::-1]
+        (top, bottom, left, right) = roi if roi is not None else (None,) * 4
+        nrows = len(range(*slice(top, bottom).indices(h)))
+        ncols = len(range(*slice(left, right).indices(w)))
+        return (nrows, ncols) if self.transpose else (ncols, nrows)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return self.get_batch(np.arange(*idx.indices(len(self))))
+        if np.ndim(idx) > 0:
+            return self.get_batch(idx)
+        return self.get_batch([idx])[0]
+
+    def get_batch(self, indices, out=None, roi=None):
+        '''Return the frames at the global indices as an array of shape
+(n,) + frame_shape. The reads are grouped by file and done in file order.
+
+out = optional uint8 array of shape (n,) + frame_shape to read into
+roi = optional (top, bottom, left, right) rows and columns of the frames of
+    BprReader.get_frame() to read; None means the frame edge. The result
+    then has shape (n,) + roi_shape(roi).
+'''
+        indices = np.asarray(indices, dtype=np.int64).ravel()
+        (top, bottom, left, right) = roi if roi is not None else (None,) * 4
+        (cols, rows) = (slice(left, right), slice(top, bottom))
+        shape = (len(indices),) + self.roi_shape(roi)
+        if out is None:
+            out = np.empty(shape, dtype=np.uint8)
+        elif out.shape != shape:
+            raise DatasetError('out has shape {:}, expected {:}'.format(
+                out.shape, shape
+            ))
+        if len(indices) == 0:
+            return out
+        (fidx, local) = self.locate(indices)
+        order = np.lexsort((local, fidx))
+        (fidx, local) = (fidx[order], local[order])
+        bounds = np.flatnonzero(np.diff(fidx)) + 1
+        starts = np.concatenate([[0], bounds])
+        stops = np.concatenate([bounds, [len(order)]])
+        with profiling.stage('dataset', frames=len(indices), nbytes=out.nbytes):
+            for (start, stop) in zip(starts, stops):
+                frames = self._read(int(fidx[start]), local[start:stop], cols, rows)
+                if self.transpose:
+                    frames = frames.transpose(0, 2, 1)
+                out[order[start:stop]] = frames
+        return out
+
+    def file_header(self, fidx):
+        '''Return the bpr header of file fidx.'''
+        return self._sources[fidx].reader.header
+
+    def source(self, idx):
+        '''Return (filename, local frame index) of the global frame index idx.'''
+        (fidx, local) = self.locate(idx)
+        return (self.filenames[int(fidx)], int(local))
+
+    def iter_batches(self, batch_size=64, shuffle=True, seed=None, prefetch=2, drop_last=False):
+        '''Yield batches of frames covering the dataset once, as (indices,
+frames) tuples, where indices are the global indices of the frames.
+
+batch_size = number of frames per batch
+shuffle = if True, visit the frames in random order
+seed = seed or numpy Generator for the shuffle
+prefetch = number of batches read ahead by a background thread; 0 reads
+    in the calling thread
+drop_last = if True, skip a final batch smaller than batch_size
+'''
+        n = len(self)
+        if shuffle:
+            order = np.random.default_rng(seed).permutation(n)
+        else:
+            order = np.arange(n, dtype=np.int64)
+        nbatches = n // batch_size if drop_last else -(-n // batch_size)
+        batches = (
+            order[b * batch_size:(b + 1) * batch_size] for b in range(nbatches)
+        )
+        if prefetch <= 0:
+            for indices in batches:
+                yield (indices, self.get_batch(indices))
+            return
+        for item in _prefetched(
+            ((indices, self.get_batch(indices)) for indices in batches), prefetch
+        ):
+            yield item
+
+    def close(self):
+        '''Drop the open memory maps and close the readers.'''
+        with self._lock:
+            self._maps.clear()
+        for src in self._sources:
+            src.reader.close()
+
+    # Define __enter__ and __exit__ to create context manager.
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def read_frames(ds, indices, fill=0, converter=None, out=None):
+    '''Return the frames of ds at indices as a uint8 array, with frames of
+the fill value where an index is negative (a dropped frame).
+
+converter = optional Converter; if given, the frames are scan-converted
+    with convert_stack() and ds must have transpose=True
+out = optional uint8 array of the result shape to write into
+'''
+    indices = np.asarray(indices, dtype=np.int64).ravel()
+    found = indices >= 0
+    frames = out if converter is None else None
+    if frames is None:
+        frames = np.empty((len(indices),) + ds.frame_shape, dtype=np.uint8)
+    if np.all(found):
+        ds.get_batch(indices, out=frames)
+    else:
+        frames[~found] = fill
+        frames[found] = ds.get_batch(indices[found])
+    if converter is None:
+        return frames
+    return converter.convert_stack(frames, out=out)
+
+def _prefetched(items, depth):
+    '''Yield the items of the iterator items, which are produced by a
+background thread up to depth items ahead of the consumer.'''
+    try:
+        import queue
+    except ImportError:   # py2
+        import Queue as queue
+    q = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def put(item, err=None):
+        # Give up when the consumer has stopped, so the thread can exit.
+        while not stop.is_set():
+            try:
+                q.put((item, err), timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put(item):
+                    return
+        except Exception as e:
+            put(done, e)
+            return
+        put(done)
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            (item, err) = q.get()
+            if item is done:
+                if err is not None:
+                    raise err
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
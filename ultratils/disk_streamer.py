@@ -5,50 +5,212 @@
 import pyaudio
 import os
 import re
+import time
 import wave
+import threading
+try:
+    import queue              # Python 3
+except ImportError:
+    import Queue as queue     # Python 2
+import numpy as np
+
+# soundfile (libsndfile) is only needed for compressed output.
+try:
+    import soundfile
+except ImportError:
+    soundfile = None
+
+# FLAC subtypes for the integer sample widths that can be compressed
+# losslessly. FLAC holds at most 24 bits per sample, and pyaudio opens width 4
+# streams as paFloat32, so 4-byte samples cannot be compressed.
+SF_SUBTYPES = {2: 'PCM_16', 3: 'PCM_24'}
+
+class DiskStreamerError(Exception):
+    """Base class for errors in this module."""
+    def __init__(self, msg):
+        self.msg = msg
+    def __str__(self):
+        return repr(self.msg)
+
+class _BlockWriter(threading.Thread):
+    '''Writer thread that drains raw audio buffers from a queue and writes
+them to disk in large blocks.
+
+Buffers are coalesced until at least blocksize bytes are pending or
+flush_interval seconds have passed since the last write. Channels are then
+split with a single strided numpy view and written with one call per output
+file. Every flush_interval seconds the output headers are finalized so that
+a crash leaves a readable file.
+'''
+    def __init__(self, outfiles, channels, width, compress, blocksize, flush_interval):
+        super(_BlockWriter, self).__init__()
+        self.daemon = True
+        self.outfiles = outfiles
+        self.channels = channels
+        self.width = width
+        self.compress = compress
+        self.blocksize = blocksize
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue()
+        self.bytes_written = 0
+        self.error = None
+
+    def run(self):
+        pending = []
+        npending = 0
+        last_flush = time.time()
+        done = False
+        while not done:
+            try:
+                buf = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                buf = b''
+            if buf is None:     # Sentinel from close().
+                done = True
+            elif len(buf) > 0:
+                pending.append(buf)
+                npending += len(buf)
+            now = time.time()
+            stale = (now - last_flush) >= self.flush_interval
+            if npending > 0 and (done or stale or npending >= self.blocksize):
+                try:
+                    self._write(b''.join(pending))
+                except Exception as e:
+                    self.error = e
+                pending = []
+                npending = 0
+            if done or stale:
+                self._finalize_headers()
+                last_flush = now
+
+    def _write(self, block):
+        '''Write one coalesced block of interleaved frames.'''
+        if self.compress:
+            if self.width == 2:
+                data = np.frombuffer(block, dtype='<i2')
+            else:
+                # Unpack little-endian 24-bit samples into the high bytes of
+                # int32, which soundfile writes to PCM_24 without loss.
+                packed = np.frombuffer(block, dtype=np.uint8).reshape(-1, 3)
+                data = np.zeros((len(packed), 4), dtype=np.uint8)
+                data[:, 1:] = packed
+                data = data.view('<i4')
+            data = data.reshape(-1, self.channels)
+            if len(self.outfiles) == 1:
+                self.outfiles[0].write(data)
+            else:
+                for c, f in enumerate(self.outfiles):
+                    f.write(data[:, c])
+        else:
+            if len(self.outfiles) == 1:
+                self.outfiles[0].writeframes(block)
+            else:
+                data = np.frombuffer(block, dtype=np.uint8)
+                data = data.reshape(-1, self.channels, self.width)
+                for c, f in enumerate(self.outfiles):
+                    f.writeframes(data[:, c, :].tobytes())
+        self.bytes_written += len(block)
+
+    def _finalize_headers(self):
+        '''Bring the file headers up to date with the data written so far.'''
+        for f in self.outfiles:
+            try:
+                if self.compress:
+                    f.flush()
+                else:
+                    # The wave module patches the RIFF header sizes on each
+                    # writeframes() call; flush the file object so the patched
+                    # header reaches the disk.
+                    f._file.flush()
+            except Exception as e:
+                self.error = e
 
 class DiskStreamer(object):
-    '''A class for streaming microphone audio to disk.'''
-    def __init__(self, wavname, width=2, fmt=pyaudio.paInt16, channels=2, rate=44100, separate=True):
-# TODO: is it necessary to have both width and fmt?
+    '''A class for streaming microphone audio to disk.
+
+The audio callback only hands the raw input buffers to a writer thread.
+Channel separation, encoding and disk writes are all done off the audio
+thread, in blocks of at least blocksize bytes, and file headers are
+finalized every flush_interval seconds.
+
+If compress is True, audio is written as lossless FLAC (requires the
+soundfile package) to files with a .flac extension instead of .wav. Only
+16-bit (width 2) and 24-bit (width 3) integer samples can be compressed.
+
+width is the sample width in bytes. fmt is the pyaudio sample format of
+the input stream; by default it is the integer format of width (or
+paFloat32 for width 4, as pyaudio chooses). fmt is needed only to choose
+between formats of the same width, such as paInt32 and paFloat32, and it
+must have width bytes per sample.
+'''
+    def __init__(self, wavname, width=2, fmt=None, channels=2, rate=44100, separate=True, compress=False, blocksize=1048576, flush_interval=2.0):
+        if fmt is None:
+            fmt = pyaudio.get_format_from_width(width)
+        if pyaudio.get_sample_size(fmt) != width:
+            raise DiskStreamerError(
+                'Sample format {} does not have a width of {:d} bytes.'.format(fmt, width)
+            )
+        if compress:
+            if soundfile is None:
+                raise DiskStreamerError(
+                    'The soundfile package is required for compressed output.'
+                )
+            if width not in SF_SUBTYPES or fmt == pyaudio.paFloat32:
+                raise DiskStreamerError(
+                    'Compressed output requires 2 or 3 byte integer samples.'
+                )
         p = pyaudio.PyAudio()
 
         basename = os.path.splitext(wavname)[0]
+        ext = 'flac' if compress else 'wav'
         if separate:     # Save channels to separate files.
-            wav = [None] * channels
-            for c in range(0,channels):
-                wf = wave.open('{}.ch{:d}.wav'.format(basename, c), 'wb')
-                wf.setnchannels(1)
-                wf.setsampwidth(p.get_sample_size(fmt))
-                wf.setframerate(rate)
-                wav[c] = wf
+            names = ['{}.ch{:d}.{}'.format(basename, c, ext) for c in range(0,channels)]
+            fchannels = 1
         else:
-            wf = wave.open('{}.wav'.format(basename), 'wb')
-            wf.setnchannels(channels)
-            wf.setsampwidth(p.get_sample_size(fmt))
-            wf.setframerate(rate)
-            wav = [wf]
+            names = ['{}.{}'.format(basename, ext)]
+            fchannels = channels
+        wav = []
+        for name in names:
+            if compress:
+                wf = soundfile.SoundFile(
+                    name, 'w', samplerate=rate, channels=fchannels,
+                    format='FLAC', subtype=SF_SUBTYPES[width]
+                )
+            else:
+                wf = wave.open(name, 'wb')
+                wf.setnchannels(fchannels)
+                wf.setsampwidth(width)
+                wf.setframerate(rate)
+            wav.append(wf)
 
         self.channels = channels
         self.p = p
         self.wav = wav
         self.separate = separate   # Save channels to separate files.
+        self.compress = compress
+        self._writer = _BlockWriter(
+            wav, channels, width, compress, blocksize,
+            flush_interval
+        )
+        self._writer.start()
 
         def callback(in_data, frame_count, time_info, status):
-            for idx in range(len(self.wav)):
-                self.wav[idx].writeframes(
-                    b''.join(in_data[idx:len(in_data):self.channels])
-                )
+            self._writer.queue.put(in_data)
             return (in_data, pyaudio.paContinue)
 
         # The input stream (microphone).
-        stream = p.open(format=p.get_format_from_width(width),
+        stream = p.open(format=fmt,
                         channels=channels,
                         rate=rate,
                         input=True,
                         stream_callback=callback)
         self.stream = stream
 
+    @property
+    def bytes_written(self):
+        '''Number of uncompressed audio bytes handed to the output files.'''
+        return self._writer.bytes_written
+
     def start_stream(self):
         self.stream.start_stream()
 
@@ -60,8 +222,13 @@ class DiskStreamer(object):
 
     def close(self):
         self.stream.close()
+        # Drain the writer queue before closing the output files.
+        self._writer.queue.put(None)
+        self._writer.join()
         for w in self.wav:
             w.close()
         self.p.terminate()
-
-
+        if self._writer.error is not None:
+            raise DiskStreamerError(
+                'Error writing audio: {}'.format(self._writer.error)
+            )
@@ -0,0 +1,314 @@
+# Image enhancement stages for stacks of ultrasound frames.
+#
+# A Chain is a sequence of enhancement stages that is applied to unconverted
+# uint8 frames before scan conversion and export. Each stage processes a
+# whole (n, h, w) stack at a time instead of one frame at a time:
+#
+#   lookup stages map each of the 256 intensities through a table; gamma
+#     and log compression have fixed tables, and equalize and normalize
+#     make theirs from the intensity histogram of the acquisition
+#   filter stages smooth each frame of the stack in one scipy.ndimage call
+#     with a window that does not extend across frames
+#
+# Adjacent lookup stages are fused into a single table, so a chain of
+# intensity mappings costs one table lookup per pixel. Stages that need
+# statistics are resolved by bind(), usually through for_reader(), which
+# computes the histogram of the acquisition in one chunked pass.
+#
+# Chains can be written as a spec string of comma-separated stages with
+# colon-separated arguments, for example 'median:3,log:20,normalize'. See
+# STAGES for the names.
+
+import numpy as np
+
+from ultratils import profiling
+
+class EnhanceError(Exception):
+    """Base class for errors in this module."""
+    def __init__(self, msg):
+        self.msg = msg
+    def __str__(self):
+        return repr(self.msg)
+
+class Lookup(object):
+    '''Map intensities through a 256-entry uint8 table.'''
+    inplace = True
+
+    def __init__(self, table, name='lookup'):
+        table = np.asarray(table)
+        if table.shape != (256,):
+            raise EnhanceError('A lookup table must have 256 entries.')
+        self.table = np.clip(np.rint(table), 0, 255).astype(np.uint8)
+        self.name = name
+
+    def apply(self, frames, out):
+        # mode='clip' avoids the buffered copy of mode='raise'; uint8
+        # indexes are always in range.
+        return np.take(self.table, frames, out=out, mode='clip')
+
+    def then(self, other):
+        '''Return the Lookup of this table followed by other.'''
+        return Lookup(other.table[self.table], '{:}+{:}'.format(self.name, other.name))
+
+def _levels():
+    return np.arange(256, dtype=np.float64) / 255
+
+def gamma(g=0.5):
+    '''Return the Lookup of gamma compression, 255 * (x / 255) ** g.'''
+    return Lookup(255 * _levels() ** float(g), 'gamma')
+
+def log_compression(c=10.0):
+    '''Return the Lookup of log compression,
+255 * log(1 + c * x / 255) / log(1 + c).'''
+    c = float(c)
+    if c <= 0:
+        raise EnhanceError('Log compression factor must be positive.')
+    return Lookup(255 * np.log1p(c * _levels()) / np.log1p(c), 'log')
+
+class Equalize(object):
+    '''Histogram equalization with the histogram of the acquisition.'''
+    needs_stats = True
+
+    def bind(self, hist):
+        cdf = np.cumsum(hist).astype(np.float64)
+        nz = np.flatnonzero(hist)
+        if len(nz) == 0 or cdf[-1] == cdf[nz[0]]:
+            return Lookup(np.arange(256), 'equalize')
+        low = cdf[nz[0]]
+        return Lookup(255 * np.clip(cdf - low, 0, None) / (cdf[-1] - low), 'equalize')
+
+class Normalize(object):
+    '''Linear contrast normalization of the intensities of the acquisition
+to mean and std.'''
+    needs_stats = True
+
+    def __init__(self, mean=128.0, std=48.0):
+        self.mean = float(mean)
+        self.std = float(std)
+
+    def bind(self, hist):
+        (m, s) = hist_stats(hist)
+        if s == 0:
+            return Lookup(np.full(256, self.mean), 'normalize')
+        return Lookup((np.arange(256) - m) * (self.std / s) + self.mean, 'normalize')
+
+def _med3(a, b, c, out=None):
+    return np.maximum(np.minimum(a, b), np.minimum(np.maximum(a, b), c), out=out)
+
+class Median(object):
+    '''Median filter of each frame with a size x size window. Frame edges
+are extended with the nearest value.'''
+    inplace = False
+
+    def __init__(self, size=3):
+        self.size = int(size)
+
+    def apply(self, frames, out):
+        if self.size != 3:
+            import scipy.ndimage
+            return scipy.ndimage.median_filter(
+                frames, size=(1, self.size, self.size), output=out, mode='nearest'
+            )
+        # The exact 3 x 3 median, computed separably: each vertical triple
+        # is sorted once, and the median of a window is the median of the
+        # largest of its three minimums, the median of its three medians
+        # and the smallest of its three maximums.
+        p = np.pad(frames, ((0, 0), (1, 1), (1, 1)), mode='edge')
+        (a, b, c) = (p[:, :-2], p[:, 1:-1], p[:, 2:])
+        lo = np.minimum(np.minimum(a, b), c)
+        hi = np.maximum(np.maximum(a, b), c)
+        mid = _med3(a, b, c)
+        lo = np.maximum(np.maximum(lo[..., :-2], lo[..., 1:-1]), lo[..., 2:])
+        hi = np.minimum(np.minimum(hi[..., :-2], hi[..., 1:-1]), hi[..., 2:])
+        mid = _med3(mid[..., :-2], mid[..., 1:-1], mid[..., 2:])
+        return _med3(lo, mid, hi, out=out)
+
+class Gaussian(object):
+    '''Gaussian smoothing of each frame. sigma is in samples along the
+scanlines and sigma_w (default sigma) in scanlines. The filter is separable
+and is applied one axis at a time.'''
+    inplace = False
+
+    def __init__(self, sigma=1.0, sigma_w=None):
+        self.sigma = float(sigma)
+        self.sigma_w = self.sigma if sigma_w is None else float(sigma_w)
+
+    def apply(self, frames, out):
+        import scipy.ndimage
+        return scipy.ndimage.gaussian_filter(
+            frames, sigma=(0, self.sigma, self.sigma_w), output=out, mode='nearest'
+        )
+
+# Stage names of spec strings.
+STAGES = {
+    'gamma': gamma,
+    'log': log_compression,
+    'equalize': Equalize,
+    'normalize': Normalize,
+    'median': Median,
+    'gaussian': Gaussian,
+}
+
+def hist_stats(hist):
+    '''Return the (mean, std) of the intensities of a 256-bin histogram.'''
+    hist = np.asarray(hist, dtype=np.float64)
+    n = hist.sum()
+    if n == 0:
+        return (0.0, 0.0)
+    levels = np.arange(256)
+    m = np.dot(hist, levels) / n
+    return (m, np.sqrt(max(np.dot(hist, (levels - m) ** 2) / n, 0.0)))
+
+def histogram(reader, step=1, chunk_frames=256):
+    '''Return the 256-bin intensity histogram of every step-th frame of an
+image reader, read chunk_frames at a time.'''
+    hist = np.zeros(256, dtype=np.int64)
+    with profiling.stage('enhance_stats', frames=reader.nframes):
+        for start in range(0, reader.nframes, chunk_frames):
+            frames = reader.get_roi(None, start, start + chunk_frames)
+            frames = frames[(-start) % step::step]
+            hist += np.bincount(frames.ravel(), minlength=256)
+    return hist
+
+class Chain(object):
+    '''A sequence of enhancement stages.
+
+stages = stage objects, e.g. from STAGES, in the order they are applied
+'''
+    def __init__(self, stages=()):
+        self.stages = list(stages)
+
+    def __len__(self):
+        return len(self.stages)
+
+    @property
+    def needs_stats(self):
+        '''True if a stage needs the statistics of the acquisition.'''
+        return any(getattr(s, 'needs_stats', False) for s in self.stages)
+
+    def bind(self, hist=None):
+        '''Return the chain with the stages that need statistics resolved
+with the 256-bin histogram hist of the unenhanced frames, and adjacent
+lookups fused. The histogram is passed through the lookups that precede a
+stage; filters are assumed not to change it.'''
+        stages = []
+        for s in self.stages:
+            if getattr(s, 'needs_stats', False):
+                if hist is None:
+                    raise EnhanceError('The chain needs the histogram of the acquisition.')
+                s = s.bind(hist)
+            if isinstance(s, Lookup) and hist is not None:
+                hist = np.bincount(s.table, weights=hist, minlength=256)
+            if isinstance(s, Lookup) and len(stages) > 0 and isinstance(stages[-1], Lookup):
+                s = stages.pop().then(s)
+            stages.append(s)
+        return Chain(stages)
+
+    def for_reader(self, reader, step=1):
+        '''Return the chain bound to the frames of an image reader. The
+histogram is computed only if a stage needs it.'''
+        if self.needs_stats:
+            return self.bind(histogram(reader, step))
+        return self.bind()
+
+    def apply(self, frames, out=None, chunk_frames=64):
+        '''Apply the stages to a uint8 (n, h, w) stack or (h, w) frame and
+return the result.
+
+out = output array of the same shape; default is frames itself if it is a
+    writeable uint8 array, so that the stack is enhanced in place
+chunk_frames = number of frames processed at a time
+'''
+        if self.needs_stats:
+            raise EnhanceError('Call bind() or for_reader() before apply().')
+        frames = np.asarray(frames)
+        if frames.dtype != np.uint8:
+            frames = np.clip(frames, 0, 255).astype(np.uint8)
+        if out is None:
+            out = frames if frames.flags.writeable else np.empty_like(frames)
+        if frames.ndim == 2:
+            self.apply(frames[np.newaxis], out[np.newaxis], chunk_frames)
+            return out
+        scratch = None
+        with profiling.stage('enhance', frames=len(frames), nbytes=frames.nbytes):
+            for start in range(0, len(frames), chunk_frames):
+                src = frames[start:start + chunk_frames]
+                dst = out[start:start + chunk_frames]
+                cur = src
+                for s in self.stages:
+                    if s.inplace or not np.may_share_memory(cur, dst):
+                        target = dst
+                    else:
+                        # Filters cannot write over their input.
+                        if scratch is None:
+                            scratch = np.empty((chunk_frames,) + frames.shape[1:], dtype=np.uint8)
+                        target = scratch[:len(src)]
+                    s.apply(cur, target)
+                    cur = target
+                if not np.may_share_memory(cur, dst):
+                    dst[...] = cur
+        return out
+
+    def iter_frames(self, reader, start=0, stop=None, chunk_frames=64):
+        '''Yield (idx, frame) for frames start to stop - 1 of an image
+reader, enhanced chunk_frames at a time. The chain must be bound.'''
+        (start, stop, step) = slice(start, stop).indices(reader.nframes)
+        for first in range(start, stop, chunk_frames):
+            frames = self.apply(reader.get_roi(None, first, min(first + chunk_frames, stop)))
+            for (n, frame) in enumerate(frames):
+                yield (first + n, frame)
+
+    def frames_at(self, reader, indexes, converter=None, chunk_frames=64):
+        '''Yield the frames of an image reader at indexes, in order,
+enhanced and, if converter is given, scan-converted chunk_frames at a
+time. None is yielded for indexes that are None or negative. The chain
+must be bound.'''
+        indexes = list(indexes)
+        for first in range(0, len(indexes), chunk_frames):
+            part = indexes[first:first + chunk_frames]
+            valid = [i for i in part if i is not None and i >= 0]
+            if len(valid) == 0:
+                for i in part:
+                    yield None
+                continue
+            # Indexes of a clip are nearly consecutive, so the range that
+            # covers them is read in one call.
+            (lo, hi) = (min(valid), max(valid) + 1)
+            block = reader.get_roi(None, lo, hi)
+            frames = self.apply(block[np.asarray(valid) - lo])
+            if converter is not None:
+                frames = converter.convert_stack(frames)
+            n = 0
+            for i in part:
+                if i is None or i < 0:
+                    yield None
+                else:
+                    yield frames[n]
+                    n += 1
+
+def parse(spec):
+    '''Return the Chain of a spec string such as 'median:3,gamma:0.7'.'''
+    stages = []
+    for item in spec.split(','):
+        item = item.strip()
+        if item == '':
+            continue
+        parts = item.split(':')
+        name = parts[0].strip().lower()
+        if name not in STAGES:
+            raise EnhanceError("Unknown enhancement stage '{:}'.".format(name))
+        try:
+            args = [float(a) for a in parts[1:]]
+            stages.append(STAGES[name](*args))
+        except (TypeError, ValueError) as e:
+            raise EnhanceError("Bad arguments for stage '{:}': {:}".format(name, e))
+    return Chain(stages)
+
+def as_chain(enhance):
+    '''Return enhance as a Chain. enhance may be a Chain, a spec string or
+a sequence of stages.'''
+    if enhance is None or isinstance(enhance, Chain):
+        return enhance
+    if isinstance(enhance, str):
+        return parse(enhance)
+    return Chain(enhance)
@@ -5,7 +5,6 @@ import re
 from datetime import datetime
 from dateutil.tz import tzlocal
 import numpy as np
-import pandas as pd
 from ultratils.acq import Acq
 
 # Regex that matches a timezone offset at the end of an acquisition directory
@@ -58,7 +57,6 @@ class Exp():
         self.relpath = self.abspath.replace(self.expdir, '')
         self.acquisitions = []
         self.timestamps = []
-        self._image_converter = None
 
     def gather(self):
         """Gather the acquisitions in the experiment."""
@@ -74,19 +72,29 @@ class Exp():
                     Acq(
                         timestamp=ts,
                         expdir=self.abspath,
-                        abspath=os.path.abspath(mydir),
-                        image_converter=self._image_converter
+                        abspath=os.path.abspath(mydir)
                     )
                 )
-# TODO: there should be error checking of image size here and/or in Acq()
-                if self._image_converter is None:
-                    a = self.acquisitions[0]
-                    self._image_converter = a.image_converter
+                # Acquisitions with the same geometry share a Converter
+                # through ultratils.pysonix.converters.
                 self.timestamps.append(ts)
                 re_sort = True
         if re_sort is True:
+            import pandas as pd
             self.acquisitions.sort(key=lambda a: pd.to_datetime(a.timestamp))
 
+    def render_clips(self, rows, **kwargs):
+        """Render video clips for rows of (timestamp, t1, t2, outfile). See ultratils.render.render_clips for the keyword arguments."""
+        import ultratils.render
+        return ultratils.render.render_clips(self.abspath, rows, **kwargs)
+
+    def frame_dataset(self, **kwargs):
+        """Return a ConcatFrameDataset of the frames of all acquisitions. See ultratils.dataset.ConcatFrameDataset for the keyword arguments."""
+        import ultratils.dataset
+        if len(self.acquisitions) == 0:
+            self.gather()
+        return ultratils.dataset.ConcatFrameDataset(self.acquisitions, **kwargs)
+
     def get_acq(self, timestamp):
         """Get an acquisition based on its timestamp."""
         acq = None
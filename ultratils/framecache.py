@@ -0,0 +1,121 @@
+# Process-wide cache of image frames.
+#
+# Frames are cached under a key that identifies the acquisition, the frame
+# index, whether the frame is scan-converted and the conversion geometry.
+# The least recently used frames are evicted when the cached frames exceed
+# a memory budget. Cached frames are shared by all callers and are made
+# read-only; copy a frame before modifying it. ultratils.acq.Acq caches uint8
+# frames and returns copies unless it is asked not to.
+#
+# The default budget is 256 MB. Set the ULTRATILS_FRAME_CACHE_MB environment
+# variable or call set_budget() to change it. A budget of 0 disables caching.
+
+import os
+import threading
+from collections import OrderedDict
+
+DEFAULT_MAXBYTES = int(
+    float(os.environ.get('ULTRATILS_FRAME_CACHE_MB', 256)) * 1024 * 1024
+)
+
+class FrameCache(object):
+    '''A thread-safe LRU cache of ndarray frames with a memory budget.'''
+    def __init__(self, maxbytes=DEFAULT_MAXBYTES):
+        self.maxbytes = int(maxbytes)
+        self._frames = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._frames)
+
+    def __contains__(self, key):
+        return key in self._frames
+
+    @property
+    def nbytes(self):
+        '''Total size of the cached frames.'''
+        return self._nbytes
+
+    def get(self, key):
+        '''Return the frame cached under key, or None.'''
+        with self._lock:
+            try:
+                frame = self._frames.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            self._frames[key] = frame
+            self.hits += 1
+            return frame
+
+    def put(self, key, frame):
+        '''Cache frame under key and return it. The frame is made read-only.
+A frame larger than the budget is returned without being cached.'''
+        frame.setflags(write=False)
+        if frame.nbytes > self.maxbytes:
+            return frame
+        with self._lock:
+            old = self._frames.pop(key, None)
+            if old is not None:
+                self._nbytes -= old.nbytes
+            self._frames[key] = frame
+            self._nbytes += frame.nbytes
+            self._evict()
+        return frame
+
+    def get_or_load(self, key, loader):
+        '''Return the frame cached under key. On a miss, call loader() to
+read the frame and cache the result.'''
+        frame = self.get(key)
+        if frame is None:
+            frame = self.put(key, loader())
+        return frame
+
+    def _evict(self):
+        while self._nbytes > self.maxbytes and len(self._frames) > 0:
+            (key, frame) = self._frames.popitem(last=False)
+            self._nbytes -= frame.nbytes
+            self.evictions += 1
+
+    def set_maxbytes(self, maxbytes):
+        '''Change the memory budget, evicting frames as needed.'''
+        with self._lock:
+            self.maxbytes = int(maxbytes)
+            self._evict()
+
+    def clear(self):
+        '''Remove all frames and reset the statistics.'''
+        with self._lock:
+            self._frames.clear()
+            self._nbytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def info(self):
+        '''Return a dict of cache statistics.'''
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / float(lookups) if lookups > 0 else None,
+                'frames': len(self._frames),
+                'nbytes': self._nbytes,
+                'maxbytes': self.maxbytes,
+            }
+
+_default = FrameCache()
+
+def default_cache():
+    '''Return the process-wide FrameCache.'''
+    return _default
+
+def set_budget(maxbytes):
+    '''Set the memory budget of the process-wide FrameCache, in bytes.'''
+    _default.set_maxbytes(maxbytes)
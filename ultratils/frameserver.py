@@ -0,0 +1,570 @@
+# Local frame server for the acquisitions of an experiment.
+#
+# Analysis processes and notebooks on one machine often open the same
+# acquisitions, each building its own readers, Converters and sync indexes
+# and decoding the same frames. A FrameServer keeps these open for the
+# acquisitions of an experiment and serves batches of frames to local
+# clients:
+#
+#   control = newline-delimited JSON requests and replies over a Unix
+#     socket, one connection per client
+#   data = each batch is read, and scan-converted if requested, directly
+#     into a new shared memory segment, whose name is sent in the reply; the
+#     client maps the segment and wraps it in an ndarray without copying
+#
+# A segment belongs to the connection that requested it until the client
+# releases it or the connection closes. FrameClient releases a segment when
+# the last reference to the frames of its batch goes; the release is sent
+# with the next request. The total size of unreleased segments is limited by
+# the memory budget of the server, and a request that would exceed it fails
+# instead of waiting.
+#
+# At most max_acqs acquisitions are kept open, least recently used first
+# out. Shared memory needs Python 3.8 or later.
+
+import os, sys
+import json
+import errno
+import socket
+import hashlib
+import tempfile
+import threading
+import weakref
+from collections import OrderedDict, namedtuple
+import numpy as np
+
+try:
+    from multiprocessing import shared_memory   # Python >= 3.8
+except ImportError:
+    shared_memory = None
+
+from ultratils import profiling
+
+# Default memory budget of unreleased segments, and number of open
+# acquisitions.
+DEFAULT_BUDGET = 1024 * 1024 * 1024
+MAX_ACQS = 16
+
+# Names of the segments created by servers in this process.
+_created = set()
+
+class FrameServerError(Exception):
+    """Base class for errors in this module."""
+    def __init__(self, msg):
+        self.msg = msg
+    def __str__(self):
+        return repr(self.msg)
+
+# A pulse of the sync index, with the attributes of the label returned by
+# Acq.frame_at(): text is the raw data frame index, or 'NA'.
+Pulse = namedtuple('Pulse', ['t1', 't2', 'text'])
+
+def default_socket(expdir):
+    '''Return the default socket path of the server for expdir.'''
+    key = hashlib.sha1(os.path.abspath(expdir).encode('utf-8')).hexdigest()[:12]
+    return os.path.join(tempfile.gettempdir(), 'ultratils-frames-{:}.sock'.format(key))
+
+def _send(sock, msg):
+    sock.sendall((json.dumps(msg) + '\n').encode('utf-8'))
+
+def resolve_times(sidx, times, missing=None):
+    '''Return (pulse, raw_data_idx, substituted) arrays for the frames at
+times in the SyncIndex sidx. pulse is the position of the pulse that
+contains each time, or -1, and raw_data_idx is -1 where no frame was
+received. If missing is 'prev' or 'next', the frame of the nearest earlier
+or later pulse with a frame is used instead, and substituted is True.'''
+    pos = np.atleast_1d(sidx.pulse_at(times)).astype(np.int64)
+    raw = np.where(pos >= 0, sidx.raw_data_idx[np.clip(pos, 0, None)], -1).astype(np.int64)
+    substituted = np.zeros(len(pos), dtype=bool)
+    if missing not in (None, 'prev', 'next'):
+        raise FrameServerError("missing must be 'prev', 'next' or None, not {:}".format(missing))
+    need = np.flatnonzero((pos >= 0) & (raw < 0))
+    if missing is not None and len(need) > 0:
+        received = np.flatnonzero(sidx.raw_data_idx >= 0)
+        if missing == 'prev':
+            k = np.searchsorted(received, pos[need], side='left') - 1
+            ok = k >= 0
+        else:
+            k = np.searchsorted(received, pos[need], side='right')
+            ok = k < len(received)
+        need = need[ok]
+        pos[need] = received[k[ok]]
+        raw[need] = sidx.raw_data_idx[pos[need]]
+        substituted[need] = True
+    return (pos, raw, substituted)
+
+class _Open(object):
+    '''The open sync index, dataset and Converter of an acquisition.'''
+    def __init__(self, acq):
+        from ultratils.dataset import ConcatFrameDataset
+        self.acq = acq
+        self.sidx = acq.sync_index
+        self.ds = ConcatFrameDataset([acq.abs_image_file])
+        # Pulse position of each raw data frame index.
+        self.pulse_of = np.full(len(self.ds), -1, dtype=np.int64)
+        received = np.flatnonzero(
+            (self.sidx.raw_data_idx >= 0) & (self.sidx.raw_data_idx < len(self.ds))
+        )
+        self.pulse_of[self.sidx.raw_data_idx[received]] = received
+
+    @property
+    def converter(self):
+        return self.acq.image_converter
+
+class FrameServer(object):
+    '''Serves the frames of the acquisitions of an experiment to local
+clients through shared memory.
+
+expdir = the experiment directory
+socket_path = path of the Unix socket; default is default_socket(expdir)
+budget = maximum total bytes of unreleased shared memory segments
+max_acqs = maximum number of acquisitions kept open
+verbose = if True, write a line per request to stderr
+'''
+    def __init__(self, expdir, socket_path=None, budget=DEFAULT_BUDGET, max_acqs=MAX_ACQS, verbose=False):
+        if shared_memory is None:
+            raise FrameServerError('The frame server requires Python 3.8 or later.')
+        from ultratils.exp import Exp
+        self.expdir = os.path.abspath(expdir)
+        exp = Exp(self.expdir)
+        exp.gather()
+        self._acqs = OrderedDict((a.timestamp, a) for a in exp.acquisitions)
+        self.socket_path = socket_path if socket_path is not None else default_socket(expdir)
+        self.budget = int(budget)
+        self.max_acqs = max(1, int(max_acqs))
+        self.verbose = verbose
+        self._open = OrderedDict()
+        # Unreleased segments, name: (SharedMemory, nbytes, owner).
+        self._segments = {}
+        self._used = 0
+        self._lock = threading.Lock()
+        self._server = None
+        self.frames_served = 0
+
+    def _get_open(self, timestamp):
+        with self._lock:
+            try:
+                entry = self._open.pop(timestamp)
+            except KeyError:
+                try:
+                    acq = self._acqs[timestamp]
+                except KeyError:
+                    raise FrameServerError('No acquisition {:}.'.format(timestamp))
+                entry = _Open(acq)
+            self._open[timestamp] = entry
+            # Dropped entries are not closed, so that a request still using
+            # one can finish; their maps are closed with the last reference.
+            while len(self._open) > self.max_acqs:
+                self._open.popitem(last=False)
+        return entry
+
+    def _allocate(self, nbytes, owner):
+        with self._lock:
+            if self._used + nbytes > self.budget:
+                raise FrameServerError(
+                    'Memory budget exceeded: {:d} bytes requested, {:d} of {:d} in use.'.format(
+                        nbytes, self._used, self.budget
+                    )
+                )
+            shm = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+            self._segments[shm.name] = (shm, nbytes, owner)
+            self._used += nbytes
+            _created.add(shm.name)
+        return shm
+
+    def _release(self, name, owner=None):
+        with self._lock:
+            try:
+                (shm, nbytes, segowner) = self._segments[name]
+            except KeyError:
+                return
+            if owner is not None and segowner != owner:
+                return
+            del self._segments[name]
+            self._used -= nbytes
+            _created.discard(name)
+        try:
+            shm.close()
+        except BufferError:   # an array of a failed request is still alive
+            pass
+        shm.unlink()
+
+    def release_all(self, owner=None):
+        '''Release the segments of owner, or all segments.'''
+        with self._lock:
+            names = [
+                name for (name, (shm, nbytes, segowner)) in self._segments.items()
+                if owner is None or segowner == owner
+            ]
+        for name in names:
+            self._release(name, owner)
+
+    def info(self):
+        '''Return a dict of the state of the server.'''
+        with self._lock:
+            return {
+                'expdir': self.expdir, 'timestamps': list(self._acqs.keys()),
+                'open': list(self._open.keys()), 'budget': self.budget,
+                'used': self._used, 'segments': len(self._segments),
+                'frames_served': self.frames_served,
+            }
+
+    def _acq_info(self, timestamp, convert=False):
+        entry = self._get_open(timestamp)
+        reply = {
+            'timestamp': timestamp, 'nframes': len(entry.ds),
+            'frame_shape': list(entry.ds.frame_shape),
+            'npulses': len(entry.sidx), 'framerate': entry.acq.framerate,
+        }
+        if convert:
+            reply['converted_shape'] = list(entry.converter.bmp.shape)
+        return reply
+
+    def _frames(self, msg, owner):
+        entry = self._get_open(msg['timestamp'])
+        if msg.get('times') is not None:
+            (pulse, raw, substituted) = resolve_times(
+                entry.sidx, np.asarray(msg['times'], dtype=np.float64), msg.get('missing')
+            )
+        else:
+            raw = np.asarray(msg.get('indexes', []), dtype=np.int64).ravel()
+            if np.any(raw >= len(entry.ds)):
+                raise FrameServerError('Frame index out of range for {:d} frames.'.format(len(entry.ds)))
+            pulse = np.where(raw >= 0, entry.pulse_of[np.clip(raw, 0, None)], -1)
+            substituted = np.zeros(len(raw), dtype=bool)
+        conv = entry.converter if msg.get('convert') else None
+        shape = (len(raw),) + (conv.bmp.shape if conv is not None else entry.ds.frame_shape)
+        nbytes = int(np.prod(shape))
+        shm = self._allocate(nbytes, owner)
+        try:
+            with profiling.stage('frameserver', frames=len(raw), nbytes=nbytes):
+                out = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+                from ultratils.dataset import read_frames
+                read_frames(entry.ds, raw, fill=msg.get('fill', 0), converter=conv, out=out)
+                del out
+        except Exception:
+            self._release(shm.name, owner)
+            raise
+        with self._lock:
+            self.frames_served += len(raw)
+        t1 = entry.sidx.t1[np.clip(pulse, 0, None)] if len(entry.sidx) > 0 else np.zeros(len(pulse))
+        t2 = entry.sidx.t2[np.clip(pulse, 0, None)] if len(entry.sidx) > 0 else np.zeros(len(pulse))
+        return {
+            'shm': shm.name, 'shape': list(shape), 'dtype': 'uint8',
+            'raw_data_idx': raw.tolist(), 'pulse': pulse.tolist(),
+            't1': [float(t) if p >= 0 else None for (t, p) in zip(t1, pulse)],
+            't2': [float(t) if p >= 0 else None for (t, p) in zip(t2, pulse)],
+            'substituted': substituted.tolist(),
+        }
+
+    def handle(self, msg, owner):
+        '''Return the reply to the request msg of the connection owner.'''
+        for name in msg.get('release', []):
+            self._release(name, owner)
+        op = msg.get('op')
+        if op == 'frames':
+            return self._frames(msg, owner)
+        elif op == 'acq':
+            return self._acq_info(msg['timestamp'], msg.get('convert', False))
+        elif op == 'info':
+            return self.info()
+        elif op == 'release':
+            return {}
+        elif op == 'shutdown':
+            threading.Thread(target=self._server.shutdown).start()
+            return {}
+        raise FrameServerError("Unknown request '{:}'.".format(op))
+
+    def _remove_stale_socket(self):
+        '''Remove a socket file left by a server that is not running.'''
+        if not os.path.exists(self.socket_path):
+            return
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.socket_path)
+        except socket.error as e:
+            if e.errno in (errno.ECONNREFUSED, errno.ENOENT):
+                os.remove(self.socket_path)
+                return
+            raise
+        finally:
+            sock.close()
+        raise FrameServerError('A frame server is already running at {:}.'.format(self.socket_path))
+
+    def serve_forever(self):
+        '''Serve requests until shutdown() is called or a client sends a
+shutdown request.'''
+        import socketserver
+        frameserver = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                owner = id(self)
+                try:
+                    while True:
+                        line = self.rfile.readline()
+                        if not line:
+                            break
+                        msg = None
+                        try:
+                            msg = json.loads(line.decode('utf-8'))
+                            reply = frameserver.handle(msg, owner)
+                            reply['ok'] = True
+                        except FrameServerError as e:
+                            reply = {'ok': False, 'error': e.msg}
+                        except Exception as e:
+                            reply = {'ok': False, 'error': '{:}: {:}'.format(type(e).__name__, e)}
+                        if frameserver.verbose:
+                            sys.stderr.write('{:} {:} {:}\n'.format(
+                                msg.get('op') if isinstance(msg, dict) else None,
+                                msg.get('timestamp', '') if isinstance(msg, dict) else '',
+                                'ok' if reply['ok'] else reply['error']
+                            ))
+                        self.wfile.write((json.dumps(reply) + '\n').encode('utf-8'))
+                        self.wfile.flush()
+                except (IOError, OSError):   # client went away
+                    pass
+                finally:
+                    frameserver.release_all(owner)
+
+        class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+            daemon_threads = True
+
+        self._remove_stale_socket()
+        self._server = Server(self.socket_path, Handler)
+        os.chmod(self.socket_path, 0o600)
+        try:
+            self._server.serve_forever()
+        finally:
+            self.close()
+
+    def shutdown(self):
+        '''Stop serve_forever() from another thread.'''
+        if self._server is not None:
+            self._server.shutdown()
+
+    def close(self):
+        '''Close the socket and release all segments.'''
+        if self._server is not None:
+            self._server.server_close()
+            self._server = None
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+        self.release_all()
+
+def _attach(name):
+    '''Map the shared memory segment name, which the server owns.'''
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)   # Python >= 3.13
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=name)
+        if name in _created:   # the server runs in this process
+            return shm
+        # Keep the resource tracker of this process from unlinking the
+        # segment when the process exits; the server unlinks it.
+        try:
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        except Exception:
+            pass
+        return shm
+
+class FrameBatch(object):
+    '''A batch of frames served in shared memory.
+
+frames = uint8 array of shape (n, h, w), a view of the shared memory segment
+raw_data_idx = raw data frame index of each frame, -1 where no frame was
+    received
+pulse = position of the pulse of each frame in the sync index, or -1
+t1, t2 = start and end times of the pulses, nan where pulse is -1
+substituted = True where the frame of another pulse was used for a dropped
+    frame
+
+The segment is released when the last reference to frames, or to an array
+derived from it, goes.
+'''
+    def __init__(self, reply, frames):
+        self.frames = frames
+        self.raw_data_idx = np.asarray(reply['raw_data_idx'], dtype=np.int64)
+        self.pulse = np.asarray(reply['pulse'], dtype=np.int64)
+        self.t1 = np.array([np.nan if t is None else t for t in reply['t1']])
+        self.t2 = np.array([np.nan if t is None else t for t in reply['t2']])
+        self.substituted = np.asarray(reply['substituted'], dtype=bool)
+
+    def __len__(self):
+        return len(self.raw_data_idx)
+
+    def label(self, i):
+        '''Return the Pulse of frame i, or None.'''
+        if self.pulse[i] < 0:
+            return None
+        raw = self.raw_data_idx[i]
+        return Pulse(float(self.t1[i]), float(self.t2[i]), str(raw) if raw >= 0 else 'NA')
+
+    def release(self):
+        '''Drop the reference of the batch to the frames.'''
+        self.frames = None
+
+class FrameClient(object):
+    '''Client of a FrameServer.
+
+socket_path = path of the server socket; default is default_socket(expdir)
+expdir = experiment directory of the server, used for the default socket
+timeout = socket timeout in seconds
+
+A client can be shared by the threads of a process; requests are sent one
+at a time.
+'''
+    def __init__(self, socket_path=None, expdir=None, timeout=None):
+        if shared_memory is None:
+            raise FrameServerError('The frame server requires Python 3.8 or later.')
+        if socket_path is None:
+            if expdir is None:
+                raise FrameServerError('A socket path or experiment directory is required.')
+            socket_path = default_socket(expdir)
+        self.socket_path = socket_path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        try:
+            self.sock.connect(socket_path)
+        except socket.error as e:
+            self.sock.close()
+            raise FrameServerError('No frame server at {:}: {:}'.format(socket_path, e))
+        self._rfile = self.sock.makefile('rb')
+        self._lock = threading.Lock()
+        # (name, SharedMemory) of batches whose frames are gone; appended
+        # by finalizers, so no request is sent from them.
+        self._unused = []
+        # Segments released but still mapped.
+        self._mapped = []
+
+    def _take_unused(self):
+        names = []
+        while len(self._unused) > 0:
+            (name, shm) = self._unused.pop()
+            names.append(name)
+            self._mapped.append(shm)
+        # The frames of these segments are gone, so they can be unmapped.
+        still = []
+        for shm in self._mapped:
+            try:
+                shm.close()
+            except BufferError:
+                still.append(shm)
+        self._mapped = still
+        return names
+
+    def request(self, msg):
+        '''Send the request msg and return the reply.'''
+        with self._lock:
+            if self.sock is None:
+                raise FrameServerError('The client is closed.')
+            names = self._take_unused()
+            if len(names) > 0:
+                msg = dict(msg, release=names)
+            _send(self.sock, msg)
+            line = self._rfile.readline()
+        if not line:
+            raise FrameServerError('The frame server closed the connection.')
+        reply = json.loads(line.decode('utf-8'))
+        if not reply.pop('ok', False):
+            raise FrameServerError(reply.get('error'))
+        return reply
+
+    def frames(self, timestamp, indexes=None, times=None, convert=False, missing=None, fill=0):
+        '''Return a FrameBatch of the frames of an acquisition.
+
+timestamp = the acquisition timestamp
+indexes = raw data frame indexes; -1 for a frame of the fill value
+times = times, instead of indexes; see resolve_times()
+convert = if True, the frames are scan-converted
+missing = None, 'prev' or 'next'; see resolve_times()
+fill = value of the frames at times without a frame
+'''
+        msg = {'op': 'frames', 'timestamp': timestamp, 'convert': bool(convert), 'fill': fill}
+        if times is not None:
+            msg['times'] = [float(t) for t in np.atleast_1d(times)]
+            msg['missing'] = missing
+        else:
+            msg['indexes'] = [int(i) for i in np.atleast_1d(indexes)]
+        reply = self.request(msg)
+        shm = _attach(reply['shm'])
+        frames = np.ndarray(tuple(reply['shape']), dtype=np.uint8, buffer=shm.buf)
+        weakref.finalize(frames, self._unused.append, (reply['shm'], shm))
+        return FrameBatch(reply, frames)
+
+    def acq(self, timestamp):
+        '''Return a RemoteAcq for the acquisition timestamp.'''
+        return RemoteAcq(self, timestamp)
+
+    def info(self):
+        '''Return a dict of the state of the server.'''
+        return self.request({'op': 'info'})
+
+    def shutdown(self):
+        '''Ask the server to stop.'''
+        return self.request({'op': 'shutdown'})
+
+    def close(self):
+        '''Close the connection. The server releases the segments of the
+connection; frames already mapped by the client stay valid.'''
+        with self._lock:
+            if self.sock is None:
+                return
+            self._take_unused()
+            self._rfile.close()
+            self.sock.close()
+            self.sock = None
+
+    # Define __enter__ and __exit__ to create context manager.
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class RemoteAcq(object):
+    '''An acquisition served by a FrameServer, with the frame methods of
+ultratils.acq.Acq. Frames are uint8 views of shared memory and should not
+be modified.'''
+    def __init__(self, client, timestamp):
+        self.client = client
+        self.timestamp = timestamp
+        info = client.request({'op': 'acq', 'timestamp': timestamp})
+        self.nframes = info['nframes']
+        self.frame_shape = tuple(info['frame_shape'])
+        self.npulses = info['npulses']
+        self.framerate = info['framerate']
+
+    def get_frame(self, fidx, convert=False):
+        '''Return image frame fidx, scan-converted if convert is True.'''
+        return self.client.frames(self.timestamp, indexes=[fidx], convert=convert).frames[0]
+
+    def get_frames(self, indexes, convert=False):
+        '''Return the image frames at indexes as an array of shape (n, h, w).'''
+        return self.client.frames(self.timestamp, indexes=indexes, convert=convert).frames
+
+    def frames_at(self, times, convert=False, fill=0):
+        '''Return (frames, raw_data_idx) for the frames at times, as
+Acq.frames_at().'''
+        batch = self.client.frames(self.timestamp, times=times, convert=convert, fill=fill)
+        return (batch.frames, batch.raw_data_idx)
+
+    def frame_at(self, t, convert=False, missing_val=None):
+        '''Return the frame at time t, as Acq.frame_at(). The label is a
+Pulse with t1, t2 and text attributes.'''
+        mode = missing_val if missing_val in ('prev', 'next') else None
+        fill = missing_val if missing_val is not None and mode is None else 0
+        batch = self.client.frames(
+            self.timestamp, times=[t], convert=convert, missing=mode, fill=fill
+        )
+        received = batch.raw_data_idx[0] >= 0
+        frame = batch.frames[0]
+        if missing_val is None:
+            return (frame, batch.label(0)) if received else (None, None)
+        if not received:
+            # A replacement frame of the missing value, or none.
+            return (None, None, frame if mode is None else None)
+        if batch.substituted[0]:
+            return (None, batch.label(0), frame)
+        return (frame, batch.label(0), None)
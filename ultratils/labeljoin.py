@@ -0,0 +1,188 @@
+# Join annotation intervals to ultrasound frames across an experiment.
+#
+# label_table() collects the labels of an annotation tier, for example the
+# phones or words of the TextGrids of many acquisitions, into one table of
+# (timestamp, text, t1, t2) rows. join_frames() finds the frames of every
+# label with array operations on the sync index of each acquisition: the
+# label times are looked up in the sorted pulse times with searchsorted()
+# for all labels of an acquisition at once, instead of with a label_at()
+# call per time. The result is a table with one row per (label, frame),
+# which read_frames() reads with one batched read per image file.
+#
+# Frame selection:
+#   'mid' = the frame at the midpoint of each label
+#   'all' = every frame whose pulse interval overlaps the label
+#   N     = N frames per label, at times t1 + (k + 0.5) * (t2 - t1) / N,
+#           k = 0 .. N - 1; 1 is the same as 'mid'
+# The frame at a time is the frame of the pulse that contains the time, as
+# with Acq.frame_at().
+
+import os
+import re
+import numpy as np
+
+from ultratils import profiling
+
+class LabelJoinError(Exception):
+    """Base class for errors in this module."""
+    def __init__(self, msg):
+        self.msg = msg
+    def __str__(self):
+        return repr(self.msg)
+
+def _acquisitions(expdir):
+    from ultratils.exp import Exp
+    e = Exp(expdir)
+    e.gather()
+    return e.acquisitions
+
+def label_table(expdir, tier, pattern=None, textgrid='{timestamp}.TextGrid'):
+    '''Return a DataFrame of the labels of a tier in the TextGrids of the
+acquisitions of an experiment, with columns timestamp, text, t1 and t2.
+
+expdir = the experiment directory
+tier = name of the annotation tier, e.g. 'phone' or 'word'
+pattern = optional regular expression that label texts must match
+textgrid = name of the TextGrid in each acquisition directory; {timestamp}
+    and {dtype} are replaced by those of the acquisition
+
+Acquisitions without a TextGrid are skipped.
+'''
+    import pandas as pd
+    import audiolabel
+    regex = re.compile(pattern) if pattern is not None else None
+    cols = {'timestamp': [], 'text': [], 't1': [], 't2': []}
+    for a in _acquisitions(expdir):
+        tg = os.path.join(
+            a.abspath, textgrid.format(timestamp=a.timestamp, dtype=a.dtype)
+        )
+        if not os.path.isfile(tg):
+            continue
+        lm = audiolabel.LabelManager(from_file=tg, from_type='praat')
+        for l in lm.tier(tier):
+            if regex is not None and regex.search(l.text) is None:
+                continue
+            cols['timestamp'].append(a.timestamp)
+            cols['text'].append(l.text)
+            cols['t1'].append(l.t1)
+            cols['t2'].append(l.t2)
+    return pd.DataFrame(cols, columns=['timestamp', 'text', 't1', 't2'])
+
+def _expand(lo, hi):
+    '''Return (owner, pos) for the concatenated ranges lo[i]..hi[i] - 1,
+where owner is the range index and pos the position of each element.'''
+    counts = np.clip(hi - lo, 0, None)
+    owner = np.repeat(np.arange(len(lo)), counts)
+    starts = np.cumsum(counts) - counts
+    pos = np.arange(counts.sum()) - starts[owner] + lo[owner]
+    return (owner, pos)
+
+def _join_acq(sidx, t1, t2, frames):
+    '''Return (label, k, t, pulse) arrays for the labels t1, t2 of one
+acquisition with SyncIndex sidx. label is the position of the label in
+t1, k the position of the frame in the label, t the query time (the pulse
+start for 'all') and pulse the position of the pulse in sidx, -1 where no
+pulse contains t.'''
+    if frames == 'all':
+        lo = np.searchsorted(sidx.t2, t1, side='right')
+        hi = np.searchsorted(sidx.t1, t2, side='left')
+        (label, pulse) = _expand(lo, hi)
+        k = pulse - lo[label]
+        return (label, k, sidx.t1[pulse], pulse)
+    if frames == 'mid':
+        frames = 1
+    try:
+        n = int(frames)
+    except (TypeError, ValueError):
+        raise LabelJoinError("frames must be 'mid', 'all' or a number, not {:}".format(frames))
+    if n < 1:
+        raise LabelJoinError('frames must be at least 1.')
+    label = np.repeat(np.arange(len(t1)), n)
+    k = np.tile(np.arange(n), len(t1))
+    t = t1[label] + (k + 0.5) * (t2[label] - t1[label]) / n
+    return (label, k, t, sidx.pulse_at(t))
+
+def join_frames(expdir, labels, frames='mid', keep_missing=False):
+    '''Join labels to the frames of their acquisitions.
+
+expdir = the experiment directory
+labels = DataFrame with timestamp, t1 and t2 columns, e.g. from
+    label_table(); other columns are copied to the result
+frames = 'mid', 'all' or a number of frames per label; see the module
+    comments
+keep_missing = if True, keep rows for times at which no frame was received,
+    with raw_data_idx -1
+
+Returns a DataFrame with the columns of labels and label_idx (the index
+of the label row), frame_num (position of the frame in the label), t (the
+query time, or the pulse start with 'all'), pulse_idx, raw_data_idx and
+image_file. Rows are in label order.
+'''
+    import pandas as pd
+    from ultratils.acq import Acq
+    labels = labels.copy()
+    labels['label_idx'] = labels.index
+    # The index is now the position of each label row, which orders the
+    # result even if label_idx is not sorted.
+    labels = labels.reset_index(drop=True)
+    parts = []
+    positions = []
+    with profiling.stage('labeljoin', frames=len(labels)):
+        for (ts, grp) in labels.groupby('timestamp', sort=False):
+            a = Acq(timestamp=ts, expdir=expdir)
+            sidx = a.sync_index
+            t1 = grp['t1'].values.astype(np.float64)
+            t2 = grp['t2'].values.astype(np.float64)
+            (label, k, t, pulse) = _join_acq(sidx, t1, t2, frames)
+            found = pulse >= 0
+            safe = np.where(found, pulse, 0)
+            part = grp.iloc[label]
+            positions.append(part.index.values)
+            part = part.reset_index(drop=True)
+            part['frame_num'] = k
+            part['t'] = t
+            part['pulse_idx'] = np.where(found, sidx.pulse_idx[safe], -1)
+            part['raw_data_idx'] = np.where(found, sidx.raw_data_idx[safe], -1)
+            part['image_file'] = a.abs_image_file
+            parts.append(part)
+    if len(parts) == 0:
+        cols = list(labels.columns) + [
+            'frame_num', 't', 'pulse_idx', 'raw_data_idx', 'image_file'
+        ]
+        return pd.DataFrame(columns=cols)
+    result = pd.concat(parts, ignore_index=True)
+    order = np.lexsort((result['frame_num'].values, np.concatenate(positions)))
+    result = result.iloc[order]
+    if not keep_missing:
+        result = result[result['raw_data_idx'] >= 0]
+    return result.reset_index(drop=True)
+
+def read_frames(joined, convert=False):
+    '''Return the frames of the rows of a join_frames() table as an array of
+shape (nrows, h, w). The frames of each image file are read in one batched
+read. Rows without a frame (raw_data_idx -1) are zero.
+
+convert = if True, return scan-converted frames
+'''
+    import pandas as pd
+    from ultratils.dataset import ConcatFrameDataset
+    files = list(joined['image_file'].unique())
+    filepos = pd.Categorical(joined['image_file'], categories=files).codes
+    raw = joined['raw_data_idx'].values.astype(np.int64)
+    found = raw >= 0
+    with ConcatFrameDataset(files) as ds:
+        gidx = ds.offsets[filepos] + raw
+        out = np.zeros((len(joined),) + ds.frame_shape, dtype=np.uint8)
+        out[found] = ds.get_batch(gidx[found])
+        if not convert:
+            return out
+        import ultratils.pysonix.converters
+        result = None
+        for f in np.unique(filepos):
+            sel = filepos == f
+            conv = ultratils.pysonix.converters.get_converter(ds.file_header(int(f)))
+            conv_frames = conv.convert_stack(out[sel])
+            if result is None:
+                result = np.empty((len(joined),) + conv_frames.shape[1:], dtype=np.uint8)
+            result[sel] = conv_frames
+        return result if result is not None else out
@@ -0,0 +1,58 @@
+# M-mode displays: scanlines over time.
+#
+# An M-mode image shows the samples of one scanline, or the mean of a few
+# neighboring scanlines, in every frame of a recording, with time on the
+# horizontal axis. The scanlines are read through the readers'
+# get_scanlines(), which reads only the bytes of the selected scanlines
+# from the memory-mapped image file instead of every full frame.
+#
+# Without a sync index the columns of the image are frames. With a sync
+# index the columns are pulses, so that the horizontal axis is aligned to
+# the pulse times and dropped frames appear as fill columns.
+
+import numpy as np
+
+from ultratils import profiling
+
+def mmode(rdr, scanlines, sidx=None, t1=None, t2=None, average=True, fill=0):
+    '''Return (times, image) of an M-mode display.
+
+rdr = BprReader or RawReader
+scanlines = a scanline index, or a sequence of scanlines
+sidx = optional SyncIndex of the acquisition; if given, the columns of
+    image are the pulses between t1 and t2, and times are the pulse start
+    times; otherwise the columns are the frames, and times is None
+t1, t2 = time range, used with sidx; default is all pulses
+average = if True, average the scanlines; otherwise image has an extra
+    first axis of scanlines
+fill = value of the columns of pulses without a frame; nan makes an
+    integer image float32, and other values must fit the data type
+
+image has shape (samples, columns), or (nscanlines, samples, columns) if
+scanlines is a sequence and average is False.
+'''
+    if np.ndim(scanlines) == 0:
+        average = False
+    if sidx is None:
+        return (None, rdr.get_scanlines(scanlines, average=average))
+    sel = np.ones(len(sidx), dtype=bool)
+    if t1 is not None:
+        sel &= sidx.t2 > t1
+    if t2 is not None:
+        sel &= sidx.t1 < t2
+    times = sidx.t1[sel]
+    raw = sidx.raw_data_idx[sel].astype(np.intp)
+    received = (raw >= 0) & (raw < rdr.nframes)
+    if np.any(received):
+        (lo, hi) = (raw[received].min(), raw[received].max() + 1)
+    else:
+        (lo, hi) = (0, 0)
+    # One strided read of the frame range of the selected pulses.
+    data = rdr.get_scanlines(scanlines, lo, hi, average=average)
+    with profiling.stage('mmode', frames=len(raw)):
+        dtype = data.dtype
+        if np.isnan(fill) and dtype.kind != 'f':
+            dtype = np.float32
+        image = np.full(data.shape[:-1] + (len(raw),), fill, dtype=dtype)
+        image[..., received] = data[..., raw[received] - lo]
+    return (times, image)
@@ -0,0 +1,221 @@
+# Frame-to-frame motion energy of ultrasound acquisitions.
+#
+# motion_energy() reads the frames of an image file in chunks and computes
+# statistics of the change between consecutive frames for one or more
+# regions of the frame, all in a single pass with array operations on each
+# chunk. The result is a MotionEnergy with one value per frame, region and
+# statistic, which tap detection, frozen-frame checks and other detectors
+# can share instead of each reading the frames again.
+#
+# Statistics, for frame i and region r, with d = frame[i] - frame[i - 1]:
+#   'std'  = standard deviation of abs(d) over r
+#   'mad'  = mean of abs(d) over r
+#   'corr' = correlation coefficient of frame[i - 1] and frame[i] over r
+# The values of frame 0 are nan.
+#
+# Regions are given as a dict of name: (top, bottom, left, right), in rows
+# and columns of the frame as returned by BprReader.get_frame(); row 0 is
+# nearest the transducer, bottom and right are exclusive and None means the
+# frame edge. The default region is the whole frame.
+#
+# Results are cached in a .motion.npz file next to the image file and are
+# reused while the file is not older than the image file and was computed
+# with the same regions and statistics.
+
+import os
+import numpy as np
+
+from ultratils import profiling
+
+STATISTICS = ('std', 'mad', 'corr')
+MOTION_EXT = '.motion.npz'
+FORMAT_VERSION = 1
+
+class MotionError(Exception):
+    """Base class for errors in this module."""
+    def __init__(self, msg):
+        self.msg = msg
+    def __str__(self):
+        return repr(self.msg)
+
+def depth_band(depth):
+    '''Return the region of the depth rows nearest the transducer.'''
+    return (0, depth, None, None)
+
+class MotionEnergy(object):
+    '''Motion statistics of the frames of an image file.
+
+values = array of shape (nregions, nstats, nframes)
+regions = list of (name, (top, bottom, left, right))
+stats = names of the statistics
+'''
+    def __init__(self, values, regions, stats):
+        self.values = values
+        self.regions = [(name, tuple(r)) for (name, r) in regions]
+        self.stats = list(stats)
+
+    @property
+    def nframes(self):
+        return self.values.shape[2]
+
+    def get(self, stat, region=None):
+        '''Return the series of a statistic for a region (default the first),
+indexed by raw data frame index.'''
+        if stat not in self.stats:
+            raise MotionError('Statistic {:} was not computed.'.format(stat))
+        names = [name for (name, r) in self.regions]
+        ridx = 0 if region is None else names.index(region)
+        return self.values[ridx, self.stats.index(stat)]
+
+    def at_pulses(self, sidx, stat, region=None):
+        '''Return (t1, series) of a statistic at the pulses of the SyncIndex
+sidx, with nan for pulses without a frame.'''
+        series = self.get(stat, region)
+        raw = sidx.raw_data_idx
+        ok = (raw >= 0) & (raw < len(series))
+        out = np.full(len(raw), np.nan)
+        out[ok] = series[raw[ok]]
+        return (sidx.t1, out)
+
+    def signature(self):
+        return _signature(self.regions, self.stats)
+
+    def save(self, filename):
+        '''Save to an .npz file.'''
+        tmpname = filename + '.tmp'
+        with open(tmpname, 'wb') as f:
+            np.savez(
+                f, version=FORMAT_VERSION, values=self.values,
+                signature=self.signature()
+            )
+        if os.path.exists(filename):
+            os.remove(filename)
+        os.rename(tmpname, filename)
+
+    @classmethod
+    def load(cls, filename, regions, stats):
+        '''Load from an .npz file. Return None if the file was computed with
+different regions or statistics.'''
+        with np.load(filename) as npz:
+            if int(npz['version']) != FORMAT_VERSION or \
+               str(npz['signature']) != _signature(regions, stats):
+                return None
+            return cls(npz['values'], regions, stats)
+
+def _signature(regions, stats):
+    return repr((
+        [(name, tuple(None if v is None else int(v) for v in r)) for (name, r) in regions],
+        list(stats)
+    ))
+
+def _regions(regions):
+    if regions is None:
+        return [('frame', (None, None, None, None))]
+    if hasattr(regions, 'items'):
+        return sorted(regions.items())
+    return list(regions)
+
+def _bounds(region, h, w):
+    '''Return region with None replaced by the frame edges.'''
+    (top, bottom, left, right) = region
+    (top, bottom, step) = slice(top, bottom).indices(h)
+    (left, right, step) = slice(left, right).indices(w)
+    return (top, max(top, bottom), left, max(left, right))
+
+def _chunk_stats(frames, stats, out):
+    '''Compute stats for frames[1:] against frames[:-1] into out, of shape
+(nstats, len(frames) - 1). frames have shape (n, npoints).'''
+    cur = frames[1:]
+    prev = frames[:-1]
+    npts = frames.shape[1]
+    if 'std' in stats or 'mad' in stats:
+        absd = np.abs(cur.astype(np.int16) - prev.astype(np.int16)).astype(np.float32)
+        mean = absd.sum(axis=1, dtype=np.float64) / npts
+        if 'mad' in stats:
+            out[stats.index('mad')] = mean
+        if 'std' in stats:
+            sq = np.einsum('ij,ij->i', absd, absd, dtype=np.float64) / npts
+            out[stats.index('std')] = np.sqrt(np.clip(sq - mean ** 2, 0, None))
+    if 'corr' in stats:
+        x = frames.astype(np.float32)
+        x -= x.mean(axis=1, keepdims=True)
+        norm = np.einsum('ij,ij->i', x, x, dtype=np.float64)
+        cross = np.einsum('ij,ij->i', x[1:], x[:-1], dtype=np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            out[stats.index('corr')] = cross / np.sqrt(norm[1:] * norm[:-1])
+
+def compute(imagefile, regions=None, stats=STATISTICS, chunk_frames=256):
+    '''Compute the MotionEnergy of the frames of imagefile, a .bpr file or
+archive.
+
+regions = dict of name: (top, bottom, left, right); default is the whole
+    frame
+stats = statistics to compute, from STATISTICS
+chunk_frames = number of frames read at a time
+'''
+    from ultratils.dataset import ConcatFrameDataset
+    stats = list(stats)
+    for s in stats:
+        if s not in STATISTICS:
+            raise MotionError('Unknown statistic {:}.'.format(s))
+    regions = _regions(regions)
+    # Frames are read in the file layout, (w, h), so the rows of a region
+    # are the last axis, and only the bounding box of the regions is read.
+    with ConcatFrameDataset([imagefile], transpose=False) as ds:
+        (h, w) = ds.frame_shape[::-1]
+        bounds = [_bounds(r, h, w) for (name, r) in regions]
+        bbox = (
+            min(b[0] for b in bounds), max(b[1] for b in bounds),
+            min(b[2] for b in bounds), max(b[3] for b in bounds)
+        )
+        n = len(ds)
+        values = np.full((len(regions), len(stats), n), np.nan)
+        with profiling.stage('motion', frames=n):
+            # Each chunk starts with the last frame of the previous chunk.
+            for start in range(0, max(n - 1, 0), chunk_frames):
+                stop = min(start + chunk_frames + 1, n)
+                frames = ds.get_batch(np.arange(start, stop), roi=bbox)
+                for (ridx, (top, bottom, left, right)) in enumerate(bounds):
+                    sub = frames[
+                        :, left - bbox[2]:right - bbox[2], top - bbox[0]:bottom - bbox[0]
+                    ].reshape(stop - start, -1)
+                    _chunk_stats(sub, stats, values[ridx, :, start + 1:stop])
+    return MotionEnergy(values, regions, stats)
+
+def motion_energy(imagefile, regions=None, stats=STATISTICS, cache=True, chunk_frames=256):
+    '''Return the MotionEnergy of imagefile, from its .motion.npz cache file
+if that is fresh and has the same regions and statistics. If cache is
+True, a computed result is written to the cache file.'''
+    regions = _regions(regions)
+    stats = list(stats)
+    cachefile = imagefile + MOTION_EXT
+    if cache:
+        try:
+            fresh = os.path.getmtime(cachefile) >= os.path.getmtime(imagefile)
+        except OSError:
+            fresh = False
+        if fresh:
+            me = MotionEnergy.load(cachefile, regions, stats)
+            if me is not None:
+                return me
+    me = compute(imagefile, regions, stats, chunk_frames)
+    if cache:
+        try:
+            me.save(cachefile)
+        except (IOError, OSError):   # e.g. read-only data directory
+            pass
+    return me
+
+def first_exceeding(series, factor, skip=5):
+    '''Return the index of the first value of series, after the first skip,
+that exceeds factor times the mean of series, or None. nan values are
+ignored.'''
+    threshold = factor * np.nanmean(series)
+    high = np.flatnonzero(series > threshold)
+    high = high[high >= skip]
+    return int(high[0]) if len(high) > 0 else None
+
+def frozen_frames(me, region=None, tol=0.0):
+    '''Return the indexes of frames whose mean absolute change from the
+previous frame is at most tol, i.e. repeated frames.'''
+    return np.flatnonzero(me.get('mad', region) <= tol)
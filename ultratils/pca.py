@@ -0,0 +1,259 @@
+# Incremental principal component analysis of ultrasound frames.
+#
+# FramePCA computes principal components ("eigentongues") of a frame set in
+# a single streaming pass. Frames are read in batches, optionally
+# scan-converted and cropped to a region of interest, and each batch updates
+# the mean and the components with the incremental SVD of Ross et al.
+# (2008): the current components, scaled by their singular values, are
+# stacked with the centred batch and a mean correction row, and the top
+# components of the stack replace the current ones. Memory use is
+# proportional to (n_components + batch_size) * frame size and does not
+# depend on the number of frames.
+#
+# The decomposition of the stack is computed from its Gram matrix, which is
+# small, instead of by a full SVD of the wide stack, which is an order of
+# magnitude slower for frame-sized rows.
+
+import numpy as np
+
+from ultratils import profiling
+
+FORMAT_VERSION = 1
+
+class PCAError(Exception):
+    """Base class for errors in this module."""
+    def __init__(self, msg):
+        self.msg = msg
+    def __str__(self):
+        return repr(self.msg)
+
+def _top_svd(X, k):
+    '''Return (S, Vt) of the k largest singular values of X and their right
+singular vectors, with signs fixed so that the largest coefficient of each
+vector is positive.'''
+    G = np.dot(X, X.T)
+    (w, U) = np.linalg.eigh(G)
+    order = np.argsort(w)[::-1][:k]
+    w = np.clip(w[order], 0, None)
+    U = U[:, order]
+    S = np.sqrt(w)
+    nz = S > S[0] * 1e-12
+    Vt = np.zeros((len(S), X.shape[1]), dtype=X.dtype)
+    Vt[nz] = np.dot(U[:, nz].T, X) / S[nz, np.newaxis]
+    maxcol = np.argmax(np.abs(Vt), axis=1)
+    signs = np.sign(Vt[np.arange(len(S)), maxcol])
+    signs[signs == 0] = 1
+    return (S, Vt * signs[:, np.newaxis])
+
+class FramePCA(object):
+    '''Incremental PCA of ultrasound frames.
+
+n_components = number of components kept
+convert = if True, frames read from a dataset are scan-converted first
+roi = optional (top, bottom, left, right) region of the (converted) frame
+    used for the analysis, in array rows and columns; bottom and right are
+    exclusive
+
+Frames passed to partial_fit() and transform() must already be
+scan-converted if convert is True; the roi is applied by those methods.
+After fitting, the components are in the rows of components, and
+component_frames() returns them in the shape of the region of interest.
+'''
+    def __init__(self, n_components=20, convert=False, roi=None):
+        self.n_components = n_components
+        self.convert = convert
+        self.roi = tuple(roi) if roi is not None else None
+        self.frame_shape = None
+        self.mean = None
+        self.components = None
+        self.singular_values = None
+        self.n_samples_seen = 0
+        # Sum of squared deviations from the mean, over all features.
+        self._ss = 0.0
+
+    def _crop(self, frames):
+        frames = np.asarray(frames)
+        if frames.ndim == 2:
+            frames = frames[np.newaxis]
+        if self.roi is not None:
+            (top, bottom, left, right) = self.roi
+            frames = frames[:, top:bottom, left:right]
+        return frames
+
+    def features(self, frames):
+        '''Return frames, cropped to the roi, as rows of a float64 array.'''
+        frames = self._crop(frames)
+        if self.frame_shape is None:
+            self.frame_shape = frames.shape[1:]
+        elif frames.shape[1:] != self.frame_shape:
+            raise PCAError('Frame shape {:} does not match fitted shape {:}.'.format(
+                frames.shape[1:], self.frame_shape
+            ))
+        return frames.reshape(len(frames), -1).astype(np.float64)
+
+    def partial_fit(self, frames):
+        '''Update the mean and components with a batch of frames. The first
+batch must have at least n_components frames.'''
+        X = self.features(frames)
+        n_new = X.shape[0]
+        if n_new == 0:
+            return self
+        if self.n_samples_seen == 0 and n_new < self.n_components:
+            raise PCAError(
+                'The first batch has {:d} frames; at least n_components ({:d}) are needed.'.format(
+                    n_new, self.n_components
+                )
+            )
+        with profiling.stage('pca_fit', frames=n_new, nbytes=X.nbytes):
+            batch_mean = X.mean(axis=0)
+            X -= batch_mean
+            n_seen = self.n_samples_seen
+            total = n_seen + n_new
+            batch_ss = float(np.sum(X * X))
+            if n_seen == 0:
+                self.mean = batch_mean
+                self._ss = batch_ss
+            else:
+                diff = self.mean - batch_mean
+                corr = np.sqrt(float(n_seen) * n_new / total) * diff
+                self._ss += batch_ss + float(np.dot(corr, corr))
+                X = np.vstack([
+                    self.singular_values[:, np.newaxis] * self.components,
+                    X, corr[np.newaxis]
+                ])
+                self.mean = (n_seen * self.mean + n_new * batch_mean) / total
+            (S, Vt) = _top_svd(X, self.n_components)
+            self.singular_values = S
+            self.components = Vt
+            self.n_samples_seen = total
+        return self
+
+    @property
+    def explained_variance(self):
+        '''Variance explained by each component.'''
+        return self.singular_values ** 2 / max(1, self.n_samples_seen - 1)
+
+    @property
+    def explained_variance_ratio(self):
+        '''Proportion of the total variance explained by each component.'''
+        if self._ss == 0:
+            return np.zeros_like(self.singular_values)
+        return self.singular_values ** 2 / self._ss
+
+    def _check_fitted(self):
+        if self.components is None:
+            raise PCAError('FramePCA has not been fitted.')
+
+    def transform(self, frames):
+        '''Return the component scores of frames, shape (nframes, n_components).'''
+        self._check_fitted()
+        X = self.features(frames)
+        with profiling.stage('pca_transform', frames=len(X), nbytes=X.nbytes):
+            X -= self.mean
+            return np.dot(X, self.components.T)
+
+    def inverse_transform(self, scores):
+        '''Return the frames, in the roi shape, reconstructed from scores.'''
+        self._check_fitted()
+        scores = np.atleast_2d(scores)
+        X = np.dot(scores, self.components) + self.mean
+        return X.reshape((len(scores),) + tuple(self.frame_shape))
+
+    def component_frames(self):
+        '''Return the components as frames in the roi shape.'''
+        self._check_fitted()
+        return self.components.reshape((len(self.components),) + tuple(self.frame_shape))
+
+    def _dataset_batches(self, ds, indices, batch_size):
+        '''Yield (indices, frames) batches of ds in file order, scan-converted
+if convert is True.'''
+        if indices is None:
+            batches = ds.iter_batches(batch_size=batch_size, shuffle=False)
+        else:
+            indices = np.asarray(indices, dtype=np.int64)
+            batches = (
+                (indices[s:s + batch_size], ds.get_batch(indices[s:s + batch_size]))
+                for s in range(0, len(indices), batch_size)
+            )
+        if not self.convert:
+            for batch in batches:
+                yield batch
+            return
+        if not ds.transpose:
+            raise PCAError('Scan conversion needs a dataset with transpose=True.')
+        import ultratils.pysonix.converters
+        for (idx, frames) in batches:
+            fidx = ds.locate(idx)[0]
+            converted = None
+            for f in np.unique(fidx):
+                sel = fidx == f
+                conv = ultratils.pysonix.converters.get_converter(ds.file_header(int(f)))
+                out = conv.convert_stack(frames[sel])
+                if converted is None:
+                    converted = np.empty((len(idx),) + out.shape[1:], dtype=out.dtype)
+                elif out.shape[1:] != converted.shape[1:]:
+                    raise PCAError('Converted frame shapes differ between files.')
+                converted[sel] = out
+            yield (idx, converted)
+
+    def fit_dataset(self, ds, batch_size=256, progress=False):
+        '''Fit the components to all frames of ds, a ConcatFrameDataset, in
+one pass. Returns self.'''
+        prog = profiling.Progress(len(ds), label='frames') if progress else None
+        for (idx, frames) in self._dataset_batches(ds, None, batch_size):
+            self.partial_fit(frames)
+            if prog is not None:
+                prog.update(len(idx))
+        return self
+
+    def transform_dataset(self, ds, indices=None, batch_size=1024):
+        '''Return the component scores of the frames of ds at indices (default
+all), shape (nframes, n_components).'''
+        self._check_fitted()
+        n = len(ds) if indices is None else len(indices)
+        scores = np.empty((n, len(self.components)), dtype=np.float64)
+        pos = 0
+        for (idx, frames) in self._dataset_batches(ds, indices, batch_size):
+            scores[pos:pos + len(idx)] = self.transform(frames)
+            pos += len(idx)
+        return scores
+
+    def save(self, filename):
+        '''Save the fitted model as an .npz file.'''
+        self._check_fitted()
+        np.savez(
+            filename, version=FORMAT_VERSION, n_components=self.n_components,
+            convert=self.convert,
+            roi=np.array(self.roi if self.roi is not None else [], dtype=np.int64),
+            frame_shape=np.array(self.frame_shape, dtype=np.int64),
+            mean=self.mean, components=self.components,
+            singular_values=self.singular_values,
+            n_samples_seen=self.n_samples_seen, ss=self._ss
+        )
+
+    @classmethod
+    def load(cls, filename):
+        '''Load a model saved by save().'''
+        with np.load(filename) as npz:
+            if int(npz['version']) > FORMAT_VERSION:
+                raise PCAError('Unsupported model version {:}.'.format(int(npz['version'])))
+            roi = tuple(int(v) for v in npz['roi']) or None
+            pca = cls(int(npz['n_components']), bool(npz['convert']), roi)
+            pca.frame_shape = tuple(int(v) for v in npz['frame_shape'])
+            pca.mean = npz['mean']
+            pca.components = npz['components']
+            pca.singular_values = npz['singular_values']
+            pca.n_samples_seen = int(npz['n_samples_seen'])
+            pca._ss = float(npz['ss'])
+        return pca
+
+def fit_experiment(expdir, n_components=20, convert=False, roi=None, batch_size=256, progress=False):
+    '''Fit a FramePCA to all frames of the acquisitions in expdir and return
+it.'''
+    from ultratils.exp import Exp
+    e = Exp(expdir)
+    e.gather()
+    with e.frame_dataset() as ds:
+        return FramePCA(n_components, convert, roi).fit_dataset(
+            ds, batch_size=batch_size, progress=progress
+        )
@@ -0,0 +1,303 @@
+# In-process postprocessing pipeline for ultrasound acquisitions.
+#
+# The experiment tree is walked once to find the acquisitions. Each
+# acquisition is processed by an AcqJob, which runs the postprocessing
+# stages in dependency order and shares the open WavReader, BprReader and
+# Converter between them. Completed stages are recorded in a
+# <name>.bpr.pipeline.json state file next to the .bpr, and stages that are
+# already recorded as done are skipped when the pipeline is run again.
+# Independent acquisitions are processed concurrently on a worker pool.
+
+import os, sys
+import json
+import time
+import wave
+import multiprocessing
+from collections import OrderedDict
+from contextlib import closing
+from datetime import datetime
+import numpy as np
+
+import ultratils.psync
+import ultratils.utils
+from ultratils import profiling
+from ultratils.wavreader import WavReader, pack24
+import ultratils.pysonix.bprreader
+import ultratils.pysonix.converters
+import ultratils.pysonix.bmpwriter
+
+# Postprocessing stages and the stages each one depends on.
+STAGES = OrderedDict([
+    ('sepchan', ()),
+    ('psync', ('sepchan',)),
+    ('bpr2bmp', ('psync',)),
+    ('qc', ('bpr2bmp',)),
+])
+
+class PipelineError(Exception):
+    """Base class for errors in this module."""
+    def __init__(self, msg):
+        self.msg = msg
+    def __str__(self):
+        return repr(self.msg)
+
+def resolve_stages(stages=None):
+    """Return the requested stages and all the stages they depend on, in
+an order in which each stage follows its dependencies."""
+    if stages is None:
+        stages = list(STAGES.keys())
+    ordered = []
+    def visit(stage, path):
+        if stage not in STAGES:
+            raise PipelineError("Unknown stage '{:}'.".format(stage))
+        if stage in path:
+            raise PipelineError("Circular dependency for stage '{:}'.".format(stage))
+        for dep in STAGES[stage]:
+            visit(dep, path + [stage])
+        if stage not in ordered:
+            ordered.append(stage)
+    for stage in stages:
+        visit(stage, [])
+    return ordered
+
+def find_bprs(dirs):
+    """Walk one or more directories once and return the .bpr files found."""
+    bprs = []
+    for d in dirs:
+        for root, dirnames, filenames in os.walk(d):
+            for filename in sorted(filenames):
+                if filename.lower().endswith('.bpr'):
+                    bprs.append(os.path.join(root, filename))
+    return bprs
+
+def split_channels(wavreader, basename, blocksize=1048576):
+    """Write each channel of an open WavReader to basename.chN.wav, where N
+is the one-based channel number."""
+    if wavreader.dtype.kind == 'f':
+        raise PipelineError('Cannot split channels of floating point .wav.')
+    for c in range(wavreader.nchannels):
+        chan = wavreader.channel(c)
+        name = '{:}.ch{:d}.wav'.format(basename, c + 1)
+        with closing(wave.open(name, 'wb')) as w:
+            w.setnchannels(1)
+            w.setsampwidth(wavreader.sampwidth)
+            w.setframerate(wavreader.rate)
+            for start in range(0, len(chan), blocksize):
+                block = chan[start:start + blocksize]
+                if wavreader.sampwidth == 3:
+                    w.writeframes(pack24(block))
+                else:
+                    w.writeframes(np.ascontiguousarray(block).tobytes())
+
+class AcqJob(object):
+    """The postprocessing stages for a single acquisition.
+
+bpr = the acquisition's .bpr file
+channel = channel of the .wav that contains the synchronization signal
+algorithm = name of the psync algorithm
+probe = probe id; if None, the probe id in the .bpr header is used
+auto_index = if True, do not use the .idx.txt file in psync and bpr2bmp
+deduplicate = if True, do not write bitmaps for duplicate frames
+"""
+    def __init__(self, bpr, channel=0, algorithm='impulse', probe=None,
+auto_index=False, deduplicate=True, summary=False, verbose=False):
+        self.bpr = os.path.abspath(bpr)
+        # Prefer a .wav with the .bpr extension removed, as psync does.
+        shortname = os.path.splitext(self.bpr)[0]
+        if os.path.isfile(shortname + '.wav'):
+            self.basename = shortname
+        else:
+            self.basename = self.bpr
+        self.wav = self.basename + '.wav'
+        self.statefile = self.bpr + '.pipeline.json'
+        self.channel = channel
+        self.algorithm = algorithm
+        self.probe_id = probe
+        self.auto_index = auto_index
+        self.deduplicate = deduplicate
+        self.summary = summary
+        self.verbose = verbose
+        self._wavreader = None
+        self._bprreader = None
+        self._converter = None
+        self.state = self.load_state()
+
+    @property
+    def wavreader(self):
+        """WavReader for the acquisition .wav, shared by all stages."""
+        if self._wavreader is None:
+            self._wavreader = WavReader(self.wav)
+        return self._wavreader
+
+    @property
+    def bprreader(self):
+        """BprReader for the acquisition .bpr, shared by all stages."""
+        if self._bprreader is None:
+            self._bprreader = ultratils.pysonix.bprreader.BprReader(self.bpr)
+        return self._bprreader
+
+    @property
+    def converter(self):
+        """Converter for the acquisition .bpr, shared by all stages."""
+        if self._converter is None:
+            self._converter = ultratils.pysonix.converters.get_converter(
+                self.bprreader.header, self.probe_id
+            )
+        return self._converter
+
+    def load_state(self):
+        """Load the per-stage completion record from the state file."""
+        try:
+            with open(self.statefile, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def save_state(self):
+        """Write the per-stage completion record to the state file."""
+        tmpname = self.statefile + '.tmp'
+        with open(tmpname, 'w') as f:
+            json.dump(self.state, f, indent=1, sort_keys=True)
+        if os.path.exists(self.statefile):
+            os.remove(self.statefile)
+        os.rename(tmpname, self.statefile)
+
+    def is_done(self, stage):
+        return self.state.get(stage, {}).get('status') == 'done'
+
+    def run(self, stages=None, force=False):
+        """Run stages in dependency order. Stages already recorded as done
+are skipped unless force is True. A stage is not run if any stage it
+depends on did not complete. Return the state dict."""
+        for stage in resolve_stages(stages):
+            if self.is_done(stage) and not force:
+                if self.verbose:
+                    sys.stderr.write("Skipping {:} for {:}.\n".format(stage, self.bpr))
+                continue
+            failed = [dep for dep in STAGES[stage] if not self.is_done(dep)]
+            if len(failed) > 0:
+                self.state[stage] = {
+                    'status': 'skipped',
+                    'reason': 'incomplete dependencies {:}'.format(','.join(failed))
+                }
+                self.save_state()
+                continue
+            if self.verbose:
+                sys.stderr.write("Running {:} for {:}.\n".format(stage, self.bpr))
+            start = time.time()
+            try:
+                with profiling.stage('pipeline_' + stage):
+                    result = getattr(self, 'do_' + stage)()
+                rec = {'status': 'done'}
+                if result is not None:
+                    rec.update(result)
+            except Exception as e:
+                sys.stderr.write("Error in {:} for {:}: {:}\n".format(stage, self.bpr, e))
+                rec = {'status': 'failed', 'error': str(e)}
+            rec['time'] = datetime.now().replace(microsecond=0).isoformat()
+            rec['elapsed'] = round(time.time() - start, 3)
+            self.state[stage] = rec
+            self.save_state()
+        self.close()
+        return self.state
+
+    def close(self):
+        """Release the readers used by the stages."""
+        if self._wavreader is not None:
+            self._wavreader.close()
+            self._wavreader = None
+        if self._bprreader is not None:
+            self._bprreader.close()
+
+    def do_sepchan(self):
+        """Separate the .wav channels into .chN.wav files."""
+        split_channels(self.wavreader, self.basename)
+
+    def do_psync(self):
+        """Detect the synchronization pulses and write the .sync files."""
+        idxfile = None
+        if not self.auto_index:
+            idxfile = "{}.idx.txt".format(self.basename)
+        ultratils.psync.sync2text(
+            self.wav, chan=self.channel, algorithm=self.algorithm,
+            outbasename=self.basename, received_indexes=idxfile,
+            summary=self.summary, wavreader=self.wavreader
+        )
+
+    def do_bpr2bmp(self):
+        """Scan-convert the .bpr frames to bitmaps."""
+        n = ultratils.pysonix.bmpwriter.convert_to_bmp(
+            self.bpr, auto_index=self.auto_index,
+            deduplicate=self.deduplicate, reader=self.bprreader,
+            converter=self.converter, verbose=self.verbose
+        )
+        return {'bitmaps': n}
+
+    def do_qc(self):
+        """Check the .bpr for white fan and frozen frames."""
+        white = ultratils.utils.is_white_bpr(self.bpr, self.bprreader)
+        frozen = ultratils.utils.is_frozen_bpr(self.bpr, self.bprreader)
+        if white or frozen:
+            sys.stderr.write("WARNING: bad bpr {:} (white={:}, frozen={:}).\n".format(
+                self.bpr, white, frozen
+            ))
+        return {'white': bool(white), 'frozen': bool(frozen)}
+
+def _run_job(args):
+    """Run an AcqJob; used as the worker pool function. Return the stage
+counters of the job along with its state so that they can be merged in the
+parent process. If profile is None the job is run in the calling process and
+the counters are left alone."""
+    (bpr, stages, force, options, profile) = args
+    if profile is not None:
+        profiling.enable(profile)
+        profiling.reset()
+    try:
+        state = AcqJob(bpr, **options).run(stages=stages, force=force)
+    except Exception as e:
+        sys.stderr.write("Error processing {:}: {:}\n".format(bpr, e))
+        state = {'error': str(e)}
+    return (bpr, state, profiling.summary())
+
+def run(dirs, stages=None, jobs=1, force=False, progress=False, **options):
+    """Run the pipeline on all acquisitions found in dirs.
+
+stages = list of stages to run (dependencies are added automatically);
+    default is all stages
+jobs = number of acquisitions to process concurrently
+force = if True, rerun stages that are already recorded as done
+progress = if True, periodically report acquisitions per second and ETA
+options = keyword arguments passed to AcqJob
+
+Returns a list of (bpr, state) tuples, one per acquisition. If profiling
+is enabled, the stage counters of all jobs are merged into the counters
+of the calling process.
+"""
+    resolve_stages(stages)   # Fail early on unknown stages.
+    bprs = find_bprs(dirs)
+    prog = None
+    if progress:
+        prog = profiling.Progress(len(bprs), label='acquisitions')
+    pool = None
+    if jobs is None or jobs > 1:
+        profile = profiling.enabled()
+        tasks = [(bpr, stages, force, options, profile) for bpr in bprs]
+        pool = multiprocessing.Pool(jobs)
+        jobiter = pool.imap_unordered(_run_job, tasks)
+    else:
+        profile = False   # Counters are already kept in this process.
+        tasks = [(bpr, stages, force, options, None) for bpr in bprs]
+        jobiter = (_run_job(task) for task in tasks)
+    results = []
+    try:
+        for (bpr, state, stats) in jobiter:
+            results.append((bpr, state))
+            if profile:
+                profiling.merge(stats)
+            if prog is not None:
+                prog.update()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return results
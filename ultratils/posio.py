@@ -0,0 +1,89 @@
+# Positional file reads that can be shared by threads.
+#
+# A PositionalFile reads with os.pread(), which takes an explicit offset and
+# does not move a shared file position, so one instance can be used by many
+# threads at once. On platforms without os.pread() the reads fall back to a
+# seek and read under a lock. The file descriptor is opened on first use and
+# stays open until close() is called; a closed PositionalFile reopens on
+# the next read.
+
+import os
+import threading
+
+_HAS_PREAD = hasattr(os, 'pread')
+
+class PositionalFile(object):
+    '''A read-only file that is read at explicit offsets.'''
+    def __init__(self, filename):
+        self.filename = os.path.abspath(filename)
+        self._fd = None
+        self._lock = threading.Lock()
+
+    @property
+    def closed(self):
+        return self._fd is None
+
+    def fileno(self):
+        '''Return the file descriptor, opening the file if necessary.'''
+        fd = self._fd
+        if fd is None:
+            with self._lock:
+                if self._fd is None:
+                    self._fd = os.open(
+                        self.filename, os.O_RDONLY | getattr(os, 'O_BINARY', 0)
+                    )
+                fd = self._fd
+        return fd
+
+    def pread(self, size, offset):
+        '''Return up to size bytes read at offset. Fewer bytes are returned
+only at the end of the file.'''
+        fd = self.fileno()
+        if not _HAS_PREAD:
+            with self._lock:
+                os.lseek(fd, offset, os.SEEK_SET)
+                return self._readall(fd, size)
+        chunks = []
+        while size > 0:
+            data = os.pread(fd, size, offset)
+            if len(data) == 0:
+                break
+            chunks.append(data)
+            size -= len(data)
+            offset += len(data)
+        return b''.join(chunks)
+
+    @staticmethod
+    def _readall(fd, size):
+        chunks = []
+        while size > 0:
+            data = os.read(fd, size)
+            if len(data) == 0:
+                break
+            chunks.append(data)
+            size -= len(data)
+        return b''.join(chunks)
+
+    def size(self):
+        '''Return the current size of the file.'''
+        return os.fstat(self.fileno()).st_size
+
+    def close(self):
+        '''Close the file descriptor. Later reads reopen the file.'''
+        with self._lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+    # Define __enter__ and __exit__ to create context manager.
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
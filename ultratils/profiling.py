@@ -0,0 +1,227 @@
+# Lightweight, opt-in instrumentation for ultratils processing stages.
+#
+# Readers, the Converter and the postprocessing functions report the
+# frames and bytes they process and the wall time they take, per named
+# stage, through stage() and count(). When instrumentation is disabled,
+# which is the default, stage() returns a shared do-nothing context manager
+# and count() returns immediately, so the calls can stay in production code.
+#
+# Enable instrumentation with enable() or by setting the ULTRATILS_PROFILE
+# environment variable to a non-zero value.
+
+import os, sys
+import json
+import time
+import platform
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+
+_enabled = os.environ.get('ULTRATILS_PROFILE', '') not in ('', '0')
+
+class StageStats(object):
+    '''Counters for one processing stage.'''
+    __slots__ = ('calls', 'seconds', 'frames', 'nbytes')
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.frames = 0
+        self.nbytes = 0
+
+    def as_dict(self):
+        d = OrderedDict([
+            ('calls', self.calls),
+            ('seconds', round(self.seconds, 6)),
+            ('frames', self.frames),
+            ('bytes', self.nbytes),
+        ])
+        if self.seconds > 0:
+            d['fps'] = round(self.frames / self.seconds, 3)
+            d['mb_per_s'] = round(self.nbytes / self.seconds / 1e6, 3)
+        return d
+
+# Stage name -> StageStats for this process. Stages run in several threads,
+# so the counters are only changed with _lock held.
+_stats = OrderedDict()
+_lock = threading.Lock()
+
+def enable(flag=True):
+    '''Turn instrumentation on (or off, if flag is False).'''
+    global _enabled
+    _enabled = bool(flag)
+
+def enabled():
+    '''Return True if instrumentation is on.'''
+    return _enabled
+
+def reset():
+    '''Clear all stage counters.'''
+    with _lock:
+        _stats.clear()
+
+def _get(name):
+    # Call with _lock held.
+    try:
+        return _stats[name]
+    except KeyError:
+        s = _stats[name] = StageStats()
+        return s
+
+def count(name, frames=0, nbytes=0):
+    '''Add frames and bytes to the counters of stage name, without timing.'''
+    if not _enabled:
+        return
+    with _lock:
+        s = _get(name)
+        s.calls += 1
+        s.frames += frames
+        s.nbytes += nbytes
+
+class _Timer(object):
+    __slots__ = ('name', 'frames', 'nbytes', 'start')
+    def __init__(self, name, frames, nbytes):
+        self.name = name
+        self.frames = frames
+        self.nbytes = nbytes
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        elapsed = time.time() - self.start
+        with _lock:
+            s = _get(self.name)
+            s.seconds += elapsed
+            s.calls += 1
+            s.frames += self.frames
+            s.nbytes += self.nbytes
+        return False
+
+class _NullTimer(object):
+    # frames and nbytes can be set as on a _Timer, and are ignored.
+    __slots__ = ('frames', 'nbytes')
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+_NULL_TIMER = _NullTimer()
+
+def stage(name, frames=0, nbytes=0):
+    '''Return a context manager that times its block and adds the time,
+frames and bytes to the counters of stage name. If the frames or bytes are
+known only at the end of the block, set the frames and nbytes attributes of
+the context manager inside the block.'''
+    if not _enabled:
+        return _NULL_TIMER
+    return _Timer(name, frames, nbytes)
+
+def summary():
+    '''Return the stage counters as a dict of dicts.'''
+    with _lock:
+        return OrderedDict([(name, s.as_dict()) for name, s in _stats.items()])
+
+def merge(stats):
+    '''Add the counters in stats, a dict returned by summary() in another
+process, to the counters of this process.'''
+    with _lock:
+        for name, d in stats.items():
+            s = _get(name)
+            s.calls += d['calls']
+            s.seconds += d['seconds']
+            s.frames += d['frames']
+            s.nbytes += d['bytes']
+
+def report(stream=sys.stderr):
+    '''Write a table of the stage counters to stream.'''
+    stream.write('{:<20s} {:>8s} {:>10s} {:>10s} {:>12s} {:>10s}\n'.format(
+        'stage', 'calls', 'seconds', 'frames', 'bytes', 'fps'
+    ))
+    for name, d in summary().items():
+        stream.write('{:<20s} {:>8d} {:>10.3f} {:>10d} {:>12d} {:>10}\n'.format(
+            name, d['calls'], d['seconds'], d['frames'], d['bytes'],
+            d.get('fps', '')
+        ))
+
+def write_profile(filename, **meta):
+    '''Write the stage counters and run metadata to a JSON file. Keyword
+arguments are stored as additional metadata.'''
+    prof = OrderedDict([
+        ('date', datetime.now().replace(microsecond=0).isoformat()),
+        ('argv', sys.argv),
+        ('python', platform.python_version()),
+        ('platform', platform.platform()),
+    ])
+    prof.update(meta)
+    prof['stages'] = summary()
+    with open(filename, 'w') as f:
+        json.dump(prof, f, indent=2)
+
+@contextmanager
+def cprofiled(filename=None):
+    '''Run the block under cProfile and dump the statistics to filename.
+Do nothing if filename is None.'''
+    if filename is None:
+        yield None
+        return
+    import cProfile
+    prof = cProfile.Profile()
+    prof.enable()
+    try:
+        yield prof
+    finally:
+        prof.disable()
+        prof.dump_stats(filename)
+
+class Progress(object):
+    '''Periodic progress report for long runs.
+
+Call update() as items are completed. At most every interval seconds a
+line is written to stream with the items done, the item rate, the
+frame rate of stage (if given and instrumentation is enabled) and the
+estimated time remaining. The frame rate counts only the frames of stage
+since the Progress was made.
+'''
+    def __init__(self, total, label='items', interval=10.0, stage=None, stream=sys.stderr):
+        self.total = total
+        self.label = label
+        self.interval = interval
+        self.stage = stage
+        self.stream = stream
+        self.done = 0
+        self.start = time.time()
+        self._last = self.start
+        self._frames0 = self._stage_frames()
+
+    def _stage_frames(self):
+        s = _stats.get(self.stage) if self.stage is not None else None
+        return s.frames if s is not None else 0
+
+    def update(self, n=1):
+        self.done += n
+        now = time.time()
+        if now - self._last >= self.interval or self.done == self.total:
+            self._last = now
+            self.stream.write(self.status(now) + '\n')
+
+    def status(self, now=None):
+        '''Return the progress line.'''
+        if now is None:
+            now = time.time()
+        elapsed = now - self.start
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        msg = '{:d}/{:d} {:s}, {:0.2f} {:s}/s'.format(
+            self.done, self.total, self.label, rate, self.label
+        )
+        if self.stage is not None and self.stage in _stats:
+            frames = self._stage_frames() - self._frames0
+            msg += ', {:0.1f} frames/s'.format(frames / elapsed if elapsed > 0 else 0.0)
+        if rate > 0 and self.done < self.total:
+            eta = (self.total - self.done) / rate
+            msg += ', ETA {:d}:{:02d}:{:02d}'.format(
+                int(eta // 3600), int(eta % 3600 // 60), int(eta % 60)
+            )
+        return msg
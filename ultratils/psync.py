@@ -1,9 +1,9 @@
 from __future__ import division
 import sys
 import numpy as np
-import wave
-from contextlib import closing
-import audiolabel
+from ultratils.wavreader import WavReader
+from ultratils.syncindex import write_sync_index, SYNC_INDEX_EXT
+from ultratils import profiling
 
 # Algorithms to detect synchronization pulses.
 
@@ -21,16 +21,16 @@ def pcm2float(sig, dtype=np.float64):
     # Therefore, we use '-min' here to avoid clipping.
     return sig.astype(dtype) / dtype.type(-np.iinfo(sig.dtype).min)
 
-def loadsync(wavfile, chan):
+def loadsync(wavfile, chan, wavreader=None):
     '''Load synchronization signal from an audio file channel and return as a normalized
-(range [-1 1]) 1D numpy array.'''
-    with closing(wave.open(wavfile)) as w:
-        nchannels = w.getnchannels()
-        assert w.getsampwidth() == 2
-        data = w.readframes(w.getnframes())
-        rate = w.getframerate()
-    sig = np.frombuffer(data, dtype='<i2').reshape(-1, nchannels)
-    return (pcm2float(sig[:,int(chan)], np.float32), rate)
+(range [-1 1]) 1D numpy array. If wavreader is an already open WavReader for
+wavfile it is used instead of opening the file again.'''
+    if wavreader is None:
+        with WavReader(wavfile) as w:
+            return loadsync(wavfile, chan, wavreader=w)
+    assert wavreader.sampwidth == 2
+    sig = pcm2float(wavreader.channel(chan), np.float32)
+    return (sig, wavreader.rate)
 
 def sync_pstretch(sig, threshold, min_run):
     '''Find and return indexes of synchronization points from pstretch unit,
@@ -68,7 +68,7 @@ percentage of the signal maximum.'''
         peaks[idx] = s + np.argmax(bounded[s:e])
     return peaks
     
-def sync2text(wavname, chan, algorithm, outbasename, received_indexes=None, summary=False):
+def sync2text(wavname, chan, algorithm, outbasename, received_indexes=None, summary=False, wavreader=None):
     '''Find the synchronization signals in an acquisition's .wav file and
 create a text file that contains frame numbers and time stamps for each pulse.
 
@@ -77,13 +77,19 @@ algorithm = name of sync algorithm
 received_indexes = filename of an index file containing the indexes of the
    data frames received during acquisition
 outbasename = basename for output synchronization files, which will consist of
-   outbasename + '.sync.(txt|TextGrid)'
+   outbasename + '.sync.(txt|TextGrid|npz)'; the .npz file is a binary
+   ultratils.syncindex index of the pulses
+wavreader = an already open WavReader for wavname, to be reused
 '''
-    (syncsig, rate) = loadsync(wavname, chan)
-    if algorithm == 'impulse':
-        syncsamp = sync_impulse(syncsig)
-    elif algorithm == 'pstretch':
-        syncsamp = sync_pstretch(syncsig, NORM_SYNC_THRESH, MIN_SYNC_TIME * rate)
+    import audiolabel
+    with profiling.stage('psync_load') as timer:
+        (syncsig, rate) = loadsync(wavname, chan, wavreader=wavreader)
+        timer.nbytes = syncsig.size * 2
+    with profiling.stage('psync_detect'):
+        if algorithm == 'impulse':
+            syncsamp = sync_impulse(syncsig)
+        elif algorithm == 'pstretch':
+            syncsamp = sync_pstretch(syncsig, NORM_SYNC_THRESH, MIN_SYNC_TIME * rate)
     synctimes = np.round(syncsamp / rate, decimals=4)
     if summary is True:
         sys.stderr.write("Found {0:d} synchronization pulses.\n".format(len(syncsamp)))
@@ -114,6 +120,9 @@ outbasename = basename for output synchronization files, which will consist of
         lm.add(raw_data_tier)
         raw_data_tier.add(audiolabel.Label(t1=0.0, t2=synctimes[0], text=''))
     t1 = synctimes[0]
+    pulse_t1 = np.zeros(len(synctimes))
+    pulse_t2 = np.zeros(len(synctimes))
+    pulse_raw = np.full(len(synctimes), -1, dtype=np.int32)
     with open(txtname, 'w') as fout:
         if received_indexes is None:
             fout.write("seconds\tpulse_idx\n")
@@ -138,8 +147,12 @@ outbasename = basename for output synchronization files, which will consist of
             except IndexError:
                 t2 = t + dtimes.min()
             pulse_tier.add(audiolabel.Label(t1=t1, t2=t2, text=str(idx)))
+            pulse_t1[idx] = t1
+            pulse_t2[idx] = t2
             if received_indexes is not None:
                 raw_data_tier.add(audiolabel.Label(t1=t1, t2=t2, text=str(dframe)))
+                if dframe != 'NA':
+                    pulse_raw[idx] = dframe
             t1 = t2
             last_frame += 1
     t2 = t1 + dtimes.min()
@@ -152,6 +165,12 @@ outbasename = basename for output synchronization files, which will consist of
             raw_data_tier.end = t2
     with open(tgname, 'w') as tgout:
         tgout.write(lm.as_string(fmt="praat_long"))
+    # Written after the TextGrid so that it is not older than the TextGrid.
+    write_sync_index(
+        outbasename + SYNC_INDEX_EXT, pulse_t1, pulse_t2,
+        pulse_raw if received_indexes is not None else None,
+        end=pulse_tier.end
+    )
  
 
 
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+# Write the frames of a .bpr file to indexed bitmaps.
+
+import os, sys
+import hashlib
+import numpy as np
+try:  # Python 2
+    import Image
+except ImportError:  # Python 3
+    from PIL import Image
+
+import ultratils.pysonix.bprreader
+import ultratils.pysonix.converters
+import ultratils.enhance
+from ultratils import profiling
+
+def bitmap_for_bpr_exists(bpr):
+    """Return true if one or more bitmap files exist for a .bpr file."""
+    return os.path.isfile(os.path.splitext(bpr)[0] + '.0.bmp')
+
+def convert_to_bmp(bpr, probe=None, auto_index=False, deduplicate=True, reader=None, converter=None, verbose=False, enhance=None):
+    """Convert the frames in a bpr file to bitmaps.
+
+probe = Probe object; if None, use the probe id in the .bpr header
+auto_index = if True, number bitmaps sequentially instead of using the
+    .idx.txt file
+deduplicate = if True, do not write bitmaps for duplicate frames
+reader = an already open BprReader for bpr, to be reused
+converter = an already constructed Converter for bpr, to be reused
+enhance = optional ultratils.enhance.Chain or spec string; frames are
+    enhanced in batches before conversion
+
+Returns the number of bitmaps written.
+"""
+    barename = os.path.splitext(bpr)[0]   # get filename without extension
+    if reader is None:
+        reader = ultratils.pysonix.bprreader.BprReader(bpr)
+    header = reader.header
+    if converter is None:
+        converter = ultratils.pysonix.converters.get_converter(header, probe)
+
+    if not auto_index:
+        idxfile = "{}.idx.txt".format(bpr)
+        indexes = np.loadtxt(idxfile, dtype=int, ndmin=1)
+        # Create a gray image as a skipped frame filler.
+        blankbpr = converter.default_bpr_frame(0)
+        blank = converter.convert(blankbpr).astype(np.uint8)
+        blank = Image.fromarray(np.flipud(blank))
+        last_frame = -1
+
+    if deduplicate:
+        fhashes = {}
+    if enhance is not None:
+        chain = ultratils.enhance.as_chain(enhance).for_reader(reader)
+        frames = chain.iter_frames(reader)
+    else:
+        frames = ((idx, reader.get_frame(idx)) for idx in range(reader.nframes))
+    nwritten = 0
+    for (idx, bprdata) in frames:
+        data = np.flipud(converter.convert(bprdata))
+        if deduplicate:
+            h = hashlib.sha1(data.copy(order="c")).hexdigest()
+            if h in fhashes.keys():
+                if verbose:
+                    msg = "Frame {:d} is a duplicate of {:d}. Skipping.\n".format(idx, fhashes[h])
+                    sys.stderr.write(msg)
+                continue
+            fhashes[h] = idx
+        with profiling.stage('bmp_encode', frames=1, nbytes=data.size):
+            frame = Image.fromarray(data.astype(np.uint8))
+            if auto_index:
+                frame.save("{:s}.{:d}.bmp".format(barename, idx))
+            else:
+                for n in range(indexes[idx] - last_frame - 1):
+                    last_frame += 1
+                    blank.save("{:s}.{:d}.bmp".format(barename, last_frame))
+                    nwritten += 1
+                last_frame += 1
+                frame.save("{:s}.{:d}.bmp".format(barename, last_frame))
+        nwritten += 1
+    return nwritten
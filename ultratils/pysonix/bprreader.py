@@ -1,9 +1,13 @@
 #!/usr/bin/env python
 
 import os
+import io
 import struct
 import numpy as np
 import hashlib
+from ultratils.archive import is_archive, ArchiveReader
+from ultratils.posio import PositionalFile
+from ultratils import profiling
 
 class Header(object):
     def __init__(self, filehandle):
@@ -26,11 +30,30 @@ class Header(object):
                 idx += 1
 
 class BprReader:
+    '''Reader for .bpr files.
+
+    Frames are read with positional reads, so get_frame() can be called
+    from several threads on the same reader. Iteration with next() keeps a
+    per-reader position and should be done by one thread only. The file is
+    opened on the first frame read and stays open until close() is called
+    or the reader is used as a context manager.
+    '''
     def __init__(self, filename, checksum=False):
         self.filename = os.path.abspath(filename)
-        self._fhandle = None
-        self.open()
-        self.header = Header(self._fhandle)
+        self._file = None
+        # Compressed frame archives are read transparently.
+        self._archive = None
+        if is_archive(self.filename):
+            self._archive = ArchiveReader(self.filename)
+            if self._archive.kind != 'bpr':
+                raise ValueError('{:} is not a .bpr archive.'.format(filename))
+            self.header = Header(io.BytesIO(self._archive.header_bytes))
+        else:
+            self._file = PositionalFile(self.filename)
+            self.header = Header(io.BytesIO(self._file.pread(19 * 4, 0)))
+            # Readers are often created only for their header; do not hold
+            # the descriptor until a frame is read.
+            self._file.close()
         # TODO: when we have more image readers other than bpr, they all should
         # have attributes for the image height and width, number of frames, and
         # data type (i.e. the numeric type of the data values), and we make
@@ -51,47 +74,132 @@ class BprReader:
         if checksum:
             for idx in range(self.header.nframes):
                 print("working on {:d}".format(idx))
-                data = self.get_frame()
+                data = self.get_frame(idx)
                 csum = hashlib.sha1(data.copy(order="c")).hexdigest()
                 if csum in self.csums:
                     "Frame {:d} is a duplicate!".format(idx)
                 self.csums[idx] = csum
-        self._fhandle.seek(self.header.packed_size)
-        self._cursor = self._fhandle.tell()
-        self.close()
+        # Index of the next frame returned by next().
+        self._cursor = 0
 
     def __iter__(self):
         return self
 
     def next(self):
         '''Get the next image frame.'''
-        if self._fhandle is None:
-            self.open()
+        idx = self._cursor
+        if idx >= self.nframes:
+            raise StopIteration
         try:
-            self._fhandle.seek(self._cursor)
-            packed_data = self._fhandle.read(self.framesize)
-            data = np.array(struct.unpack(self.data_fmt, packed_data))
-        except struct.error:   # ran out of data to unpack()
+            data = self.get_frame(idx)
+        except IndexError:   # file is shorter than the header says
             raise StopIteration
-        self._cursor = self._fhandle.tell()
-        return data.reshape([self.header.w, self.header.h]).T
+        self._cursor = idx + 1
+        return data
+
+    __next__ = next
  
     def get_frame(self, idx=None):
-        '''Get the image frame specified by idx. Do not advance the read location of _fhandle.'''
-        if self._fhandle is None:
-            self.open()
-        self._fhandle.seek(self.header.packed_size + (idx * self.framesize))
-        packed_data = self._fhandle.read(self.framesize)
-        self._fhandle.seek(self._cursor)
-        data = np.array(struct.unpack(self.data_fmt, packed_data))
+        '''Get the image frame specified by idx. Does not change the position
+used by next(), and is safe to call from several threads.'''
+        if self._archive is not None:
+            data = self._archive.get_frame(idx).astype(int)
+            return data.reshape([self.header.w, self.header.h]).T
+        if idx < 0:
+            raise IndexError('{:}'.format(idx))
+        with profiling.stage('bprreader', frames=1, nbytes=self.framesize):
+            packed_data = self._file.pread(
+                self.framesize, self.header.packed_size + idx * self.framesize
+            )
+            if len(packed_data) != self.framesize:
+                raise IndexError('{:}'.format(idx))
+            data = np.frombuffer(packed_data, dtype=np.uint8).astype(int)
         return data.reshape([self.header.w, self.header.h]).T
 
+    def _frames_view(self, start, stop):
+        '''Return a memory map of frames start to stop - 1 in the file
+layout, (n, w, h).'''
+        nbytes = os.path.getsize(self.filename) - self.header.packed_size
+        nframes = min(self.nframes, nbytes // self.framesize)
+        (start, stop, step) = slice(start, stop).indices(nframes)
+        if stop <= start:
+            return np.zeros([0, self.header.w, self.header.h], dtype=np.uint8)
+        return np.memmap(
+            self.filename, dtype=np.uint8, mode='r',
+            offset=self.header.packed_size + start * self.framesize,
+            shape=(stop - start, self.header.w, self.header.h)
+        )
+
+    def get_roi(self, roi=None, start=0, stop=None):
+        '''Return frames start to stop - 1 cropped to roi as a uint8 array of
+shape (n, rows, cols).
+
+roi = (top, bottom, left, right) in the rows (samples) and columns
+    (scanlines) of get_frame(); bottom and right are exclusive and None means
+    the frame edge
+
+Each scanline is stored contiguously, so only the bytes of the selected
+scanlines are read, and only the selected samples are copied. Unlike
+get_frame(), the frames keep their uint8 data type.'''
+        (top, bottom, left, right) = roi if roi is not None else (None,) * 4
+        if self._archive is not None:
+            frames = self._archive.get_frames(start, stop)
+            frames = frames.reshape(-1, self.header.w, self.header.h)
+        else:
+            frames = self._frames_view(start, stop)
+        block = frames[:, left:right, top:bottom]
+        with profiling.stage('bprreader_roi', frames=len(block), nbytes=block.size):
+            return np.ascontiguousarray(block.transpose(0, 2, 1))
+
+    def get_scanlines(self, scanlines, start=0, stop=None, average=False, copy=True):
+        '''Return the samples of one or more scanlines in frames start to
+stop - 1, e.g. for an M-mode display.
+
+scanlines = a scanline index (a column of get_frame()), or a sequence of them
+average = if True, return the mean of the scanlines as float32
+copy = if False, a single scanline is returned as a read-only view of the
+    memory-mapped file
+
+Returns an array of shape (samples, frames) for a single scanline or with
+average, and (nscanlines, samples, frames) otherwise. Only the bytes of
+the selected scanlines are read.'''
+        if self._archive is not None:
+            frames = self._archive.get_frames(start, stop)
+            frames = frames.reshape(-1, self.header.w, self.header.h)
+        else:
+            frames = self._frames_view(start, stop)
+        single = np.ndim(scanlines) == 0
+        if single:
+            view = frames[:, int(scanlines), :].T
+            return np.array(view) if copy else view
+        block = frames[:, np.asarray(scanlines, dtype=np.intp), :]
+        with profiling.stage('bprreader_scanlines', frames=len(block), nbytes=block.size):
+            if average:
+                return block.mean(axis=1, dtype=np.float32).T.copy()
+            return np.ascontiguousarray(block.transpose(1, 2, 0))
+
+    @property
+    def closed(self):
+        '''True if the reader holds no open file descriptor.'''
+        if self._archive is not None:
+            return self._archive.closed
+        return self._file.closed
+
     def open(self):
-        self._fhandle = open(self.filename, 'rb')
+        '''Open the file. Not normally needed; reads open the file on demand.'''
+        if self._archive is None:
+            self._file.fileno()
 
     def close(self):
-        try:
-            self._fhandle.close()
-            self._fhandle = None
-        except Exception as e:
-            raise e
+        '''Close the file. The reader reopens it if it is read again.'''
+        if self._archive is not None:
+            self._archive.close()
+            return
+        self._file.close()
+
+    # Define __enter__ and __exit__ to create context manager.
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
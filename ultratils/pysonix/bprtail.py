@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+
+# Follow a .bpr file that is still being written and hand its frames to a
+# monitor process through a shared-memory ring buffer.
+
+import os, sys
+import time
+import select
+import struct
+import ctypes
+import ctypes.util
+import numpy as np
+try:
+    from multiprocessing import shared_memory   # Python >= 3.8
+except ImportError:
+    shared_memory = None
+
+from ultratils.pysonix.bprreader import Header
+
+# inotify event masks, from <sys/inotify.h>.
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+
+class BprTailError(Exception):
+    """Base class for errors in this module."""
+    def __init__(self, msg):
+        self.msg = msg
+    def __str__(self):
+        return repr(self.msg)
+
+class _GrowthWaiter(object):
+    '''Block until a file is modified. Use inotify on Linux and fall back to
+polling at poll_interval elsewhere.'''
+    def __init__(self, filename, poll_interval=0.02):
+        self.poll_interval = poll_interval
+        self._fd = None
+        if sys.platform.startswith('linux'):
+            try:
+                libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+                fd = libc.inotify_init()
+                if fd >= 0:
+                    wd = libc.inotify_add_watch(
+                        fd, filename.encode(sys.getfilesystemencoding()),
+                        IN_MODIFY | IN_CLOSE_WRITE
+                    )
+                    if wd >= 0:
+                        self._fd = fd
+                    else:
+                        os.close(fd)
+            except (OSError, AttributeError):
+                self._fd = None
+
+    @property
+    def uses_inotify(self):
+        return self._fd is not None
+
+    def wait(self, timeout):
+        '''Wait at most timeout seconds for the file to change.'''
+        if self._fd is not None:
+            (ready, w, x) = select.select([self._fd], [], [], timeout)
+            if ready:
+                os.read(self._fd, 4096)   # Drain queued events.
+        else:
+            time.sleep(min(self.poll_interval, timeout))
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+class BprTail(object):
+    '''Reader for a .bpr file that is still growing.
+
+    The number of available frames is calculated from the file size rather
+    than taken from the header, which is not final until acquisition ends.
+    follow() yields frames as soon as they are completely written.
+
+    Parameters
+    ----------
+    filename : str
+    The .bpr file to follow. It need not exist yet.
+
+    poll_interval : float (default 0.02)
+    Seconds between file size checks when inotify is not available.
+
+    idle_timeout : float (default 5.0)
+    follow() stops when the file has not grown for this many seconds. Use
+    None to follow forever.
+
+    '''
+    def __init__(self, filename, poll_interval=0.02, idle_timeout=5.0):
+        self.filename = os.path.abspath(filename)
+        self.poll_interval = poll_interval
+        self.idle_timeout = idle_timeout
+        self.header = None
+        self._fhandle = None
+        self.hdrsize = struct.calcsize('I' * 19)
+
+    def _wait_for(self, nbytes, waiter):
+        '''Wait until the file is at least nbytes long. Return False if the
+idle timeout expires first.'''
+        last_growth = time.time()
+        last_size = -1
+        while True:
+            try:
+                size = os.stat(self.filename).st_size
+            except OSError:
+                size = 0
+            if size >= nbytes:
+                return True
+            now = time.time()
+            if size != last_size:
+                last_size = size
+                last_growth = now
+            elif self.idle_timeout is not None and \
+                 now - last_growth > self.idle_timeout:
+                return False
+            waiter.wait(self.poll_interval * 10)
+
+    def open(self):
+        '''Open the file and read the header, waiting for it if necessary.'''
+        if self._fhandle is not None:
+            return
+        waiter = _GrowthWaiter(os.path.dirname(self.filename), self.poll_interval)
+        try:
+            if not self._wait_for(self.hdrsize, waiter):
+                raise BprTailError('No header found in {:}.'.format(self.filename))
+        finally:
+            waiter.close()
+        self._fhandle = open(self.filename, 'rb')
+        self.header = Header(self._fhandle)
+        if self.header.filetype != 2:
+            msg = "Unexpected filetype! Expected 2 and got {filetype:d}"
+            raise ValueError(msg.format(filetype=self.header.filetype))
+        self.h = self.header.h
+        self.w = self.header.w
+        self.framesize = self.h * self.w
+
+    def close(self):
+        if self._fhandle is not None:
+            self._fhandle.close()
+            self._fhandle = None
+
+    def available_frames(self):
+        '''Return the number of complete frames currently in the file.'''
+        self.open()
+        size = os.fstat(self._fhandle.fileno()).st_size
+        return max(0, (size - self.hdrsize) // self.framesize)
+
+    def get_frame(self, idx):
+        '''Get the frame specified by idx, which must be available.'''
+        self.open()
+        self._fhandle.seek(self.hdrsize + idx * self.framesize)
+        data = np.frombuffer(self._fhandle.read(self.framesize), dtype=np.uint8)
+        return data.reshape([self.w, self.h]).T
+
+    def follow(self, start=0):
+        '''Yield (idx, frame) tuples for each frame from start onward as the
+frames become available. Stop when the file has been idle for idle_timeout
+seconds.'''
+        self.open()
+        waiter = _GrowthWaiter(self.filename, self.poll_interval)
+        idx = start
+        last_growth = time.time()
+        try:
+            while True:
+                navail = self.available_frames()
+                if navail > idx:
+                    for i in range(idx, navail):
+                        yield (i, self.get_frame(i))
+                    idx = navail
+                    last_growth = time.time()
+                    continue
+                if self.idle_timeout is not None:
+                    remaining = self.idle_timeout - (time.time() - last_growth)
+                    if remaining <= 0:
+                        break
+                    waiter.wait(remaining)
+                else:
+                    waiter.wait(1.0)
+        finally:
+            waiter.close()
+
+class FrameRing(object):
+    '''Ring buffer of image frames in shared memory.
+
+    A single writer process puts frames in the ring, and any number of
+    monitor processes attach to it by name and read the most recent frame.
+
+    Parameters
+    ----------
+    shape : tuple
+    The (h, w) shape of the frames. Required when creating a ring.
+
+    nslots : int (default 8)
+    The number of frames held in the ring.
+
+    name : str
+    The name of an existing ring to attach to. If None, create a new ring.
+
+    '''
+    # Header layout: [write count, nslots, h, w], as int64.
+    NHDR = 4
+
+    def __init__(self, shape=None, nslots=8, name=None):
+        if shared_memory is None:
+            raise BprTailError('FrameRing requires Python 3.8 or later.')
+        hdrbytes = self.NHDR * 8
+        if name is None:
+            (h, w) = shape
+            size = hdrbytes + nslots * 8 + nslots * h * w
+            self._shm = shared_memory.SharedMemory(create=True, size=size)
+            self._owner = True
+            hdr = np.ndarray([self.NHDR], dtype=np.int64, buffer=self._shm.buf)
+            hdr[:] = [0, nslots, h, w]
+        else:
+            self._shm = shared_memory.SharedMemory(name=name)
+            self._owner = False
+            hdr = np.ndarray([self.NHDR], dtype=np.int64, buffer=self._shm.buf)
+            (nslots, h, w) = [int(v) for v in hdr[1:]]
+        self.name = self._shm.name
+        self.nslots = nslots
+        self.shape = (h, w)
+        self._hdr = hdr
+        self._idx = np.ndarray(
+            [nslots], dtype=np.int64, buffer=self._shm.buf, offset=hdrbytes
+        )
+        self._frames = np.ndarray(
+            [nslots, h, w], dtype=np.uint8, buffer=self._shm.buf,
+            offset=hdrbytes + nslots * 8
+        )
+
+    @property
+    def count(self):
+        '''The total number of frames put in the ring.'''
+        return int(self._hdr[0])
+
+    def put(self, idx, frame):
+        '''Put frame with frame index idx in the next slot.'''
+        count = int(self._hdr[0])
+        slot = count % self.nslots
+        self._frames[slot] = frame
+        self._idx[slot] = idx
+        self._hdr[0] = count + 1
+
+    def latest(self):
+        '''Return an (idx, frame) tuple with a copy of the most recent frame,
+or None if no frame has been put in the ring yet.'''
+        while True:
+            count = int(self._hdr[0])
+            if count == 0:
+                return None
+            slot = (count - 1) % self.nslots
+            frame = self._frames[slot].copy()
+            idx = int(self._idx[slot])
+            # Retry if the writer lapped the slot while we copied it.
+            if int(self._hdr[0]) - count < self.nslots - 1:
+                return (idx, frame)
+
+    def close(self):
+        '''Detach from the ring. The creating process also frees it.'''
+        self._hdr = self._idx = self._frames = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+def feed_ring(tail, ring, converter=None, start=0):
+    '''Follow tail and put each new frame in ring, scan-converted by
+converter if it is not None. Return the number of frames fed.'''
+    n = 0
+    for idx, frame in tail.follow(start):
+        if converter is not None:
+            frame = converter.convert(frame)
+        ring.put(idx, frame)
+        n += 1
+    return n
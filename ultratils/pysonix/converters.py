@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+# Process-wide registry of scan Converters, keyed on frame geometry.
+#
+# Building a Converter computes the mapping for every bitmap pixel, and
+# acquisitions in an experiment usually share a small number of distinct
+# geometries. get_converter() returns a cached Converter for a header and
+# probe, building one only for a geometry that has not been seen recently.
+# The key covers every value the Converter mapping depends on, so that
+# acquisitions with the same frame size but a different sampling frequency
+# or probe do not share a Converter.
+
+import threading
+from collections import OrderedDict
+
+import ultratils.pysonix.probe
+
+# Default number of Converters kept, least recently used first out.
+MAXSIZE = 8
+
+_cache = OrderedDict()
+_lock = threading.Lock()
+_maxsize = MAXSIZE
+_hits = 0
+_misses = 0
+
+def as_probe(probe):
+    '''Return probe as a Probe object. probe may be a Probe or a probe id.'''
+    if isinstance(probe, ultratils.pysonix.probe.Probe):
+        return probe
+    return ultratils.pysonix.probe.Probe(probe)
+
+def geometry_key(header, probe, ppmm=2):
+    '''Return the registry key for a bpr header, Probe and ppmm.'''
+    return (
+        int(header.h), int(header.w), int(header.sf),
+        int(probe.pitch), int(probe.radius), int(probe.numElements),
+        ppmm
+    )
+
+def get_converter(header, probe=None, ppmm=2):
+    '''Return a Converter for header and probe, reusing a cached Converter
+with the same geometry if there is one.
+
+header = bpr header
+probe = Probe object or probe id; if None, the probe id in header is used
+ppmm = bitmap pixels per mm
+
+The returned Converter is shared; its conversion methods return new arrays
+and can be called from several threads.
+'''
+    global _hits, _misses
+    if probe is None:
+        probe = header.probe
+    probe = as_probe(probe)
+    key = geometry_key(header, probe, ppmm)
+    with _lock:
+        try:
+            conv = _cache.pop(key)
+            _hits += 1
+        except KeyError:
+            import ultratils.pysonix.scanconvert
+            conv = ultratils.pysonix.scanconvert.Converter(header, probe, ppmm)
+            _misses += 1
+        _cache[key] = conv
+        while len(_cache) > _maxsize:
+            _cache.popitem(last=False)
+    return conv
+
+def matches(converter, header, probe=None, ppmm=2):
+    '''Return True if converter has the geometry of header and probe.'''
+    if probe is None:
+        probe = header.probe
+    return geometry_key(converter.header, converter.probe, converter.ppmm) == \
+        geometry_key(header, as_probe(probe), ppmm)
+
+def set_maxsize(n):
+    '''Set the number of Converters kept in the registry.'''
+    global _maxsize
+    with _lock:
+        _maxsize = max(0, int(n))
+        while len(_cache) > _maxsize:
+            _cache.popitem(last=False)
+
+def clear():
+    '''Remove all Converters from the registry and reset the counters.'''
+    global _hits, _misses
+    with _lock:
+        _cache.clear()
+        _hits = 0
+        _misses = 0
+
+def info():
+    '''Return a dict of registry hits, misses, size and maxsize.'''
+    with _lock:
+        return {
+            'hits': _hits, 'misses': _misses,
+            'size': len(_cache), 'maxsize': _maxsize
+        }
@@ -1,7 +1,19 @@
 #!/usr/bin/env python
 
 import xml.etree.ElementTree as ET
-import pkg_resources
+import pkgutil
+
+# Parsed probes.xml, shared by all Probe objects.
+_probes_root = None
+
+def probes_root():
+    '''Return the parsed probes.xml root element.'''
+    global _probes_root
+    if _probes_root is None:
+        _probes_root = ET.fromstring(
+            pkgutil.get_data('ultratils.pysonix', 'data/probes.xml')
+        )
+    return _probes_root
 
 # TODO: make this inherit from a base Probe class that has pitch and radius attributes.
 class Probe:
@@ -12,9 +24,8 @@ class Probe:
 
     def probe_for_id(self, id):
         '''Populate a Probe by id. For now we only get the elements we know we need.'''
-        root = ET.fromstring(
-            pkg_resources.resource_string('ultratils.pysonix', 'data/probes.xml')
-        )
+        root = probes_root()
+        self.id = id
         self.name = root.find('.//probe[@id="{}"]'.format(id)).get('name')
         self.pitch = int(root.find('.//probe[@id="{}"]/pitch'.format(id)).text)
         self.radius = int(root.find('.//probe[@id="{}"]/radius'.format(id)).text)
@@ -1,40 +1,134 @@
 # Class for converting from .bpr (pre-scan converted b-mode data)
 
-import sys
+import os, sys
 import numpy as np
 cimport numpy as np
-NPINT = np.int
-ctypedef np.int_t NPINT_t
-NPFLOAT = np.float
-ctypedef np.float_t NPFLOAT_t
-NPLONG = np.long
-ctypedef np.long_t NPLONG_t
-
-cdef cart2pol(NPFLOAT_t x, NPFLOAT_t y):
-    """Convert from cartesian to radian polar coordinates."""
-    cdef NPFLOAT_t radius = np.hypot(x,y)
-    cdef NPFLOAT_t theta = np.arctan2(y,x)
-    return theta, radius
-
-cdef pol2cart(NPFLOAT_t radius, NPFLOAT_t theta):
-    """Convert from polar to cartesian coordinates."""
-    x = radius * np.cos(theta)
-    y = radius * np.sin(theta)
-    return x, y
+cimport cython
+from ultratils import profiling
+NPINT = np.intp
+ctypedef np.intp_t NPINT_t
+NPFLOAT = np.float64
+ctypedef np.float64_t NPFLOAT_t
+NPLONG = np.int64
+ctypedef np.int64_t NPLONG_t
 
+# Pixel types handled by the compiled remapping kernel. Frames of other
+# types are converted with numpy indexing.
+ctypedef fused pixel_t:
+    np.uint8_t
+    np.uint16_t
+    np.int16_t
+    np.int32_t
+    np.int64_t
+    np.float32_t
+    np.float64_t
+
+KERNEL_DTYPES = frozenset(np.dtype(t) for t in (
+    np.uint8, np.uint16, np.int16, np.int32, np.int64, np.float32, np.float64
+))
+
+class ConverterError(Exception):
+    """Base class for errors in this module."""
+    def __init__(self, msg):
+        self.msg = msg
+    def __str__(self):
+        return repr(self.msg)
+
+def cart2pol(x, y):
+    """Convert from cartesian to radian polar coordinates. x and y may be
+scalars or arrays. Return (theta, radius)."""
+    return np.arctan2(y, x), np.hypot(x, y)
+
+def pol2cart(radius, theta):
+    """Convert from polar to cartesian coordinates. radius and theta may be
+scalars or arrays. Return (x, y)."""
+    return radius * np.cos(theta), radius * np.sin(theta)
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _remap(const pixel_t[:, ::1] src, pixel_t[:, ::1] dst,
+const NPINT_t[::1] src_index, const NPINT_t[::1] dst_index,
+pixel_t bgcolor) noexcept nogil:
+    """Fill each frame in dst with bgcolor, then copy the src_index pixels
+of the corresponding src frame to the dst_index pixels. Frames are flattened
+to rows. The indexes must be in bounds; they are not checked."""
+    cdef Py_ssize_t f, i
+    cdef Py_ssize_t n = src_index.shape[0]
+    for f in range(src.shape[0]):
+        for i in range(dst.shape[1]):
+            dst[f, i] = bgcolor
+        for i in range(n):
+            dst[f, dst_index[i]] = src[f, src_index[i]]
+
+def remap_frames(const pixel_t[:, ::1] src, pixel_t[:, ::1] dst,
+const NPINT_t[::1] src_index, const NPINT_t[::1] dst_index, double bgcolor=0):
+    """Remap a stack of flattened frames without holding the GIL.
+
+src = (nframes, npixels) C-contiguous input frames
+dst = (nframes, npixels_out) C-contiguous output frames of the same dtype
+src_index, dst_index = intp arrays of equal length; pixel src_index[i] of
+    each src frame is copied to pixel dst_index[i] of the dst frame
+bgcolor = value of dst pixels that are not in dst_index
+"""
+    if src.shape[0] != dst.shape[0]:
+        raise ConverterError('Input and output frame counts differ.')
+    if src_index.shape[0] != dst_index.shape[0]:
+        raise ConverterError('Index arrays differ in length.')
+    _check_index(src_index, src.shape[1], 'Input')
+    _check_index(dst_index, dst.shape[1], 'Output')
+    cdef pixel_t bg = <pixel_t>bgcolor
+    with nogil:
+        _remap(src, dst, src_index, dst_index, bg)
+
+def _check_index(index, size, name):
+    """Raise ConverterError if an index array has entries outside 0..size-1."""
+    if len(index) > 0 and (np.min(index) < 0 or np.max(index) >= size):
+        raise ConverterError('{:} index out of bounds.'.format(name))
+
+def _remap_checked_indexes(const pixel_t[:, ::1] src, pixel_t[:, ::1] dst,
+const NPINT_t[::1] src_index, const NPINT_t[::1] dst_index, double bgcolor=0):
+    """Like remap_frames(), for indexes that were checked once against the
+frame sizes when they were made. The index arrays are not scanned, so the
+caller must make sure that the frames have those sizes."""
+    if src.shape[0] != dst.shape[0]:
+        raise ConverterError('Input and output frame counts differ.')
+    cdef pixel_t bg = <pixel_t>bgcolor
+    with nogil:
+        _remap(src, dst, src_index, dst_index, bg)
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
 cpdef scanconvert(np.ndarray[NPLONG_t, ndim=2] Iin, indt=None, indr=None):
     '''Convert data from a .bpr to image data.'''
     framedim = indt.shape
     cdef np.ndarray[NPLONG_t, ndim=2] Iout = np.zeros(framedim, dtype=NPLONG)
-    cdef int xCntr, yCntr, indt_, indr_
-    for xCntr in np.arange(0, framedim[1]):
-        for yCntr in np.arange(0, framedim[0]):
-            indt_ = indt[yCntr, xCntr]
-            indr_ = indr[yCntr, xCntr]
-            if indt_>0 and indt_<Iin.shape[1] and indr_>0 and indr_<Iin.shape[0]:
-                Iout[yCntr, xCntr] = Iin[indr_, indt_]
+    cdef const NPINT_t[:, :] t = np.asarray(indt, dtype=NPINT)
+    cdef const NPINT_t[:, :] r = np.asarray(indr, dtype=NPINT)
+    cdef NPLONG_t[:, :] src = Iin
+    cdef NPLONG_t[:, :] out = Iout
+    cdef Py_ssize_t xCntr, yCntr, indt_, indr_
+    cdef Py_ssize_t nt = Iin.shape[1], nr = Iin.shape[0]
+    with nogil:
+        for yCntr in range(t.shape[0]):
+            for xCntr in range(t.shape[1]):
+                indt_ = t[yCntr, xCntr]
+                indr_ = r[yCntr, xCntr]
+                if indt_>0 and indt_<nt and indr_>0 and indr_<nr:
+                    out[yCntr, xCntr] = src[indr_, indt_]
     return Iout
 
+# Thread pools used by Converter.convert_stack, keyed by number of threads.
+_pools = {}
+
+def _thread_pool(nthreads):
+    """Return a shared pool of nthreads worker threads."""
+    try:
+        return _pools[nthreads]
+    except KeyError:
+        from concurrent.futures import ThreadPoolExecutor
+        pool = _pools[nthreads] = ThreadPoolExecutor(nthreads)
+        return pool
+
 class Converter(object):
     """Converter for bpr to bmp frame data.
 On construction this object calculates and caches the mapping from bpr
@@ -92,70 +186,310 @@ probe = Probe object
         xreg = np.arange(np.min(self.x), np.max(self.x), step=1e-3/self.ppmm)
         yreg = np.arange(np.min(self.y), np.max(self.y), step=1e-3/self.ppmm)
         [yreg, xreg] = np.meshgrid(yreg, xreg)
-        theta = np.zeros(xreg.shape, dtype=NPFLOAT)
-        rho = np.zeros(xreg.shape, dtype=NPFLOAT)
-        indt = np.zeros(xreg.shape, dtype=NPFLOAT)
-        indr = np.zeros(xreg.shape, dtype=NPFLOAT)
-        # TODO: vectorize?
-        bmp_index = []
-        bpr_index = []
-        for xCntr in np.arange(0, xreg.shape[1]):
-            for yCntr in np.arange(0, yreg.shape[0]):
-                [theta[yCntr, xCntr], rho[yCntr, xCntr]] = cart2pol(
-                    xreg[yCntr, xCntr], yreg[yCntr, xCntr]
-                )
-                indt = np.int(
-                    np.floor(
-                        theta[yCntr, xCntr]/(self.lpitch/self.radius)+header.w/2
-                    ) + 1
-                )
-                indr = np.int(
-                    np.floor(
-                        (rho[yCntr, xCntr]-self.radius)/self.apitch
-                    ) + 1
-                )
-                if indt>0 and indt<header.w and indr>0 and indr<header.h:
-                    bmp_index.append(
-                        np.ravel_multi_index((yCntr, xCntr), xreg.shape)
-                    )
-                    bpr_index.append(
-                        np.ravel_multi_index((indr, indt), (header.h, header.w))
-                    )
+        # Polar coordinates of the bmp pixel centers, and the bpr indexes
+        # that they display.
+        (theta, rho) = cart2pol(xreg, yreg)
+        indt = (np.floor(theta/(self.lpitch/self.radius) + header.w/2) + 1).astype(NPINT)
+        indr = (np.floor((rho - self.radius)/self.apitch) + 1).astype(NPINT)
+        infan = (indt > 0) & (indt < header.w) & (indr > 0) & (indr < header.h)
+        bmp_index = np.flatnonzero(infan)
+        bpr_index = np.ravel_multi_index(
+            (indr.ravel()[bmp_index], indt.ravel()[bmp_index]),
+            (header.h, header.w)
+        )
         self.theta = theta
         self.rho = rho
         self.indt = indt
         self.indr = indr
         self.xreg = xreg
         self.yreg = yreg
-        self.bmp_index = bmp_index
-        self.bpr_index = bpr_index
+        self.xmin = xreg[0, 0]
+        self.ymin = yreg[0, 0]
+        self.bmp_index = bmp_index.astype(NPINT)
+        self.bpr_index = bpr_index.astype(NPINT)
+        # The indexes never change, so they are checked once here rather
+        # than on every conversion.
+        _check_index(self.bpr_index, header.h * header.w, 'Input')
+        _check_index(self.bmp_index, xreg.size, 'Output')
         self.bmp = np.zeros(self.xreg.shape, dtype=NPLONG)
         self._fan = np.zeros(self.xreg.shape, dtype=NPLONG)
+        self._lut = None
+        self._roi_maps = {}
+
+    # Coordinate transforms. All of them accept scalars or arrays of any
+    # shape and return arrays (or scalars) of the same shape. bpr
+    # coordinates are (scanline, sample) and bmp coordinates are (row, col)
+    # of the convert() output, before any flipud(). Integer coordinates are
+    # pixel centers, so np.floor(c + 0.5) of a bmp2bpr() result c is the bpr
+    # pixel that convert() displays at that bmp pixel. Cartesian coordinates are
+    # in metres, with x along the center scanline and the origin at the
+    # center of the probe's radius of curvature.
+
+    def bpr2polar(self, scanline, sample):
+        """Return (theta, rho) for bpr (scanline, sample) coordinates."""
+        scanline = np.asarray(scanline, dtype=NPFLOAT)
+        sample = np.asarray(sample, dtype=NPFLOAT)
+        theta = (scanline - self.input_w/2 - 0.5) * (self.lpitch/self.radius)
+        rho = self.radius + (sample - 0.5) * self.apitch
+        return theta, rho
+
+    def polar2bpr(self, theta, rho):
+        """Return bpr (scanline, sample) coordinates for (theta, rho)."""
+        scanline = np.asarray(theta) / (self.lpitch/self.radius) + self.input_w/2 + 0.5
+        sample = (np.asarray(rho) - self.radius) / self.apitch + 0.5
+        return scanline, sample
+
+    def cart2bmp(self, x, y):
+        """Return bmp (row, col) coordinates for cartesian (x, y)."""
+        step = 1e-3/self.ppmm
+        return (np.asarray(x) - self.xmin) / step, (np.asarray(y) - self.ymin) / step
+
+    def bmp2cart(self, row, col):
+        """Return cartesian (x, y) for bmp (row, col) coordinates."""
+        step = 1e-3/self.ppmm
+        return self.xmin + np.asarray(row) * step, self.ymin + np.asarray(col) * step
+
+    def bpr2bmp(self, scanline, sample):
+        """Return bmp (row, col) coordinates for bpr (scanline, sample)."""
+        (theta, rho) = self.bpr2polar(scanline, sample)
+        return self.cart2bmp(*pol2cart(rho, theta))
+
+    def bmp2bpr(self, row, col, lut=False):
+        """Return bpr (scanline, sample) coordinates for bmp (row, col).
+
+If lut is True, row and col must be integer pixel indexes, and the
+integer bpr pixel displayed at each bmp pixel is looked up in the
+inverse lookup table instead. Pixels outside the fan are returned as -1."""
+        if lut:
+            idx = self.inverse_lut()[row, col]
+            (sample, scanline) = np.divmod(idx, self.input_w)
+            outside = idx < 0
+            if np.any(outside):
+                scanline = np.where(outside, -1, scanline)
+                sample = np.where(outside, -1, sample)
+            return scanline, sample
+        (x, y) = self.bmp2cart(row, col)
+        return self.polar2bpr(*cart2pol(x, y))
+
+    def bpr2mm(self, scanline, sample):
+        """Return cartesian (x, y) in millimetres for bpr (scanline, sample)."""
+        (theta, rho) = self.bpr2polar(scanline, sample)
+        (x, y) = pol2cart(rho, theta)
+        return x * 1e3, y * 1e3
+
+    def mm2bpr(self, x, y):
+        """Return bpr (scanline, sample) for cartesian (x, y) in millimetres."""
+        return self.polar2bpr(*cart2pol(np.asarray(x) * 1e-3, np.asarray(y) * 1e-3))
 
-    def bmp_overlay(self, theta, radius):
+    def inverse_lut(self):
+        """Return the bmp-shaped lookup table of the flat bpr index displayed
+at each bmp pixel, or -1 for pixels outside the fan. The table is
+computed on first use and cached."""
+        if self._lut is None:
+            lut = np.full(self._fan.shape, -1, dtype=NPINT)
+            lut.ravel()[self.bmp_index] = self.bpr_index
+            self._lut = lut
+        return self._lut
+
+    def bmp_mask_to_bpr(self, mask):
+        """Return a boolean bpr-shaped mask of the bpr pixels displayed by
+the True pixels of a boolean bmp-shaped mask."""
+        idx = self.inverse_lut()[np.asarray(mask, dtype=bool)]
+        out = np.zeros((self.input_h, self.input_w), dtype=bool)
+        out.ravel()[idx[idx >= 0]] = True
+        return out
+
+    def bmp_overlay(self, theta, radius, flip=True):
         """
         Return points specified in polar (bpr) coordinates as cartesian
         points that can be plotted over a scanconverted bmp.
 
-        theta = bpr scanline index
-        radius = bpr scanline height index
+        theta = bpr scanline index (scalar or array)
+        radius = bpr scanline height index (scalar or array)
+        flip = if True, return coordinates for the flipped images written
+        by bpr2bmp; otherwise for the output of convert()
+
+        Returns (x, y) pixel coordinates, i.e. (col, row), in the order
+        expected by plotting functions.
         """
-        points = np.zeros(self._fan.shape, dtype=NPLONG) * np.nan
-        points.ravel()[theta]
-        return points
+        (row, col) = self.bpr2bmp(theta, radius)
+        if flip:
+            row = self._fan.shape[0] - 1 - row
+        return col, row
 
-    def convert(self, frame, bgcolor=0):
+    def convert(self, frame, bgcolor=0, out=None):
         """
         Return bpr or raw frame data as scan-converted ndarray.
 
         frame = frame of unconverted bpr or raw data
         bgcolor = background color value
+        out = optional output ndarray of the convert() shape and the dtype
+        of frame
+
+        The result is a new array (or out), so a Converter can be shared by
+        several users and threads.
+        """
+        if frame.shape != (self.input_h, self.input_w):
+            raise ConverterError(
+                'Frame shape {:} does not match header shape {:}.'.format(
+                    frame.shape, (self.input_h, self.input_w)
+                )
+            )
+        if out is None:
+            out = np.empty(self._fan.shape, dtype=frame.dtype)
+        elif out.shape != self._fan.shape or out.dtype != frame.dtype or \
+             not out.flags['C_CONTIGUOUS']:
+            raise ConverterError('Output array has wrong shape, dtype or layout.')
+        with profiling.stage('convert', frames=1):
+            if frame.dtype in KERNEL_DTYPES:
+                _remap_checked_indexes(
+                    np.ascontiguousarray(frame).reshape(1, -1),
+                    out.reshape(1, -1),
+                    self.bpr_index, self.bmp_index, bgcolor
+                )
+            else:
+                out[:] = bgcolor
+                out.ravel()[self.bmp_index] = frame.ravel()[self.bpr_index]
+        return out
+
+    def convert_stack(self, frames, bgcolor=0, out=None, nthreads=None, chunk_frames=16):
+        """
+        Return a stack of bpr or raw frames as scan-converted ndarray.
+
+        frames = (nframes, h, w) ndarray of unconverted frames
+        bgcolor = background color value
+        out = optional (nframes, H, W) output ndarray of the same dtype
+        as frames
+        nthreads = number of worker threads; default is the number of cpus
+        chunk_frames = number of frames converted by a thread at a time
+
+        The frames are converted by the compiled kernel, which releases the
+        GIL, so chunks are converted in parallel.
+        """
+        frames = np.ascontiguousarray(frames)
+        if frames.ndim == 2:
+            frames = frames[np.newaxis]
+        nframes = frames.shape[0]
+        if frames.shape[1:] != (self.input_h, self.input_w):
+            raise ConverterError(
+                'Frame shape {:} does not match header shape {:}.'.format(
+                    frames.shape[1:], (self.input_h, self.input_w)
+                )
+            )
+        if out is None:
+            out = np.empty((nframes,) + self._fan.shape, dtype=frames.dtype)
+        elif out.shape != (nframes,) + self._fan.shape or \
+             out.dtype != frames.dtype or not out.flags['C_CONTIGUOUS']:
+            raise ConverterError('Output array has wrong shape, dtype or layout.')
+        with profiling.stage('convert', frames=nframes, nbytes=frames.nbytes):
+            src = frames.reshape(nframes, -1)
+            dst = out.reshape(nframes, -1)
+            if frames.dtype not in KERNEL_DTYPES:
+                dst[:] = bgcolor
+                dst[:, self.bmp_index] = src[:, self.bpr_index]
+                return out
+            if nthreads is None:
+                nthreads = os.cpu_count() or 1
+            chunk_frames = max(1, chunk_frames)
+            starts = range(0, nframes, chunk_frames)
+            def work(start):
+                stop = start + chunk_frames
+                _remap_checked_indexes(
+                    src[start:stop], dst[start:stop],
+                    self.bpr_index, self.bmp_index, bgcolor
+                )
+            if nthreads <= 1 or nframes <= chunk_frames:
+                for start in starts:
+                    work(start)
+            else:
+                list(_thread_pool(nthreads).map(work, starts))
+        return out
+
+    def _roi_bounds(self, roi):
+        """Return the (top, bottom, left, right) of a roi with None edges
+resolved to frame edges."""
+        (top, bottom, left, right) = roi if roi is not None else (None,) * 4
+        (top, bottom, step) = slice(top, bottom).indices(self.input_h)
+        (left, right, step) = slice(left, right).indices(self.input_w)
+        return (top, bottom, left, right)
+
+    def _roi_map(self, roi):
+        """Return (bbox, src_index, dst_index) for a bpr region of interest.
+The maps are computed on first use of a roi and cached."""
+        (top, bottom, left, right) = self._roi_bounds(roi)
+        key = (top, bottom, left, right)
+        try:
+            return self._roi_maps[key]
+        except KeyError:
+            pass
+        (sample, scanline) = np.divmod(self.bpr_index, self.input_w)
+        sel = (sample >= top) & (sample < bottom) & \
+              (scanline >= left) & (scanline < right)
+        (row, col) = np.divmod(self.bmp_index[sel], self._fan.shape[1])
+        if len(row) == 0:
+            bbox = (0, 0, 0, 0)
+        else:
+            bbox = (int(row.min()), int(row.max()) + 1, int(col.min()), int(col.max()) + 1)
+        src = (sample[sel] - top) * (right - left) + (scanline[sel] - left)
+        dst = (row - bbox[0]) * (bbox[3] - bbox[2]) + (col - bbox[2])
+        _check_index(src, (bottom - top) * (right - left), 'Input')
+        _check_index(dst, (bbox[1] - bbox[0]) * (bbox[3] - bbox[2]), 'Output')
+        result = (bbox, src.astype(NPINT), dst.astype(NPINT))
+        self._roi_maps[key] = result
+        return result
+
+    def roi_bbox(self, roi):
+        """
+        Return the (top, bottom, left, right) bounding box, in rows and
+        columns of the convert() output, of the pixels that display a bpr
+        region of interest.
+
+        roi = (top, bottom, left, right) in samples and scanlines of the
+        unconverted frame; None means the frame edge
         """
-        self._fan[:] = bgcolor 
-        if self._fan.dtype != frame.dtype:
-            self._fan = self._fan.astype(frame.dtype)
-        self._fan.ravel()[self.bmp_index] = frame.ravel()[self.bpr_index]
-        return self._fan
+        return self._roi_map(roi)[0]
+
+    def convert_roi(self, block, roi, bgcolor=0, out=None):
+        """
+        Scan-convert a bpr region of interest to its bounding box.
+
+        block = (nframes, rows, cols) or (rows, cols) frames cropped to roi,
+        e.g. from BprReader.get_roi()
+        roi = the (top, bottom, left, right) region of block
+        bgcolor = value of the bounding box pixels outside the region
+        out = optional output ndarray of the bounding box shape and the
+        dtype of block
+
+        Only the pixels of the bounding box are computed; the result equals
+        the bounding box of convert() of frames that are bgcolor outside roi.
+        """
+        (bbox, src_index, dst_index) = self._roi_map(roi)
+        block = np.ascontiguousarray(block)
+        squeeze = block.ndim == 2
+        if squeeze:
+            block = block[np.newaxis]
+        (top, bottom, left, right) = self._roi_bounds(roi)
+        if block.shape[1:] != (bottom - top, right - left):
+            raise ConverterError(
+                'Block shape {:} does not match roi shape {:}.'.format(
+                    block.shape[1:], (bottom - top, right - left)
+                )
+            )
+        shape = (block.shape[0], bbox[1] - bbox[0], bbox[3] - bbox[2])
+        if out is None:
+            out = np.empty(shape[1:] if squeeze else shape, dtype=block.dtype)
+        elif out.shape != (shape[1:] if squeeze else shape) or \
+             out.dtype != block.dtype or not out.flags['C_CONTIGUOUS']:
+            raise ConverterError('Output array has wrong shape, dtype or layout.')
+        dst = out.reshape(shape[0], -1)
+        with profiling.stage('convert_roi', frames=shape[0], nbytes=block.nbytes):
+            src = block.reshape(shape[0], -1)
+            if block.dtype in KERNEL_DTYPES:
+                _remap_checked_indexes(src, dst, src_index, dst_index, bgcolor)
+            else:
+                dst[:] = bgcolor
+                dst[:, dst_index] = src[:, src_index]
+        return out
 
     def as_bmp(self, frame):
         """
@@ -163,9 +497,9 @@ probe = Probe object
         frame = frame of bpr data
         """
         sys.stderr.write("WARNING: as_bmp is deprecated; use convert instead.")
-        self.bmp[:] = 0
-        self.bmp.ravel()[self.bmp_index] = frame.ravel()[self.bpr_index]
-        return self.bmp.astype(frame.dtype, copy=False)
+        bmp = np.zeros(self.bmp.shape, dtype=NPLONG)
+        bmp.ravel()[self.bmp_index] = frame.ravel()[self.bpr_index]
+        return bmp.astype(frame.dtype, copy=False)
 
     def default_bpr_frame(self, default=0):
         """
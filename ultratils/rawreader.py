@@ -3,6 +3,9 @@
 import os, sys
 import numpy as np
 import hashlib
+from ultratils.archive import is_archive, ArchiveReader
+from ultratils.posio import PositionalFile
+from ultratils import profiling
 
 class RawReader(object):
     '''Class for reading uniform binary ultrasound data from a file.
@@ -48,11 +51,26 @@ class RawReader(object):
     The number of header bytes to skip before the data section of the file.
     Default value indicates no header.
 
+    If filename is a compressed frame archive (see ultratils.archive), the
+    dtype and data_offset stored in the archive are used instead, and frames
+    are decoded from the archive transparently.
+
+    Frames are read with positional reads, so get_frame() can be called
+    from several threads on the same reader. Iteration keeps a per-reader
+    position and should be done by one thread only. The file is opened on
+    the first read and stays open until close() is called or the reader is
+    used as a context manager.
+
     '''
     def __init__(self, filename, nscanlines, npoints, dtype=np.uint8,
 data_offset=0, checksum=False):
         self.filename = os.path.abspath(filename)
-        self._fhandle = None
+        self._file = None
+        self._archive = None
+        if is_archive(self.filename):
+            self._archive = ArchiveReader(self.filename)
+            dtype = self._archive.dtype
+            data_offset = len(self._archive.header_bytes)
         self.nscanlines = nscanlines
         self.npoints = npoints
         self.points_per_frame = npoints * nscanlines
@@ -61,6 +79,13 @@ data_offset=0, checksum=False):
         self.framesize = self.points_per_frame * dtypesize
         self.data_offset = data_offset
         self._data = None
+        # Index of the next frame returned by __next__().
+        self._cursor = 0
+        if self._archive is not None:
+            if self._archive.framesize != self.points_per_frame:
+                raise ValueError('Frame size in archive does not match.')
+            self.nframes = self._archive.nframes
+            return
         st = os.stat(filename)
         try:
             assert(((st.st_size - self.data_offset) % self.framesize) == 0)
@@ -71,18 +96,25 @@ data_offset=0, checksum=False):
             sys.stderr.write(msg)
             sys.stderr.write(' File size {:} bytes.'.format(st.st_size))
             sys.stderr.write(' Frame size {:} bytes.'.format(self.framesize))
-        self.nframes = np.int((st.st_size - self.data_offset) / self.framesize)
-        self._cursor = 0
-        self.open()
+        self.nframes = int((st.st_size - self.data_offset) // self.framesize)
+        self._file = PositionalFile(self.filename)
 
     @property
     def data(self):
         '''Return all data as 3-dimensional ndarray.'''
+        if self._data is None and self._archive is not None:
+            imdims = [self.nframes, self.nscanlines, self.npoints]
+            data = self._archive.get_frames().reshape(imdims)
+            self._data = np.rot90(data, axes=(1, 2))
         if self._data is None:
-            self._cursor = self._fhandle.tell()
-            self._fhandle.seek(self.data_offset)
-            data = np.fromfile(self._fhandle, self.dtype)
-            self._fhandle.seek(self._cursor)
+            # Read by filename rather than through the shared descriptor.
+            with profiling.stage('rawreader', frames=self.nframes) as timer:
+                data = np.fromfile(
+                    self.filename, dtype=self.dtype,
+                    count=self.nframes * self.points_per_frame,
+                    offset=self.data_offset
+                )
+                timer.nbytes = data.nbytes
             imdims = [self.nframes, self.nscanlines, self.npoints]
             try:
                 self._data = np.rot90(data.reshape(imdims), axes=(1, 2))
@@ -116,42 +148,130 @@ data_offset=0, checksum=False):
     def __next__(self):
         '''
         Get next frame, used to iterate through the images one at a time.
-        You should not make other reads on the file handle while iterating
-        through the reader.
+        The iteration position is shared by all users of the reader.
         '''
-        try:
-            data = self._fhandle.read(self.framesize)
-            assert(len(data) == self.points_per_frame)
-            data = np.fromstring(data, dtype=self.dtype)
-        except AssertionError as e:
-            if len(data) == 0:
-                self._fhandle.seek(self.data_offset)
-                raise StopIteration  # ran out of data at end of file
-            else:
-                raise RuntimeError('Got unexpected number of data points.')
-        return np.rot90(data.reshape([self.nscanlines, self.npoints]))
+        if self._cursor >= self.nframes:
+            self._cursor = 0
+            raise StopIteration
+        self._cursor += 1
+        return self.get_frame(self._cursor - 1)
  
     def get_frame(self, idx=None):
         '''
-        Get the image frame specified by idx. Do not advance the read
-        location of _fhandle.
+        Get the image frame specified by idx. Does not change the
+        iteration position, and is safe to call from several threads.
         '''
-        self._fhandle.seek(self.data_offset + (idx * self.framesize))
-        data = self._fhandle.read(self.framesize)
-        try:
-            assert(len(data) == self.points_per_frame)
-        except AssertionError:
+        if idx < 0 or idx >= self.nframes:
+            raise IndexError('{:}'.format(idx))
+        if self._archive is not None:
+            data = self._archive.get_frame(idx)
+            # Copy out of the archive's shared chunk cache.
+            return np.rot90(data.reshape([self.nscanlines, self.npoints])).copy()
+        with profiling.stage('rawreader', frames=1, nbytes=self.framesize):
+            data = self._file.pread(
+                self.framesize, self.data_offset + (idx * self.framesize)
+            )
+        if len(data) != self.framesize:
             raise IndexError('{:}'.format(idx))
-        self._fhandle.seek(self._cursor)
-        data = np.fromstring(data, self.dtype)
+        data = np.frombuffer(bytearray(data), self.dtype)
         return np.rot90(data.reshape([self.nscanlines, self.npoints]))
 
+    def _frames_view(self, start, stop):
+        '''
+        Return frames start to stop - 1 in the file layout, (n, nscanlines,
+        npoints), as a memory map, or decoded from the archive.
+        '''
+        (start, stop, step) = slice(start, stop).indices(self.nframes)
+        stop = max(start, stop)
+        if self._archive is not None:
+            frames = self._archive.get_frames(start, stop)
+        elif stop > start:
+            frames = np.memmap(
+                self.filename, dtype=self.dtype, mode='r',
+                offset=self.data_offset + start * self.framesize,
+                shape=(stop - start, self.points_per_frame)
+            )
+        else:
+            frames = np.zeros([0, self.points_per_frame], dtype=self.dtype)
+        return frames.reshape(-1, self.nscanlines, self.npoints)
+
+    def get_roi(self, roi=None, start=0, stop=None):
+        '''
+        Return frames start to stop - 1 cropped to a region of interest, as
+        an array of shape (n, rows, cols) in the orientation of get_frame().
+
+        Parameters
+        ----------
+        roi : tuple, optional
+            (top, bottom, left, right) rows and columns of get_frame();
+            bottom and right are exclusive and None means the frame edge.
+        start, stop : int, optional
+            Frame range.
+
+        Notes
+        -----
+        The columns of a frame are scanlines, which are stored contiguously,
+        so only the bytes of the selected scanlines are read.
+        '''
+        (top, bottom, left, right) = roi if roi is not None else (None,) * 4
+        frames = self._frames_view(start, stop)
+        # get_frame() rotates the frames, so row r is point npoints - 1 - r.
+        (rstart, rstop, step) = slice(top, bottom).indices(self.npoints)
+        block = frames[:, left:right, self.npoints - max(rstop, rstart):self.npoints - rstart]
+        with profiling.stage('rawreader_roi', frames=len(block), nbytes=block.nbytes):
+            return np.ascontiguousarray(np.rot90(block, axes=(1, 2)))
+
+    def get_scanlines(self, scanlines, start=0, stop=None, average=False, copy=True):
+        '''
+        Return the samples of one or more scanlines in frames start to
+        stop - 1, e.g. for an M-mode display.
+
+        Parameters
+        ----------
+        scanlines : int or sequence of int
+            Scanline index (a column of get_frame()), or indexes.
+        start, stop : int, optional
+            Frame range.
+        average : bool (default False)
+            If True, return the mean of the scanlines as float32.
+        copy : bool (default True)
+            If False, a single scanline is returned as a read-only view of
+            the memory-mapped file.
+
+        Returns
+        -------
+        ndarray
+            (samples, frames) for a single scanline or with average, and
+            (nscanlines, samples, frames) otherwise, with samples in the
+            row order of get_frame(). Only the bytes of the selected
+            scanlines are read.
+        '''
+        frames = self._frames_view(start, stop)
+        # get_frame() rotates the frames, so row r is point npoints - 1 - r.
+        if np.ndim(scanlines) == 0:
+            view = frames[:, int(scanlines), ::-1].T
+            return np.array(view) if copy else view
+        block = frames[:, np.asarray(scanlines, dtype=np.intp), ::-1]
+        with profiling.stage('rawreader_scanlines', frames=len(block), nbytes=block.nbytes):
+            if average:
+                return block.mean(axis=1, dtype=np.float32).T.copy()
+            return np.ascontiguousarray(block.transpose(1, 2, 0))
+
+    @property
+    def closed(self):
+        '''True if the reader holds no open file descriptor.'''
+        if self._archive is not None:
+            return self._archive.closed
+        return self._file.closed
+
     def open(self):
-        self._fhandle = open(self.filename, 'rb')
+        '''Open the file. Not normally needed; reads open the file on demand.'''
+        if self._archive is None:
+            self._file.fileno()
 
     def close(self):
-        try:
-            self._fhandle.close()
-            self._fhandle = None
-        except Exception as e:
-            raise e
+        '''Close the file. The reader reopens it if it is read again.'''
+        if self._archive is not None:
+            self._archive.close()
+            return
+        self._file.close()
@@ -0,0 +1,288 @@
+# Batch rendering of acquisition video clips.
+#
+# render_clips() takes a table of (timestamp, t1, t2, outfile) rows and
+# renders each row as an .mp4 clip of the ultrasound frames, with audio,
+# between t1 and t2. Rows are grouped by acquisition, so that the image
+# reader, scan converter, sync index and .wav mapping of an acquisition are
+# opened once for all of its clips, and the groups are rendered on a pool
+# of worker processes. Each worker runs one ffmpeg encoder at a time, and
+# frames are piped to it directly instead of through matplotlib. Temporary
+# files are created in a private directory per worker, so that renders do
+# not collide. A failed clip is reported in the results and does not stop
+# the other clips.
+
+import os, sys
+import time
+import shutil
+import tempfile
+import subprocess
+import multiprocessing
+from collections import OrderedDict
+import numpy as np
+
+from ultratils import profiling
+
+class RenderError(Exception):
+    """Base class for errors in this module."""
+    def __init__(self, msg):
+        self.msg = msg
+    def __str__(self):
+        return repr(self.msg)
+
+def _rows(rows):
+    '''Return rows as a list of (timestamp, t1, t2, outfile) tuples. rows
+may be a sequence of tuples or a DataFrame with those columns.'''
+    if hasattr(rows, 'itertuples'):
+        rows = rows[['timestamp', 't1', 't2', 'outfile']].itertuples(index=False)
+    return [(str(ts), t1, t2, outfile) for (ts, t1, t2, outfile) in rows]
+
+def group_rows(rows, clips_per_task=50):
+    '''Group rows by acquisition timestamp, in order of first appearance,
+and split each group into tasks of at most clips_per_task clips.
+Return a list of (timestamp, [(t1, t2, outfile), ...]) tuples.'''
+    groups = OrderedDict()
+    for (ts, t1, t2, outfile) in _rows(rows):
+        groups.setdefault(ts, []).append((t1, t2, outfile))
+    tasks = []
+    for ts, clips in groups.items():
+        for start in range(0, len(clips), clips_per_task):
+            tasks.append((ts, clips[start:start + clips_per_task]))
+    return tasks
+
+class ClipRenderer(object):
+    '''Renders clips of a single acquisition.
+
+acq = ultratils.acq.Acq
+corrected = if True, scan-convert the frames; otherwise use the raw
+    scanline data in rectangular format
+fill = if True, show a blank frame where no frame was received; otherwise
+    repeat the previous frame
+audio = if True, add the audio of the first .wav channel
+scale = ffmpeg scale filter size, e.g. '692x350'; None keeps the frame size
+    (rounded down to even dimensions, as required by the encoder)
+enhance = optional ultratils.enhance.Chain or spec string; frames are
+    enhanced in batches before conversion
+ffmpeg = the ffmpeg executable
+ffmpeg_threads = number of encoder threads per clip
+tmpdir = directory for temporary audio files
+'''
+    def __init__(self, acq, corrected=True, fill=True, audio=True, scale=None,
+enhance=None, ffmpeg='ffmpeg', ffmpeg_threads=1, tmpdir=None):
+        self.acq = acq
+        self.corrected = corrected
+        self.fill = fill
+        self.audio = audio
+        self.scale = scale
+        self.enhance = enhance
+        self._chain = None
+        self.ffmpeg = ffmpeg
+        self.ffmpeg_threads = ffmpeg_threads
+        self.tmpdir = tmpdir
+        self._wav = None
+        self._blank = None
+
+    @property
+    def wav(self):
+        '''The WavReader of the acquisition audio, opened once.'''
+        if self._wav is None:
+            from ultratils.wavreader import WavReader
+            self._wav = WavReader(self.acq.abs_audio_file)
+        return self._wav
+
+    @property
+    def blank(self):
+        '''The frame shown where no frame was received.'''
+        if self._blank is None:
+            if self.corrected:
+                conv = self.acq.image_converter
+                blank = conv.convert(conv.default_bpr_frame(0))
+            else:
+                blank = self.acq.get_frame(0, copy=False) * 0
+            self._blank = np.flipud(blank).astype(np.uint8)
+        return self._blank
+
+    @property
+    def chain(self):
+        '''The enhancement Chain bound to the acquisition frames, or None.'''
+        if self._chain is None and self.enhance is not None:
+            import ultratils.enhance
+            self._chain = ultratils.enhance.as_chain(self.enhance).for_reader(
+                self.acq.image_reader
+            )
+        return self._chain
+
+    def frames(self, t1, t2):
+        '''Yield the uint8 frames of the pulses between t1 and t2.'''
+        sidx = self.acq.sync_index
+        first = np.searchsorted(sidx.t2, t1, side='right') if t1 is not None else 0
+        last = np.searchsorted(sidx.t1, t2, side='left') if t2 is not None else len(sidx)
+        rdidxs = [int(rdidx) for rdidx in sidx.raw_data_idx[first:last]]
+        if self.chain is not None:
+            frames = self.chain.frames_at(
+                self.acq.image_reader, rdidxs,
+                converter=self.acq.image_converter if self.corrected else None
+            )
+        else:
+            frames = (
+                self.acq.get_frame(rdidx, convert=self.corrected, copy=False) if rdidx >= 0 else None
+                for rdidx in rdidxs
+            )
+        prev = self.blank
+        for frame in frames:
+            if frame is not None:
+                prev = np.ascontiguousarray(np.flipud(frame).astype(np.uint8))
+                yield prev
+            elif self.fill:
+                yield self.blank
+            else:
+                yield prev
+
+    def _write_audio(self, t1, t2, name):
+        import scipy.io.wavfile
+        snip = np.ascontiguousarray(self.wav.tslice(t1, t2, chan=0))
+        scipy.io.wavfile.write(name, self.wav.rate, snip)
+
+    def render(self, t1, t2, outfile):
+        '''Render the clip between t1 and t2 to outfile. Return the number
+of video frames written.'''
+        (h, w) = self.blank.shape
+        vf = 'scale={:}'.format(self.scale.replace('x', ':')) if self.scale \
+            else 'scale=trunc(iw/2)*2:trunc(ih/2)*2'
+        cmd = [
+            self.ffmpeg, '-y', '-loglevel', 'error',
+            '-f', 'rawvideo', '-pix_fmt', 'gray', '-s', '{:d}x{:d}'.format(w, h),
+            '-r', '{:0.6f}'.format(self.acq.framerate), '-i', '-'
+        ]
+        audname = None
+        if self.audio:
+            (fd, audname) = tempfile.mkstemp(suffix='.wav', dir=self.tmpdir)
+            os.close(fd)
+            self._write_audio(t1, t2, audname)
+            cmd += ['-i', audname, '-c:a', 'aac', '-shortest']
+        cmd += [
+            '-vf', vf, '-c:v', 'libx264', '-pix_fmt', 'yuv420p',
+            '-threads', str(self.ffmpeg_threads), outfile
+        ]
+        nframes = 0
+        try:
+            proc = subprocess.Popen(
+                cmd, stdin=subprocess.PIPE, stderr=subprocess.PIPE
+            )
+            try:
+                for frame in self.frames(t1, t2):
+                    proc.stdin.write(frame.tobytes())
+                    nframes += 1
+                proc.stdin.close()
+            except (IOError, OSError):   # ffmpeg exited early
+                pass
+            err = proc.stderr.read()
+            if proc.wait() != 0:
+                raise RenderError('ffmpeg failed: {:}'.format(
+                    err.decode('utf-8', 'replace').strip()[-500:]
+                ))
+        except Exception:
+            if os.path.exists(outfile):
+                os.remove(outfile)
+            raise
+        finally:
+            if audname is not None and os.path.exists(audname):
+                os.remove(audname)
+        return nframes
+
+    def close(self):
+        if self._wav is not None:
+            self._wav.close()
+            self._wav = None
+
+def _render_task(args):
+    '''Render the clips of one acquisition; used as the worker pool function.
+Return a list of result dicts, one per clip.'''
+    (expdir, ts, clips, options) = args
+    results = []
+    tmpdir = tempfile.mkdtemp(prefix='ultrarender')
+    renderer = None
+    try:
+        from ultratils.acq import Acq
+        try:
+            acq = Acq(timestamp=ts, expdir=expdir)
+            renderer = ClipRenderer(acq, tmpdir=tmpdir, **options)
+        except Exception as e:
+            err = 'cannot open acquisition: {:}'.format(e)
+            return [
+                _result(ts, t1, t2, outfile, error=err) for (t1, t2, outfile) in clips
+            ]
+        for (t1, t2, outfile) in clips:
+            start = time.time()
+            try:
+                n = renderer.render(t1, t2, outfile)
+                results.append(_result(ts, t1, t2, outfile, frames=n, start=start))
+            except Exception as e:
+                results.append(_result(ts, t1, t2, outfile, error=str(e), start=start))
+    finally:
+        if renderer is not None:
+            renderer.close()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return results
+
+def _result(ts, t1, t2, outfile, frames=0, error=None, start=None):
+    return OrderedDict([
+        ('timestamp', ts), ('t1', t1), ('t2', t2), ('outfile', outfile),
+        ('status', 'failed' if error is not None else 'done'),
+        ('frames', frames), ('error', error),
+        ('elapsed', round(time.time() - start, 3) if start is not None else 0.0),
+    ])
+
+def render_clips(expdir, rows, jobs=1, clips_per_task=50, progress=False, **options):
+    '''Render video clips of acquisitions in an experiment.
+
+expdir = the experiment directory
+rows = sequence of (timestamp, t1, t2, outfile) tuples, or a DataFrame with
+    those columns
+jobs = number of worker processes; None for one per cpu
+clips_per_task = maximum number of clips of one acquisition rendered by a
+    worker before the next acquisition is handed out
+progress = if True, periodically report clips per second and ETA, and
+    write a summary when done
+options = keyword arguments passed to ClipRenderer (corrected, fill, audio,
+    scale, enhance, ffmpeg, ffmpeg_threads)
+
+Returns a list of result dicts, one per clip, with 'status' 'done' or
+'failed' and the 'error' message of failed clips.
+'''
+    tasks = [
+        (expdir, ts, clips, options)
+        for (ts, clips) in group_rows(rows, clips_per_task)
+    ]
+    nclips = sum(len(t[2]) for t in tasks)
+    prog = None
+    if progress:
+        prog = profiling.Progress(nclips, label='clips')
+    start = time.time()
+    pool = None
+    if jobs is None or jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        taskiter = pool.imap_unordered(_render_task, tasks)
+    else:
+        taskiter = (_render_task(task) for task in tasks)
+    results = []
+    try:
+        for res in taskiter:
+            results.extend(res)
+            for r in res:
+                if r['status'] != 'done':
+                    sys.stderr.write('Error rendering {:}: {:}\n'.format(
+                        r['outfile'], r['error']
+                    ))
+            if prog is not None:
+                prog.update(len(res))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    if progress:
+        nfailed = len([r for r in results if r['status'] != 'done'])
+        sys.stderr.write('Rendered {:d} clips ({:d} failed, {:d} frames) in {:0.1f} s.\n'.format(
+            len(results) - nfailed, nfailed,
+            sum(r['frames'] for r in results), time.time() - start
+        ))
+    return results
@@ -0,0 +1,187 @@
+# Temporal resampling of ultrasound frames onto a uniform time grid.
+#
+# Frames are received at the times of the synchronization pulses, which
+# jitter, and some pulses have no frame. A ResamplePlan maps every target
+# time of a grid to the received frames before and after it and the weight
+# of the later frame, computed for all target times at once from the sync
+# index. Applying a plan reads the frames it needs in one batched read and
+# interpolates the output stack with array operations.
+#
+# Methods:
+#   'nearest' = the received frame nearest in time
+#   'linear'  = linear interpolation between the received frames before
+#               and after the target time
+#   'fill'    = like 'linear', but interpolates across dropped frames
+#
+# With 'linear', a target time between two received frames that are more
+# than max_gap apart (by default 1.5 pulse periods, so any dropped frame)
+# has no value, unless it falls on one of the frames. With 'nearest', a
+# target time has no value if the nearest frame is more than max_gap / 2
+# away. Target times outside the received frames have no value with any
+# method.
+
+import numpy as np
+
+from ultratils import profiling
+
+METHODS = ('nearest', 'linear', 'fill')
+
+class ResampleError(Exception):
+    """Base class for errors in this module."""
+    def __init__(self, msg):
+        self.msg = msg
+    def __str__(self):
+        return repr(self.msg)
+
+def uniform_grid(t1, t2, rate):
+    '''Return the times t1, t1 + 1/rate, ... that are less than t2.'''
+    n = int(np.floor((t2 - t1) * rate + 1e-9))
+    return t1 + np.arange(max(n, 0)) / float(rate)
+
+def frame_times(sidx, anchor='start'):
+    '''Return (times, raw_data_idx) of the received frames in the SyncIndex
+sidx. anchor is 'start' to time each frame at the start of its pulse or
+'mid' to use the middle of the pulse.'''
+    received = sidx.raw_data_idx >= 0
+    if anchor == 'start':
+        times = sidx.t1[received]
+    elif anchor == 'mid':
+        times = (sidx.t1[received] + sidx.t2[received]) / 2
+    else:
+        raise ResampleError("anchor must be 'start' or 'mid', not {:}".format(anchor))
+    return (times, sidx.raw_data_idx[received].astype(np.int64))
+
+class ResamplePlan(object):
+    '''Frames and weights for resampling onto target times.
+
+times = target times
+lo, hi = raw data frame index of the received frames before and after each
+    target time
+weight = weight of the hi frame; the lo frame has weight 1 - weight
+valid = False where a target time has no value
+'''
+    def __init__(self, times, lo, hi, weight, valid):
+        self.times = times
+        self.lo = lo
+        self.hi = hi
+        self.weight = weight
+        self.valid = valid
+
+    def __len__(self):
+        return len(self.times)
+
+    @classmethod
+    def from_sync_index(cls, sidx, times, method='linear', max_gap=None, anchor='start'):
+        '''Make the plan for resampling the frames of the SyncIndex sidx
+onto times.
+
+method = 'nearest', 'linear' or 'fill'
+max_gap = longest time between two received frames that is interpolated
+    across, or for 'nearest' twice the longest distance to the nearest
+    frame; default is 1.5 pulse periods for 'nearest' and 'linear' and
+    unlimited for 'fill'
+anchor = 'start' or 'mid'; see frame_times()
+'''
+        if method not in METHODS:
+            raise ResampleError('method must be one of {:}, not {:}'.format(METHODS, method))
+        times = np.asarray(times, dtype=np.float64)
+        (ft, fidx) = frame_times(sidx, anchor)
+        if len(ft) == 0:
+            zeros = np.zeros(len(times), dtype=np.int64)
+            return cls(times, zeros, zeros, np.zeros(len(times)), zeros.astype(bool))
+        if max_gap is None:
+            if method == 'fill' or len(sidx) < 2:
+                max_gap = np.inf
+            else:
+                max_gap = 1.5 * np.median(np.diff(sidx.t1))
+        j = np.searchsorted(ft, times, side='right')
+        lo = np.clip(j - 1, 0, len(ft) - 1)
+        hi = np.clip(j, 0, len(ft) - 1)
+        span = ft[hi] - ft[lo]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            weight = np.where(span > 0, (times - ft[lo]) / span, 0.0)
+        valid = (times >= ft[0]) & (times <= ft[-1])
+        if method == 'nearest':
+            weight = (weight >= 0.5).astype(np.float64)
+            nearest = np.where(weight > 0, ft[hi], ft[lo])
+            valid &= np.abs(times - nearest) <= max_gap / 2
+        else:
+            # A time on a received frame needs only that frame.
+            valid &= (weight == 0) | (span <= max_gap)
+        return cls(times, fidx[lo], fidx[hi], weight, valid)
+
+    def needed(self):
+        '''Return the sorted raw data frame indexes the plan reads.'''
+        v = self.valid
+        return np.union1d(
+            self.lo[v & (self.weight < 1)], self.hi[v & (self.weight > 0)]
+        )
+
+    def apply(self, frames, fill_value=np.nan, dtype=np.float32, chunk=256):
+        '''Return the resampled stack, of shape (len(self),) + frame shape.
+
+frames = (indexes, stack) of the frames returned by needed(), or a
+    function that takes the indexes and returns the stack
+fill_value = value of the target times that have no value; use a number,
+    not nan, with an integer dtype
+dtype = output dtype
+chunk = number of target times interpolated at a time
+'''
+        if callable(frames):
+            indexes = self.needed()
+            stack = frames(indexes)
+        else:
+            (indexes, stack) = frames
+        indexes = np.asarray(indexes)
+        fshape = stack.shape[1:]
+        out = np.empty((len(self),) + tuple(fshape), dtype=dtype)
+        out[...] = fill_value
+        v = np.flatnonzero(self.valid)
+        if len(v) == 0:
+            return out
+        # Positions in stack of the lo and hi frames; unused ones are clipped.
+        lopos = np.clip(np.searchsorted(indexes, self.lo[v]), 0, len(indexes) - 1)
+        hipos = np.clip(np.searchsorted(indexes, self.hi[v]), 0, len(indexes) - 1)
+        w = self.weight[v]
+        with profiling.stage('resample', frames=len(v), nbytes=out.itemsize * len(v) * int(np.prod(fshape))):
+            for start in range(0, len(v), chunk):
+                sl = slice(start, start + chunk)
+                wc = w[sl].reshape((-1,) + (1,) * len(fshape))
+                a = stack[lopos[sl]].astype(np.float32)
+                b = stack[hipos[sl]].astype(np.float32)
+                a += wc.astype(np.float32) * (b - a)
+                if np.issubdtype(dtype, np.integer):
+                    np.rint(a, out=a)
+                out[v[sl]] = a
+        return out
+
+def resample_acq(acq, rate=100.0, t1=None, t2=None, method='linear', convert=False, max_gap=None, fill_value=np.nan, dtype=np.float32, anchor='start'):
+    '''Resample the frames of an acquisition onto a uniform grid.
+
+acq = ultratils.acq.Acq
+rate = grid rate in Hz
+t1, t2 = start and end of the grid; default is the span of the pulses
+method, max_gap, anchor = see ResamplePlan.from_sync_index()
+convert = if True, return scan-converted frames
+fill_value, dtype = see ResamplePlan.apply()
+
+Returns (times, frames, valid).
+'''
+    sidx = acq.sync_index
+    if t1 is None:
+        t1 = sidx.t1[0] if len(sidx) > 0 else 0.0
+    if t2 is None:
+        t2 = sidx.t2[-1] if len(sidx) > 0 else 0.0
+    times = uniform_grid(t1, t2, rate)
+    plan = ResamplePlan.from_sync_index(sidx, times, method, max_gap, anchor)
+
+    def read(indexes):
+        from ultratils.dataset import ConcatFrameDataset
+        with ConcatFrameDataset([acq.abs_image_file]) as ds:
+            stack = ds.get_batch(indexes)
+        if convert:
+            stack = acq.image_converter.convert_stack(stack)
+        return stack
+
+    frames = plan.apply(read, fill_value=fill_value, dtype=dtype)
+    return (times, frames, plan.valid)
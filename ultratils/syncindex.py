@@ -0,0 +1,173 @@
+# Binary index of the synchronization pulses of an acquisition.
+#
+# psync writes the pulses to a .sync.TextGrid for use in Praat, which is
+# slow to parse for long acquisitions. It also writes the same information
+# to a .sync.npz sidecar as arrays: the start and end time of each pulse,
+# the pulse index and the raw data frame index of each pulse, with -1 where
+# the TextGrid has 'NA'. A SyncIndex is loaded from the sidecar when it is
+# at least as new as the TextGrid, and is built from the TextGrid otherwise.
+
+import os
+import numpy as np
+
+SYNC_INDEX_EXT = '.sync.npz'
+FORMAT_VERSION = 1
+
+class SyncIndexError(Exception):
+    """Base class for errors in this module."""
+    def __init__(self, msg):
+        self.msg = msg
+    def __str__(self):
+        return repr(self.msg)
+
+def write_sync_index(filename, t1, t2, raw_data_idx=None, end=None):
+    '''Write a sync index file.
+
+t1, t2 = start and end times of each pulse
+raw_data_idx = raw data frame index of each pulse, -1 if no frame was
+    received; None if there is no .idx.txt information
+end = end time of the acquisition; default is the end of the last pulse
+'''
+    t1 = np.asarray(t1, dtype=np.float64)
+    t2 = np.asarray(t2, dtype=np.float64)
+    has_raw = raw_data_idx is not None
+    if raw_data_idx is None:
+        raw_data_idx = np.full(len(t1), -1, dtype=np.int32)
+    if end is None:
+        end = t2[-1] if len(t2) > 0 else 0.0
+    tmpname = filename + '.tmp'
+    with open(tmpname, 'wb') as f:
+        np.savez(
+            f, version=FORMAT_VERSION, t1=t1, t2=t2,
+            pulse_idx=np.arange(len(t1), dtype=np.int32),
+            raw_data_idx=np.asarray(raw_data_idx, dtype=np.int32),
+            has_raw_data_idx=has_raw, end=end
+        )
+    if os.path.exists(filename):
+        os.remove(filename)
+    os.rename(tmpname, filename)
+
+def is_fresh(filename, textgrid):
+    '''Return True if the sync index filename exists and is not older than
+textgrid (or textgrid does not exist).'''
+    try:
+        mtime = os.path.getmtime(filename)
+    except OSError:
+        return False
+    try:
+        return mtime >= os.path.getmtime(textgrid)
+    except OSError:
+        return True
+
+class SyncIndex(object):
+    '''Synchronization pulses of an acquisition as arrays.
+
+t1, t2 = start and end time of each pulse
+pulse_idx = index of each pulse
+raw_data_idx = raw data frame index of each pulse, -1 where no frame was
+    received
+has_raw_data_idx = False if psync did not have an .idx.txt file, in which
+    case raw_data_idx is all -1
+'''
+    def __init__(self, t1, t2, pulse_idx, raw_data_idx, has_raw_data_idx=True, end=None):
+        self.t1 = np.asarray(t1, dtype=np.float64)
+        self.t2 = np.asarray(t2, dtype=np.float64)
+        self.pulse_idx = np.asarray(pulse_idx, dtype=np.int32)
+        self.raw_data_idx = np.asarray(raw_data_idx, dtype=np.int32)
+        self.has_raw_data_idx = bool(has_raw_data_idx)
+        if end is None:
+            end = self.t2[-1] if len(self.t2) > 0 else 0.0
+        self.end = float(end)
+
+    @classmethod
+    def load(cls, filename):
+        '''Load a sync index file.'''
+        with np.load(filename) as npz:
+            if int(npz['version']) > FORMAT_VERSION:
+                raise SyncIndexError(
+                    'Unsupported sync index version {:}.'.format(int(npz['version']))
+                )
+            return cls(
+                npz['t1'], npz['t2'], npz['pulse_idx'], npz['raw_data_idx'],
+                bool(npz['has_raw_data_idx']), float(npz['end'])
+            )
+
+    @classmethod
+    def from_textgrid(cls, lm):
+        '''Build a SyncIndex from the LabelManager of a .sync.TextGrid.'''
+        pulses = lm.tier('pulse_idx').search(r'^\d+$')
+        t1 = np.array([l.t1 for l in pulses], dtype=np.float64)
+        t2 = np.array([l.t2 for l in pulses], dtype=np.float64)
+        pulse_idx = np.array([int(l.text) for l in pulses], dtype=np.int32)
+        raw = np.full(len(pulses), -1, dtype=np.int32)
+        try:
+            raw_tier = lm.tier('raw_data_idx')
+            has_raw = True
+        except Exception:
+            has_raw = False
+        if has_raw:
+            # The raw_data_idx labels share their boundaries with the pulses.
+            texts = dict((l.t1, l.text) for l in raw_tier.search(r''))
+            for i, t in enumerate(t1):
+                try:
+                    raw[i] = int(texts.get(t, ''))
+                except ValueError:   # 'NA' or ''
+                    pass
+        end = lm.tier('pulse_idx').end
+        return cls(t1, t2, pulse_idx, raw, has_raw, end)
+
+    @classmethod
+    def for_textgrid(cls, textgrid, sidecar=None):
+        '''Return the SyncIndex for a .sync.TextGrid, loaded from its sidecar
+if the sidecar is fresh and parsed from the TextGrid otherwise.'''
+        if sidecar is None:
+            sidecar = textgrid[:-len('.sync.TextGrid')] + SYNC_INDEX_EXT \
+                if textgrid.endswith('.sync.TextGrid') else textgrid + SYNC_INDEX_EXT
+        if is_fresh(sidecar, textgrid):
+            return cls.load(sidecar)
+        if not os.path.isfile(textgrid):
+            raise IOError('No such file: {:}'.format(textgrid))
+        import audiolabel
+        lm = audiolabel.LabelManager(from_file=textgrid, from_type='praat')
+        return cls.from_textgrid(lm)
+
+    def save(self, filename):
+        '''Write the index to filename.'''
+        write_sync_index(
+            filename, self.t1, self.t2,
+            self.raw_data_idx if self.has_raw_data_idx else None, self.end
+        )
+
+    def __len__(self):
+        return len(self.t1)
+
+    @property
+    def durations(self):
+        '''Duration of each pulse.'''
+        return self.t2 - self.t1
+
+    @property
+    def framerate(self):
+        '''Pulses per second.'''
+        return len(self.t1) / (self.t2[-1] - self.t1[0])
+
+    @property
+    def n_raw_data_idx(self):
+        '''Number of pulses for which a raw data frame was received.'''
+        return int(np.count_nonzero(self.raw_data_idx >= 0))
+
+    def pulse_at(self, t):
+        '''Return the position of the pulse that contains time t, or -1.
+t may be a scalar or an array.'''
+        t = np.asarray(t, dtype=np.float64)
+        if len(self.t1) == 0:
+            return np.full(t.shape, -1, dtype=np.intp)
+        pos = np.searchsorted(self.t1, t, side='right') - 1
+        inside = (pos >= 0) & (t < self.t2[np.clip(pos, 0, None)])
+        return np.where(inside, pos, -1)
+
+    def raw_data_idx_at(self, t):
+        '''Return the raw data frame index at time t, or -1 if no frame was
+received at t. t may be a scalar or an array.'''
+        pos = self.pulse_at(t)
+        return np.where(pos >= 0, self.raw_data_idx[np.clip(pos, 0, None)], -1)
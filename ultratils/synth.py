@@ -0,0 +1,131 @@
+# Generate synthetic ultrasound acquisitions for testing and benchmarking.
+
+import os, sys
+import struct
+import wave
+from contextlib import closing
+from datetime import datetime, timedelta
+import numpy as np
+
+# Default .bpr header values for synthetic data: Ultrasonix C9-5/10 probe
+# with an 8 MHz sampling frequency.
+DEFAULT_PROBE = 19
+DEFAULT_SF = 8000000
+
+def synth_frames(nframes, h, w, dup_rate=0.0, seed=0):
+    '''Return a (nframes, h, w) uint8 array of speckled frames with a bright
+band that moves slowly through the frames, like a tongue contour. A
+proportion dup_rate of the frames duplicate the frame before them.'''
+    rng = np.random.RandomState(seed)
+    rows = np.arange(h)[:, np.newaxis]
+    frames = np.empty([nframes, h, w], dtype=np.uint8)
+    for idx in range(nframes):
+        if idx > 0 and rng.rand() < dup_rate:
+            frames[idx] = frames[idx - 1]
+            continue
+        center = h * (0.5 + 0.2 * np.sin(2 * np.pi * idx / 120.0))
+        band = 160 * np.exp(-((rows - center) / (0.03 * h)) ** 2)
+        speckle = rng.rayleigh(25, size=[h, w])
+        frames[idx] = np.clip(band + speckle, 0, 255).astype(np.uint8)
+    return frames
+
+def write_bpr(filename, frames, probe=DEFAULT_PROBE, sf=DEFAULT_SF):
+    '''Write a (nframes, h, w) uint8 array to a .bpr file.'''
+    (nframes, h, w) = frames.shape
+    # filetype, nframes, w, h, ss, ul, ur, br, bl, probe, txf, sf, dr, ld, extra
+    hdr = [2, nframes, w, h, 8, 0, 0, w, 0, w, h, 0, h, probe, 5000000, sf,
+           0, 0, 0]
+    with open(filename, 'wb') as f:
+        f.write(struct.pack('I' * 19, *hdr))
+        # .bpr frames store each scanline's samples contiguously.
+        f.write(np.ascontiguousarray(frames.transpose(0, 2, 1)).tobytes())
+
+def write_raw(filename, frames, dtype=np.uint8, data_offset=0):
+    '''Write a (nframes, npoints, nscanlines) array in the layout read by
+RawReader, preceded by data_offset header bytes.'''
+    data = np.ascontiguousarray(np.rot90(frames, -1, axes=(1, 2))).astype(dtype)
+    with open(filename, 'wb') as f:
+        f.write(b'\0' * data_offset)
+        f.write(data.tobytes())
+
+def received_indexes(npulses, drop_rate=0.0, seed=0):
+    '''Return the sorted pulse indexes of the frames that were received
+when a proportion drop_rate of npulses frames is dropped.'''
+    rng = np.random.RandomState(seed)
+    keep = rng.rand(npulses) >= drop_rate
+    keep[0] = True
+    return np.where(keep)[0]
+
+def write_idx(filename, indexes):
+    '''Write received frame indexes to an .idx.txt file.'''
+    np.savetxt(filename, indexes, fmt='%d')
+
+def pulse_times(npulses, framerate=60.0, start=0.5, jitter=0.0, seed=0):
+    '''Return the times of npulses synchronization pulses.'''
+    rng = np.random.RandomState(seed)
+    times = start + np.arange(npulses) / framerate
+    if jitter > 0:
+        times += rng.uniform(-jitter, jitter, npulses)
+    return times
+
+def write_sync_wav(filename, times, rate=44100, sync_chan=1, algorithm='impulse', seed=0):
+    '''Write a stereo 16-bit .wav with noise in one channel and a train of
+synchronization pulses at times (in seconds) in channel sync_chan. With the
+'impulse' algorithm each pulse is a single-sample spike; with 'pstretch'
+it is a 1 ms rectangular pulse.'''
+    rng = np.random.RandomState(seed)
+    nsamp = int((times[-1] + 0.5) * rate)
+    data = np.zeros([nsamp, 2], dtype=np.int16)
+    data[:, 1 - sync_chan] = (rng.randn(nsamp) * 1000).astype(np.int16)
+    sync = (rng.randn(nsamp) * 100).astype(np.int16)
+    starts = np.round(np.asarray(times) * rate).astype(int)
+    if algorithm == 'pstretch':
+        for s in starts:
+            sync[s:s + int(0.001 * rate)] = 30000
+    else:
+        sync[starts] = 30000
+    data[:, sync_chan] = sync
+    with closing(wave.open(filename, 'wb')) as w:
+        w.setnchannels(2)
+        w.setsampwidth(2)
+        w.setframerate(rate)
+        w.writeframes(data.tobytes())
+
+def make_acquisition(acqdir, tstamp, npulses=200, h=256, w=128, drop_rate=0.02, dup_rate=0.0, framerate=60.0, rate=44100, stimulus='', seed=0):
+    '''Create a synthetic acquisition directory like ultrasession.py does,
+with a .bpr, .bpr.idx.txt, stereo .bpr.wav, stim.txt and params.cfg.
+Return the name of the .bpr file.'''
+    if not os.path.isdir(acqdir):
+        os.makedirs(acqdir)
+    base = os.path.join(acqdir, tstamp + '.bpr')
+    indexes = received_indexes(npulses, drop_rate, seed)
+    write_bpr(base, synth_frames(len(indexes), h, w, dup_rate, seed))
+    write_idx(base + '.idx.txt', indexes)
+    write_sync_wav(base + '.wav', pulse_times(npulses, framerate), rate, seed=seed)
+    with open(os.path.join(acqdir, 'stim.txt'), 'w') as f:
+        f.write(stimulus)
+    with open(os.path.join(acqdir, 'params.cfg'), 'w') as f:
+        f.write('B-Mode/Depth={:d}\n'.format(h))
+    return base
+
+def make_experiment(expdir, nacq=4, start=None, utcoffset='-0800', subject='s01', **kwargs):
+    '''Create a synthetic experiment with nacq timestamped acquisitions in
+an expdir/subject directory, and a runtime_vars.txt that names the subject
+level. Additional keyword arguments are passed to make_acquisition().
+Return the list of .bpr files.'''
+    if start is None:
+        start = datetime(2015, 1, 1, 12, 0, 0)
+    if not os.path.isdir(expdir):
+        os.makedirs(expdir)
+    with open(os.path.join(expdir, 'runtime_vars.txt'), 'w') as f:
+        f.write('subject\n')
+    bprs = []
+    for idx in range(nacq):
+        ts = (start + timedelta(minutes=idx)).strftime('%Y-%m-%dT%H%M%S')
+        ts += utcoffset
+        kwargs['seed'] = idx
+        bprs.append(make_acquisition(
+            os.path.join(expdir, subject, ts), ts, stimulus='stim{:d}'.format(idx),
+            **kwargs
+        ))
+    return bprs
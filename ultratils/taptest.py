@@ -1,40 +1,157 @@
 from __future__ import division
 import numpy as np
-from scipy import ndimage
-import scipy.signal as signal
-import scipy.io.wavfile
 
-from ultratils.pysonix.bprreader import BprReader
+from ultratils.wavreader import WavReader
+import ultratils.motion
 
 # Algorithms to analyze taptests.
+#
+# The audio algorithms work on a signal that is read once with load_audio(),
+# so that several algorithms can be run on one decode of the .wav file. The
+# peakdiff() and impulse() functions read the file themselves.
+#
+# estimate_lag() aligns the audio and the images as a whole instead of at a
+# single tap point: the audio envelope and the image motion-energy series
+# are resampled to a common rate, and the lag is the peak of their FFT
+# cross-correlation, refined to a fraction of a sample by fitting a
+# parabola to the peak and its neighbors.
+
+AUDIO_ALGORITHMS = ('peakdiff', 'impulse')
+
+def load_audio(wavfile, chan=0):
+    '''Return (sig, rate) of channel chan of wavfile as int32 samples.'''
+    with WavReader(wavfile) as w:
+        sig = np.array(w.channel(chan), dtype=np.int32)
+        rate = w.rate
+    return (sig, rate)
+
+def peakdiff_signal(sig, rate):
+    '''Return the tap time by the 'peakdiff' algorithm for a signal.'''
+    atapidx = np.argmax(np.diff(np.abs(sig), n=1))
+    return float(atapidx) / rate
+
+def impulse_signal(sig, rate, threshold=0.5):
+    '''Return the tap time by the 'impulse' algorithm for a signal: the
+first sample whose magnitude exceeds threshold times the signal maximum.'''
+    mag = np.abs(sig)
+    return float(np.argmax(mag > threshold * np.max(mag))) / rate
+
+def audio_taps(sig, rate, algorithms=AUDIO_ALGORITHMS):
+    '''Return a dict of algorithm: tap time for a signal.'''
+    funcs = {'peakdiff': peakdiff_signal, 'impulse': impulse_signal}
+    taps = {}
+    for alg in algorithms:
+        try:
+            taps[alg] = funcs[alg](sig, rate)
+        except KeyError:
+            raise ValueError('Unknown audio algorithm {:}.'.format(alg))
+    return taps
 
 def peakdiff(wavfile):
     '''Find tap by 'peakdiff' algorithm, which finds the peak of the .wav file's first differential.'''
-    (rate, audio) = scipy.io.wavfile.read(wavfile)
-    atapidx = np.argmax(np.diff(np.abs(audio[:,0]), n=1))
-    ataptime = np.float(atapidx) / rate
-    return ataptime
+    return peakdiff_signal(*load_audio(wavfile))
 
 def impulse(wavfile):
-    '''Find tap by 'impulse' algorithm.'''
-    (rate, audio) = scipy.io.wavfile.read(wavfile)
+    '''Find tap by 'impulse' algorithm, which finds the first sample that exceeds half of the .wav file's maximum magnitude.'''
+    return impulse_signal(*load_audio(wavfile))
+
+def envelope(sig, rate, outrate):
+    '''Return the mean magnitude of sig in consecutive blocks of 1/outrate
+seconds, i.e. its amplitude envelope at outrate.'''
+    nout = int(len(sig) * outrate // rate)
+    if nout == 0:
+        return np.zeros(0)
+    bounds = np.round(np.arange(nout + 1) * (rate / outrate)).astype(np.int64)
+    mag = np.abs(sig[:bounds[-1]]).astype(np.float64)
+    sums = np.add.reduceat(mag, bounds[:-1])
+    return sums / np.diff(bounds)
+
+def to_grid(t, values, outrate, nout):
+    '''Linearly interpolate the samples values at times t onto a grid of
+nout samples at outrate starting at 0, ignoring nan values.'''
+    ok = ~np.isnan(values)
+    grid = np.arange(nout) / float(outrate)
+    if not np.any(ok):
+        return np.zeros(nout)
+    return np.interp(grid, t[ok], values[ok])
+
+def _zscore(x):
+    x = x - np.mean(x)
+    sd = np.std(x)
+    return x / sd if sd > 0 else x
+
+def xcorr_lag(a, b, max_lag=None):
+    '''Return (lag, peak) of the FFT cross-correlation of a and b, where lag
+is the number of samples (with a fractional part) by which b lags a, and
+peak is the normalized correlation at that lag. max_lag limits the
+searched lags to -max_lag..max_lag samples.'''
+    n = max(len(a), len(b))
+    a = _zscore(np.asarray(a, dtype=np.float64))
+    b = _zscore(np.asarray(b, dtype=np.float64))
+    nfft = 1 << int(np.ceil(np.log2(2 * n)))
+    cc = np.fft.irfft(np.conj(np.fft.rfft(a, nfft)) * np.fft.rfft(b, nfft), nfft)
+    # cc[k] is the correlation at lag k, with negative lags at the end.
+    if max_lag is None:
+        max_lag = n - 1
+    max_lag = int(min(max_lag, n - 1))
+    lags = np.arange(-max_lag, max_lag + 1)
+    vals = cc[lags % nfft]
+    i = int(np.argmax(vals))
+    frac = 0.0
+    if 0 < i < len(vals) - 1:
+        (y0, y1, y2) = vals[i - 1:i + 2]
+        denom = y0 - 2 * y1 + y2
+        if denom < 0:
+            frac = 0.5 * (y0 - y2) / denom
+    return (lags[i] + frac, vals[i] / n)
+
+def estimate_lag(bprfile, algorithms=AUDIO_ALGORITHMS, rate=1000.0, depth=69, max_lag=1.0, chan=0, sidx=None):
+    '''Estimate the lag of the image taps behind the audio taps of a taptest
+acquisition.
+
+bprfile = the .bpr file; the .bpr.wav and the sync index (.bpr.sync.npz or
+    .bpr.sync.TextGrid) are found next to it
+algorithms = audio tap algorithms to run on the single decode of the audio
+rate = common rate, in Hz, of the audio envelope and the motion series
+depth = number of image rows nearest the transducer used for the motion
+    series
+max_lag = largest lag searched, in seconds
+chan = audio channel of the microphone
+sidx = optional SyncIndex of the acquisition
+
+Returns a dict with the lag in seconds, the peak correlation and the tap
+time of each audio algorithm.
+'''
+    if sidx is None:
+        from ultratils.syncindex import SyncIndex
+        sidx = SyncIndex.for_textgrid(bprfile + '.sync.TextGrid', bprfile + '.sync.npz')
+    (sig, arate) = load_audio(bprfile + '.wav', chan)
+    result = audio_taps(sig, arate, algorithms)
+    env = envelope(sig, arate, rate)
+    me = ultratils.motion.motion_energy(
+        bprfile, regions={'depth': ultratils.motion.depth_band(depth)},
+        stats=['std']
+    )
+    (t, motion) = me.at_pulses(sidx, 'std', 'depth')
+    motion = to_grid(t, motion, rate, len(env))
+    (lag, peak) = xcorr_lag(env, motion, max_lag * rate)
+    result['lag'] = float(lag / rate)
+    result['corr'] = float(peak)
+    return result
 
-def standard_dev(bprfile, depth, factor):
+def standard_dev(bprfile, depth, factor, me=None):
     '''Find tap in images using 'standard deviation' method, which calculates the standard deviation of the difference of consecutive image frames and chooses the first frame that exceeds a multiple of the mean standard deviation.
 depth is the number of rows (closest to the transducer) in which to examine the standard deviation
-factor is multiplied by the mean standard deviation to find a threshold'''
-# Number of rows in which to check for changes. Row 0 is nearest the transducer.
-    rdr = BprReader(bprfile)
-    prev = rdr.get_frame(0)[range(depth),:]
-    stds = np.zeros([rdr.header.nframes])
-    for idx in range(1,rdr.header.nframes):
-        frame = rdr.get_frame(idx)[range(depth),:]
-        dframe = np.abs(frame - prev)
-        stds[idx] = np.std(dframe)
-        prev = frame
-    
-    threshold = factor * np.mean(stds)
-    # Find the frame indexes where the threshold is exceeded.
-    high = np.where(stds > threshold)[0]
+factor is multiplied by the mean standard deviation to find a threshold
+me is an optional ultratils.motion.MotionEnergy with a 'depth' region and 'std' statistic; by default it is computed from bprfile, or loaded from its cache file
+Returns the raw data index of the tap frame, or None.'''
+    if me is None:
+        me = ultratils.motion.motion_energy(
+            bprfile,
+            regions={'depth': ultratils.motion.depth_band(depth)},
+            stats=['std']
+        )
+    # Frame 0 has no preceding frame and counts as 0 in the mean.
+    stds = np.nan_to_num(me.get('std', 'depth'))
     # Find the first frame index that is not in the first five frames.
-    return high[np.where(high > 4)[0][0]]
+    return ultratils.motion.first_exceeding(stds, factor, skip=5)
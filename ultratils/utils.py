@@ -5,14 +5,11 @@ import errno
 from datetime import datetime
 from dateutil.tz import tzlocal
 import numpy as np
-import pandas as pd
-try:
-    import ultratils.acq
-except:
-    pass
-import audiolabel
 from ultratils.pysonix.bprreader import BprReader
 
+# pandas and ultratils.acq are imported by the functions that use
+# them, to keep the import of this module fast.
+
 def make_acqdir(datadir):
     """Make a timestamped directory in datadir and return a tuple with its 
 name and timestamp. Does not complain if directory already exists."""
@@ -29,7 +26,7 @@ name and timestamp. Does not complain if directory already exists."""
             raise
     return (acqdir, tstamp)
 
-def extract_frames(expdir, list_filename=None, frames=None):
+def extract_frames(expdir, list_filename=None, frames=None, enhance=None):
     """Extract image frames from specified acquisitions and return as a numpy array and
 dataframe with associated metadata.
 
@@ -37,11 +34,16 @@ list_filename = filename containing a list of tuple triples, as in frames
 frames = list of tuple triples containing an acquisition timestamp string, a
     raw_data_idx frame index, and data type (default is 'bpr')
 expdir = the root experiment data directory
+enhance = optional ultratils.enhance.Chain or spec string; the frames of each
+    acquisition are enhanced in one batch, with the statistics of that
+    acquisition
 
 Returns an (np.array, pd.DataFrame) tuple in which the array contains the frames of
 image data and the DataFrame contains acquisition metadata. The rows of the
 DataFrame correspond to the first axis of the array.
 """
+    import pandas as pd
+    import ultratils.acq
     fields = ['stimulus', 'timestamp', 'utcoffset', 'versions', 'n_pulse_idx',
                'n_raw_data_idx', 'pulse_max', 'pulse_min', 'imaging_params',
                'n_frames', 'image_w', 'image_h', 'probe']
@@ -56,6 +58,8 @@ DataFrame correspond to the first axis of the array.
 
     rows = []
     data = None
+    # Image file of each extracted frame, for enhancement.
+    files = [None] * len(frames)
     for idx, rec in frames.iterrows():
         a = ultratils.acq.Acq(
             timestamp=rec['tstamp'],
@@ -69,7 +73,7 @@ DataFrame correspond to the first axis of the array.
         if rec['dtype'] == 'bpr':
             rdr = BprReader(a.abs_image_file)
         else:
-            raise AcqError('Only bpr data is supported.')
+            raise ultratils.acq.AcqError('Only bpr data is supported.')
 
         # Initialize array with NaN on first pass.
         if data is None:
@@ -80,42 +84,55 @@ DataFrame correspond to the first axis of the array.
             if 'fr_id' in frames.select_dtypes(include=['integer']).columns:
                 fr_idx = rec['fr_id']
             else:
-                lm = audiolabel.LabelManager(
-                    from_file=a.abs_sync_tg,
-                    from_type='praat'
-                )
-                fr_idx = int(lm.tier('raw_data_idx').label_at(rec['fr_id']).text)
+                fr_idx = int(a.sync_index.raw_data_idx_at(rec['fr_id']))
+                if fr_idx < 0:
+                    raise ValueError('No frame at {:}.'.format(rec['fr_id']))
             data[idx] = rdr.get_frame(fr_idx)
+            files[idx] = a.abs_image_file
         except Exception as e: 
             fr_idx = None
         row = a.as_dict(fields)
         row['raw_data_idx'] = fr_idx
         rows.append(row)
+    if enhance is not None and data is not None:
+        import ultratils.enhance
+        chain = ultratils.enhance.as_chain(enhance)
+        files = np.array(files, dtype=object)
+        for fname in set(f for f in files if f is not None):
+            sel = files == fname
+            bound = chain.for_reader(BprReader(fname))
+            data[sel] = bound.apply(data[sel].astype(np.uint8))
     return (data, pd.DataFrame.from_records(rows))
 
-def is_white_bpr(bpr_file_name):
-    """check for 'white fan of death' BPRs (unusually bright shading and loss of contrast information)."""
-    check_bpr = ultratils.pysonix.bprreader.BprReader(bpr_file_name) # select first frame for checking - problem does seem to manifest here.
-    frame = check_bpr.get_frame(0)
+def is_white_bpr(bpr_file_name, rdr=None):
+    """check for 'white fan of death' BPRs (unusually bright shading and loss of contrast information).
+If rdr is an already open BprReader for bpr_file_name it is used instead of opening the file again."""
+    if rdr is None:
+        rdr = BprReader(bpr_file_name)
+    frame = rdr.get_frame(0) # select first frame for checking - problem does seem to manifest here.
     if (np.mean(frame) > 200) and (np.var(frame) < 1200):
         return True
     else:
         return False
 
-def is_frozen_bpr(bpr_file_name):
-    """check for frozen BPRs (identical frame-to-frame)."""
-    check_bpr_first = ultratils.pysonix.bprreader.BprReader(bpr_file_name) # select first and second frames for checking - problem does seem to manifest here.
-    frame_first = check_bpr_first.get_frame(0)
-    check_bpr_second = ultratils.pysonix.bprreader.BprReader(bpr_file_name)
-    frame_second = check_bpr_first.get_frame(1)
+def is_frozen_bpr(bpr_file_name, rdr=None):
+    """check for frozen BPRs (identical frame-to-frame).
+If rdr is an already open BprReader for bpr_file_name it is used instead of opening the file again."""
+    if rdr is None:
+        rdr = BprReader(bpr_file_name)
+    # select first and second frames for checking - problem does seem to manifest here.
+    frame_first = rdr.get_frame(0)
+    frame_second = rdr.get_frame(1)
     if np.array_equal(frame_first,frame_second):
         return True
     else:
         return False
 
-def is_bad_bpr(bpr_file_name):
+def is_bad_bpr(bpr_file_name, rdr=None):
     """check for any type of badly recorded BPR."""
-    if is_white_bpr(bpr_file_name) or is_frozen_bpr(bpr_file_name):
+    if rdr is None:
+        rdr = BprReader(bpr_file_name)
+    if is_white_bpr(bpr_file_name, rdr) or is_frozen_bpr(bpr_file_name, rdr):
         return True
     else:
         return False
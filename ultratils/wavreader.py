@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+
+import os, sys
+import struct
+import numpy as np
+
+# WAVE format tags.
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+class WavReaderError(Exception):
+    """Base class for errors in this module."""
+    def __init__(self, msg):
+        self.msg = msg
+    def __str__(self):
+        return repr(self.msg)
+
+def unpack24(packed):
+    '''Return an array of little-endian 24-bit samples, with a last axis of
+3 bytes, as int32 with the samples in the high three bytes, as
+scipy.io.wavfile.read() returns them.'''
+    packed = np.asarray(packed)
+    out = np.zeros(packed.shape[:-1] + (4,), dtype=np.uint8)
+    out[..., 1:] = packed
+    return out.view('<i4')[..., 0]
+
+def pack24(sig):
+    '''Invert unpack24(): return the little-endian 24-bit bytes of int32
+samples in the high three bytes.'''
+    sig = np.ascontiguousarray(sig, dtype='<i4')
+    return sig.view(np.uint8).reshape(sig.shape + (4,))[..., 1:].tobytes()
+
+class WavReader(object):
+    '''Class for memory-mapped access to the sample data of a .wav file.
+
+    Only the RIFF chunk headers are read on construction. The data chunk
+    is memory-mapped as a (nframes, nchannels) array, and channel and time
+    window selections are returned as views of the mapped file, so that
+    only the samples that are actually used are read from disk.
+
+    Parameters
+    ----------
+    filename : str
+    The name of the .wav file to read.
+
+    Attributes
+    ----------
+    rate : int
+    Sample rate in Hz.
+
+    nchannels : int
+    Number of audio channels.
+
+    nframes : int
+    Number of sample frames in the data chunk. If the data chunk size in
+    the header is larger than the file (e.g. an unfinalized recording),
+    nframes is calculated from the file size instead.
+
+    dtype : numpy dtype
+    The data type of the samples. 24-bit samples are mapped as bytes and
+    are unpacked to int32, in the high three bytes, only when they are
+    selected; selections of 24-bit files are arrays rather than views.
+
+    '''
+    def __init__(self, filename):
+        self.filename = os.path.abspath(filename)
+        self._data = None
+        fmt = None
+        with open(self.filename, 'rb') as f:
+            riff, riffsize, wave = struct.unpack('<4sI4s', f.read(12))
+            if riff != b'RIFF' or wave != b'WAVE':
+                raise WavReaderError(
+                    '{:} is not a RIFF WAVE file.'.format(filename)
+                )
+            while True:
+                chunkhdr = f.read(8)
+                if len(chunkhdr) < 8:
+                    raise WavReaderError(
+                        'No data chunk found in {:}.'.format(filename)
+                    )
+                chunkid, chunksize = struct.unpack('<4sI', chunkhdr)
+                if chunkid == b'fmt ':
+                    fmt = f.read(chunksize)
+                    if chunksize % 2:
+                        f.seek(1, os.SEEK_CUR)
+                elif chunkid == b'data':
+                    self.data_offset = f.tell()
+                    datasize = chunksize
+                    break
+                else:
+                    f.seek(chunksize + (chunksize % 2), os.SEEK_CUR)
+        if fmt is None:
+            raise WavReaderError('No fmt chunk found in {:}.'.format(filename))
+        (tag, self.nchannels, self.rate, byterate, blockalign, bits) = \
+            struct.unpack('<HHIIHH', fmt[:16])
+        if tag == WAVE_FORMAT_EXTENSIBLE and len(fmt) >= 26:
+            tag = struct.unpack('<H', fmt[24:26])[0]
+        self.sampwidth = bits // 8
+        if tag == WAVE_FORMAT_PCM and self.sampwidth == 1:
+            self.dtype = np.dtype(np.uint8)
+        elif tag == WAVE_FORMAT_PCM and self.sampwidth in (2, 4):
+            self.dtype = np.dtype('<i{:d}'.format(self.sampwidth))
+        elif tag == WAVE_FORMAT_PCM and self.sampwidth == 3:
+            self.dtype = np.dtype('<i4')
+        elif tag == WAVE_FORMAT_IEEE_FLOAT and self.sampwidth in (4, 8):
+            self.dtype = np.dtype('<f{:d}'.format(self.sampwidth))
+        else:
+            raise WavReaderError(
+                'Unsupported format {:d} with {:d} bits per sample.'.format(
+                    tag, bits
+                )
+            )
+        self.framesize = self.nchannels * self.sampwidth
+        filesize = os.stat(self.filename).st_size
+        avail = filesize - self.data_offset
+        if datasize > avail:
+            sys.stderr.write(
+                'WARNING: data chunk of {:} extends beyond end of file.\n'.format(
+                    filename
+                )
+            )
+            datasize = avail
+        self.nframes = int(datasize // self.framesize)
+
+    @property
+    def _mapped(self):
+        '''The memory-mapped data chunk, as a (nframes, nchannels) array, or
+a (nframes, nchannels, 3) byte array for 24-bit samples.'''
+        if self._data is None:
+            shape = (self.nframes, self.nchannels)
+            dtype = self.dtype
+            if self.sampwidth == 3:
+                shape += (3,)
+                dtype = np.uint8
+            if self.nframes == 0:
+                self._data = np.zeros(shape, dtype=dtype)
+            else:
+                self._data = np.memmap(
+                    self.filename, dtype=dtype, mode='r',
+                    offset=self.data_offset, shape=shape
+                )
+        return self._data
+
+    def _select(self, idx):
+        '''Return the samples of the data chunk at index idx, unpacking
+24-bit samples.'''
+        if self.sampwidth == 3:
+            return unpack24(self._mapped[idx])
+        return self._mapped[idx]
+
+    @property
+    def data(self):
+        '''Return all samples as a memory-mapped (nframes, nchannels) array.
+24-bit samples are unpacked into a new array.'''
+        return self._select(np.s_[:])
+
+    @property
+    def duration(self):
+        '''Duration of the audio in seconds.'''
+        return self.nframes / float(self.rate)
+
+    # Define __enter__ and __exit__ to create context manager.
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        '''Release the memory map.'''
+        self._data = None
+
+    def time2idx(self, t):
+        '''Return the sample index nearest to time t, clipped to the data.'''
+        idx = int(np.round(t * self.rate))
+        return min(max(idx, 0), self.nframes)
+
+    def channel(self, chan):
+        '''Return a strided view of a single channel.'''
+        return self._select(np.s_[:, int(chan)])
+
+    def tslice(self, t1=None, t2=None, chan=None):
+        '''
+        Return a view of the samples between times t1 and t2 (in seconds).
+        If chan is None return all channels as a 2D array, otherwise return
+        a 1D view of channel chan.
+        '''
+        idx1 = 0 if t1 is None else self.time2idx(t1)
+        idx2 = self.nframes if t2 is None else self.time2idx(t2)
+        if chan is None:
+            return self._select(np.s_[idx1:idx2])
+        else:
+            return self._select(np.s_[idx1:idx2, int(chan)])
+
+    def iter_float(self, chan=None, t1=None, t2=None, blocksize=65536,
+dtype=np.float32):
+        '''
+        Iterate over the samples between t1 and t2 in blocks of at most
+        blocksize frames, converting each block to normalized (range [-1 1])
+        floating point as it is reached.
+        '''
+        idx1 = 0 if t1 is None else self.time2idx(t1)
+        idx2 = self.nframes if t2 is None else self.time2idx(t2)
+        cols = np.s_[:] if chan is None else int(chan)
+        for start in range(idx1, idx2, blocksize):
+            block = self._select(np.s_[start:min(start + blocksize, idx2), cols])
+            yield self.as_float(block, dtype)
+
+    def read_float(self, chan=None, t1=None, t2=None, dtype=np.float32):
+        '''
+        Return the samples between t1 and t2 as normalized (range [-1 1])
+        floating point. Only the selected samples are converted.
+        '''
+        return self.as_float(self.tslice(t1, t2, chan), dtype)
+
+    def as_float(self, sig, dtype=np.float32):
+        '''Convert a block of samples from this file to normalized float.'''
+        dtype = np.dtype(dtype)
+        if self.dtype.kind == 'f':
+            return sig.astype(dtype)
+        elif self.dtype.kind == 'u':   # 8-bit .wav data is unsigned
+            return (sig.astype(dtype) - dtype.type(128)) / dtype.type(128)
+        else:
+            return sig.astype(dtype) / dtype.type(-np.iinfo(self.dtype).min)